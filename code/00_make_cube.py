@@ -0,0 +1,89 @@
+##################################################################################
+#
+#       Make Cubes
+#       By Cascade Tuholske, cascade (dot) tuholske1 (at) montana (dot) edu  
+#
+#       ALWAYS CHECK FILE PATHS AND FILE NAMES BEFORE RUNNING
+#
+#       Loads each year of daily CHC-CMIP6 Tmax and RHx tifs (or the himax / 
+#       wbgtmax tifs from 01_Make-HI-WBGT.py) into a chunked, memory-mapped 
+#       (time, y, x) cube, see CubeFuncs.py. The cube steps in 01 and 02 then 
+#       read one file per year instead of opening every daily tif, and the 
+#       time series of a pixel is contiguous on disk.
+#
+#       Update args for each run (e.g. SSP_dataset, data_list) in main.
+#
+#################################################################################
+
+# Dependencies 
+import os
+import glob
+import time
+import multiprocessing as mp 
+from multiprocessing import Pool
+import CubeFuncs
+
+# Functions
+
+def cube_loop(year):
+    
+    """
+    Loads the daily rasters of each dataset in `data_list` for a year into a cube, 
+    written to `path` + `SSP_dataset` + '/cubes/' + data + '.' + year + '.npy'.
+
+    Args:
+        year (int): The year to load.
+
+    Note:
+        - Ensure that `path`, `SSP_dataset`, `data_list` and `chunk` are defined and accessible 
+          in the global scope.
+        - Daily rasters are found in `path` + `SSP_dataset` + '/' + data + '/' + year, and the 
+          date is whatever follows data + '.' in the file name.
+    """
+    
+    print(mp.current_process(), year)
+    
+    for data in data_list:
+        fns = sorted(glob.glob(os.path.join(path, SSP_dataset + '/' + data + '/' + str(year) + '/*.tif')))
+        dates = [os.path.basename(fn).split(data + '.')[-1].split('.tif')[0] for fn in fns]
+        fn_out = os.path.join(path, SSP_dataset + '/cubes/' + data + '.' + str(year) + '.npy')
+        CubeFuncs.ingest(fns, dates, fn_out, chunk)
+
+def parallel_loop(function, start_list, cpu_num):
+    """
+    Executes a given function in parallel using multiple CPU cores.
+
+    This function leverages Python's multiprocessing capabilities to run the 
+    specified function concurrently across a given number of CPU cores. The 
+    function is applied to each element of the provided `start_list`.
+
+    Args:
+        function (callable): The function to execute in parallel. It should be 
+            able to accept elements from the `start_list` as arguments.
+        start_list (list): A list of arguments to pass to the `function` in parallel.
+        cpu_num (int): The number of CPU cores to utilize for parallel processing.
+    """
+    start = time.time()
+    pool = Pool(processes = cpu_num)
+    pool.map(function, start_list)
+    pool.close()
+
+    end = time.time()
+    print(end-start)
+
+# Run it
+if __name__ == "__main__":
+    
+    # Set args
+    path = os.path.join('') # PATH/TO/DATA
+    SSP_dataset = '2050_SSP245' # blank for observational data 
+    data_list = ['Tmax', 'RHx'] # or ['wbgtmax'] to cube the 01 outputs
+    chunk = 128 # chunk size in pixels
+    
+    # set year list to feed cube_loop
+    year_list = list(range(1983,2016+1))
+    
+    # run it
+    parallel_loop(function = cube_loop, start_list = year_list, cpu_num = os.cpu_count()) # number of CPUS available
+    
+    print('done!')
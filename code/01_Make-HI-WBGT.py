@@ -21,16 +21,154 @@
 
 #### Dependencies
 import numpy as np
-import pandas as pd
-import xarray 
 import os
+import json
 import glob
 import rasterio
 import time
 import multiprocessing as mp 
 from multiprocessing import Pool
 import multiprocessing
+from functools import partial
 import ClimFuncs
+import RasterFuncs
+import CubeFuncs
+import RunFuncs
+import TraceFuncs
+
+#### Run settings (update in main as needed)
+rh_handle = 'RHx.' # or Tmax. 
+SSP_dataset = '2050_SSP245' # blank for observational data 
+path = os.path.join('') #PATH/TO/DATA 
+write_daily = True # write the daily himax and wbgtmax tifs
+out_profile = 'gtiff' # daily tif encoding, see RasterFuncs.out_profiles: 'gtiff', 'deflate', 'zstd', 'cog' or 'int16' (0.01 °C)
+count_thresh = None # WBGTmax threshold (°C), or list of them, to count days above in the same pass, None to skip counting
+n_threads = 1 # threads per year, each works on its own row window of the rasters 
+mem_mb = None # memory budget per year in MB for the row windows, None to split rows evenly across threads
+prefetch = 1 # days read ahead in a background thread (full days, 2 x 4 bytes per pixel each), 0 to read each window in its thread within mem_mb
+land_only = False # compute on the land pixels only (RasterFuncs.land_index of land_ref, cached per grid), ocean written as -9999
+land = None # the land index the land_only tasks use, made in main before the pool
+
+def hi_wbgt(tmax, rh, scratch, arr, wbgt_arr = None):
+    """
+    HImax and WBGTmax in °C from Tmax in °C and RHx, with CMIP NaN set to -9999. Works on 
+    any shape, a day, a window or a (time, rows, cols) block.
+
+    Args:
+        tmax, rh (np.ndarray): Tmax and RHx.
+        scratch (tuple): ClimFuncs.hi_scratch buffers of the same shape.
+        arr (np.ndarray): float32 array of the same shape to write HImax into.
+        wbgt_arr (np.ndarray): float32 array of the same shape to write WBGTmax into, None to make one.
+
+    Returns arr (HImax) and WBGTmax
+    """
+    
+    if wbgt_arr is None:
+        wbgt_arr = np.empty(arr.shape, dtype = 'float32')
+    _, a, b, mask, _ = scratch
+    
+    # calculate heat index, float32 ndarray version of ClimFuncs.heatindex
+    with TraceFuncs.stage('hi'):
+        ClimFuncs.heatindex_np(Tmax = tmax, RH = rh, unit_in = 'C', unit_out = 'C', out = arr, scratch = scratch)
+    
+        # CMIP NaN
+        np.less(arr, -1000, out = mask)
+        np.copyto(arr, -9999, where = mask)
+    
+    # make wbgt, C_to_F and hi_to_wbgt done in place in the scratch buffers, same ops and order
+    with TraceFuncs.stage('wbgt'):
+        np.multiply(arr, 9/5, out = a) # convert hi to F
+        a += 32
+        np.square(a, out = wbgt_arr) # write wbgt in c
+        wbgt_arr *= -0.0034
+        np.multiply(a, 0.96, out = b)
+        wbgt_arr += b
+        wbgt_arr -= 34
+    
+        # CMIP NaN
+        np.less(wbgt_arr, -1000, out = mask)
+        np.copyto(wbgt_arr, -9999, where = mask)
+    
+    return arr, wbgt_arr
+
+def hi_window(window, tmax, rh, hi_out, wbgt_out, threshs, counts, nan_mask):
+    """
+    Makes HImax and WBGTmax for one row window of one day. Called by hi_loop for each 
+    window, possibly from several threads at once, so it only reads its own window, 
+    writes its own window of the output rasters and its own slice of the count arrays.
+
+    Args:
+        window (rasterio.windows.Window): the row window to process.
+        tmax (str or np.ndarray): daily Tmax raster, or the day already read (see `prefetch`).
+        rh (str or np.ndarray): daily RHx raster, or the day already read.
+        hi_out, wbgt_out (rasterio datasets or None): open daily outputs, None to skip writing.
+        threshs (list): WBGTmax thresholds to count days above.
+        counts (np.ndarray or None): annual count arrays, one band per threshold, None to skip counting.
+        nan_mask (np.ndarray or None): ocean/nan locations of the day, updated with the counts.
+    """
+    
+    # read the window, or take it from the prefetched day
+    rows, cols = window.toslices()
+    if isinstance(tmax, str):
+        with TraceFuncs.stage('read') as trace:
+            tmax = RasterFuncs.read_window(tmax, window)
+            rh = RasterFuncs.read_window(rh, window)
+            trace['bytes'] = tmax.nbytes + rh.nbytes
+    else:
+        tmax = tmax[rows, cols]
+        rh = rh[rows, cols]
+    
+    # Update No data value / RHx nan are literally str 'nan' -- CPT March 2023
+    # rh = np.nan_to_num(rh, nan = -9999)
+    
+    # calculate heat index and wbgt reusing the thread's buffers every day
+    scratch, arr, wbgt_arr = RasterFuncs.thread_buffers(tmax.shape, 
+        lambda: (ClimFuncs.hi_scratch(tmax.shape), np.empty(tmax.shape, dtype = 'float32'), np.empty(tmax.shape, dtype = 'float32')))
+    arr, wbgt_arr = hi_wbgt(tmax, rh, scratch, arr, wbgt_arr)
+    
+    if hi_out is not None:
+        with TraceFuncs.stage('write', arr.nbytes + wbgt_arr.nbytes):
+            RasterFuncs.write_window(hi_out, arr, window)
+            RasterFuncs.write_window(wbgt_out, wbgt_arr, window)
+    
+    # add the day to the annual counts, same as 02_count_days.py 
+    if counts is not None:
+        with TraceFuncs.stage('count'):
+            mask = scratch[3]
+            for j, t in enumerate(threshs):
+                np.greater(wbgt_arr, t, out = mask) # nan and -9999 are never above thresh
+                counts[j, rows, cols] += mask
+            np.equal(wbgt_arr, -9999, out = nan_mask[rows, cols]) # ocean/nan locations
+            np.isfinite(wbgt_arr, out = mask)
+            np.logical_not(mask, out = mask)
+            nan_mask[rows, cols] |= mask
+
+def hi_land(sl, tmax, rh, hi, wbgt, threshs, counts):
+    """
+    Makes HImax and WBGTmax for one slice of the packed land pixels of a day, the `land_only` 
+    version of hi_window. Called by hi_days for each slice, possibly from several threads at 
+    once, so it only writes its own slice of the packed outputs and counts.
+
+    Args:
+        sl (slice): the slice of the packed vectors to process.
+        tmax, rh (np.ndarray): packed Tmax and RHx of the day.
+        hi, wbgt (np.ndarray): packed float32 HImax and WBGTmax of the day to write into.
+        threshs (list): WBGTmax thresholds to count days above.
+        counts (np.ndarray or None): packed annual count arrays, one row per threshold, None to skip counting.
+    """
+    
+    # calculate heat index and wbgt straight into the packed outputs
+    n = sl.stop - sl.start
+    scratch = RasterFuncs.thread_buffers(('land', n), lambda: ClimFuncs.hi_scratch((n,)))
+    hi_wbgt(tmax[sl], rh[sl], scratch, hi[sl], wbgt[sl])
+    
+    # add the day to the annual counts
+    if counts is not None:
+        with TraceFuncs.stage('count'):
+            mask = scratch[3]
+            for j, t in enumerate(threshs):
+                np.greater(wbgt[sl], t, out = mask) # nan and -9999 are never above thresh
+                counts[j, sl] += mask
 
 def hi_loop(year):
     """
@@ -41,36 +179,97 @@ def hi_loop(year):
     raster files, calculates the HImax and WBGTmax indices for each day using custom functions 
     from the `ClimFuncs` module, and saves the resulting rasters in a specified output directory.
 
+    If `count_thresh` is set, the daily WBGTmax arrays are also thresholded and summed in the 
+    same pass to make the annual count raster that `02_count_days.py` would make, so the daily 
+    wbgtmax tifs never have to be read back. Set `write_daily` to False to skip writing the 
+    daily rasters altogether.
+
     Args:
     year (int): The year for which the function processes data. All input files 
                 should be organized in directories by year.
     Notes:
     - Ensure that the `ClimFuncs` module is accessible and includes the required 
-      functions: `heatindex`, `C_to_F`, and `hi_to_wbgt`.
-    - The `SSP_dataset` variable can be modified to indicate specific scenarios or 
+      functions: `heatindex_np`, `hi_scratch`, `C_to_F`, and `hi_to_wbgt`.
+    - The `SSP_dataset` module global can be modified to indicate specific scenarios or 
       observational data.
     - Input and output file paths need to be appropriately defined.
+    - `write_daily`, `count_thresh`, `n_threads` and `mem_mb` are module globals, set them in main.
+    - Each day is processed in row windows (see `hi_window`) on `n_threads` threads, so one year
+      can use several cores while the working set stays under `mem_mb`.
+    - With `prefetch` the next days are read in a background thread into reused buffers while
+      the current day is computed, otherwise each window reads its own part of the day.
+    - With `land_only` each day is packed to its land pixels (see `hi_land`) and only those 
+      are computed and counted, the ocean is written as -9999.
+    - The work is done by `hi_days`, main can instead schedule blocks of days of every year 
+      over the workers with RunFuncs.schedule.
 
 
     """
     
     print(multiprocessing.current_process(), year)
     
-    # data handle + dataset for SSPs
-    rh_handle = 'RHx.' # or Tmax. 
-    SSP_dataset = '2050_SSP245' # blank for observational data 
-    #print(dataset)
+    result = hi_days((year, 0, None))
     
-    # Set up file paths for CMIP SSP 
-    path = os.path.join('') #PATH/TO/DATA 
+    # write the annual counts 
+    if result is not None:
+        write_counts(year, result)
+        TraceFuncs.flush()
+
+def hi_files(year):
+    """
+    Lists the year's daily CHIRTS RHx and Tmax rasters, paired by day.
+
+    Args:
+        year (int): year to list.
+
+    Returns list of (rh_fn, tmax_fn)
+    """
+    
+    # Set up file paths for CMIP SSP, data handle + dataset for SSPs are set at the top
     rh_path = os.path.join(path, SSP_dataset + '/' + rh_handle.split('.')[0] + '/' + str(year))  
     tmax_path = os.path.join(path, SSP_dataset + '/Tmax/' + str(year))   
-    hi_path = os.path.join(path, SSP_dataset + '/himax/' + str(year)) 
-    wbgt_path = os.path.join(path, SSP_dataset + '/wbgtmax/' + str(year)) 
      
     # Set up file paths for obsevational
 #     rh_path = os.path.join('', str(year))  
 #     tmax_path = os.path.join('', str(year)) 
+    
+    # CHIRTS-daily Tmax + RH
+    rh_fns = sorted(glob.glob(rh_path+'/*'+ rh_handle + '*.tif')) # RHx added 
+    tmax_fns = sorted(glob.glob(tmax_path+'/*.tif'))
+    zipped_list = list(zip(rh_fns,tmax_fns))
+    
+    # test
+    # zipped_list = zipped_list[340:]
+    
+    return zipped_list
+
+def land_ref(years):
+    """
+    Tmax rasters to make the land index from, the first day of each year, so a land pixel 
+    is only left out if it is nodata on all of them.
+    """
+    
+    return [hi_files(year)[0][1] for year in years if hi_files(year)]
+
+def day_outputs(year, fns):
+    """
+    File names of the daily himax and wbgtmax rasters made from a day of hi_files(year).
+
+    Args:
+        year (int): year of the day.
+        fns (tuple): (rh_fn, tmax_fn) of the day.
+
+    Returns (hi_fn, wbgt_fn)
+    """
+    
+    # get date
+    date = fns[0].split(rh_handle)[1].split('.tif')[0]
+    
+    # Set up file paths for CMIP SSP
+    hi_path = os.path.join(path, SSP_dataset + '/himax/' + str(year)) 
+    wbgt_path = os.path.join(path, SSP_dataset + '/wbgtmax/' + str(year)) 
+     
+    # Set up file paths for obsevational
 #     hi_path = os.path.join('himax-tmax-rhx/', str(year))
 #     wbgt_path = os.path.join('wbgtmax-tmax-rhx/', str(year))
                             
@@ -83,79 +282,361 @@ def hi_loop(year):
 #     os.system(cmd)
 #     print(cmd)
     
-    # CHIRTS-daily Tmax + RH
-    rh_fns = sorted(glob.glob(rh_path+'/*'+ rh_handle + '*.tif')) # RHx added 
-    tmax_fns = sorted(glob.glob(tmax_path+'/*.tif'))
-    zipped_list = list(zip(rh_fns,tmax_fns))
+#     hi_fn = os.path.join(hi_path, 'himax.'+date+'.tif') 
+    hi_fn = os.path.join(hi_path, SSP_dataset + '.' + 'himax' + '.' + date+'.tif') # CMIP 
+    wbgt_fn = os.path.join(wbgt_path, 'wbgtmax' +'.'+date+'.tif')
+#     wbgt_fn = os.path.join(wbgt_path, SSP_dataset + '.' + 'wbgtmax' + '.' + date+'.tif') # CMIP 
     
-    # test
-    zipped_list = zipped_list[340:]
+    return hi_fn, wbgt_fn
+
+def count_outputs(year):
+    """
+    File names of the fused-mode annual count rasters of a year, one per threshold in 
+    `count_thresh`, named like the 02_count_days.py outputs.
+    """
+    
+    threshs = count_thresh if isinstance(count_thresh, (list, tuple)) else [count_thresh]
+    count_path = os.path.join(path, SSP_dataset + '/annual_counts/') 
+    
+    return [os.path.join(count_path, 'wbgtmax' + str(t) + '/' + 'wbgtmax' + str(t) + '.count.' + str(year) + '.tif') 
+            for t in threshs]
+
+def hi_params(thresh = None):
+    """Run parameters the hi_loop outputs depend on, for the run manifest, with the threshold 
+    for a count raster."""
+    
+    params = {'SSP_dataset' : SSP_dataset, 'rh_handle' : rh_handle}
+    if thresh is not None:
+        params['thresh'] = thresh
+    else:
+        params['out_profile'] = out_profile
+    if land_only:
+        params['land_only'] = True
+    
+    return params
+
+def hi_todo(year, manifest):
+    """
+    Days of a year that still need to be run, going by the run manifest. A day is done if 
+    its himax and wbgtmax rasters are in the manifest with the key of its current inputs and 
+    parameters. With `count_thresh` set the counts need every day of the year, so the whole 
+    year is redone unless its count rasters and (with `write_daily`) all its days are done.
+
+    Args:
+        year (int): year to check.
+        manifest (dict): run manifest from RunFuncs.manifest_load.
+
+    Returns list of day indices into hi_files(year)
+    """
+    
+    zipped_list = hi_files(year)
+    todo = []
+    if write_daily:
+        for i, fns in enumerate(zipped_list):
+            key = RunFuncs.run_key(fns, hi_params())
+            if not all(RunFuncs.manifest_done(manifest, fn, key) for fn in day_outputs(year, fns)):
+                todo.append(i)
+    
+    if count_thresh is not None:
+        fns_in = [fn for fns in zipped_list for fn in fns]
+        threshs = count_thresh if isinstance(count_thresh, (list, tuple)) else [count_thresh]
+        counts_done = all(RunFuncs.manifest_done(manifest, fn, RunFuncs.run_key(fns_in, hi_params(t))) 
+                          for t, fn in zip(threshs, count_outputs(year)))
+        if todo or not counts_done:
+            todo = list(range(len(zipped_list)))
+    
+    return todo
+
+def hi_record(task, result, manifest, manifest_fn):
+    """Adds the daily rasters of a finished hi_days task to the run manifest and saves it."""
+    
+    year, start, stop = task
+    if write_daily:
+        for fns in hi_files(year)[start:stop]:
+            key = RunFuncs.run_key(fns, hi_params())
+            for fn in day_outputs(year, fns):
+                RunFuncs.manifest_add(manifest, fn, key)
+        RunFuncs.manifest_save(manifest, manifest_fn)
+
+def hi_finish(year, result, manifest, manifest_fn):
+    """Writes the annual counts of a finished year, from the handles of its partial counts 
+    (RunFuncs.spill), and adds them to the run manifest."""
+    
+    write_counts(year, RunFuncs.partial_merge(result))
+    fns_in = [fn for fns in hi_files(year) for fn in fns]
+    threshs = count_thresh if isinstance(count_thresh, (list, tuple)) else [count_thresh]
+    for t, fn in zip(threshs, count_outputs(year)):
+        RunFuncs.manifest_add(manifest, fn, RunFuncs.run_key(fns_in, hi_params(t)))
+    RunFuncs.manifest_save(manifest, manifest_fn)
+
+def hi_days(task):
+    """
+    Makes HImax and WBGTmax for a block of days of a year, the work of hi_loop split so the 
+    days of a year can be spread over workers (see RunFuncs.schedule).
+
+    Args:
+        task (tuple): (year, start, stop), the days hi_files(year)[start:stop].
+
+    Returns None, or if `count_thresh` is set the partial counts of the block as 
+    (counts, nan_mask, meta, stop) for RunFuncs.add_counts and write_counts
+    """
+    
+    year, start, stop = task
+    
+    zipped_list = hi_files(year)[start:stop]
+    
+    # count accumulators for the fused mode and row windows, made on the first day
+    threshs = count_thresh if isinstance(count_thresh, (list, tuple)) else [count_thresh]
+    counts = None
+    nan_mask = None
+    windows = None
+    
+    # days read ahead into reused buffers, or just the file names for each window to read its own part
+    if prefetch > 0 or land_only:
+        days = RasterFuncs.prefetch(zipped_list, prefetch)
+    else:
+        days = ((fns, fns, None) for fns in zipped_list)
     
     # start loop
-    for fns in zipped_list:
+    for fns, (rh, tmax), day_meta in days:
         
         print(fns)
         
-        # get date
-        date =fns[0].split(rh_handle)[1].split('.tif')[0]
-    
-        # data type
-        data_out = 'himax'
-    
-        # get meta data
-        meta = rasterio.open(fns[0]).meta
-        meta['dtype'] = 'float32'
-        meta['nodata'] = -9999
-    
-        # make hi
-        rh_fn = fns[0] 
-        tmax_fn = fns[1]
-        tmax = xarray.open_rasterio(tmax_fn)
-        rh = xarray.open_rasterio(rh_fn)
- 
-        # Update No data value / RHx nan are literally str 'nan' -- CPT March 2023
-        # rh.data = np.nan_to_num(rh.data, nan = -9999)
-        
-        # Update NaN value in meta data for CMIP -- CPT March 2023
-        rh.attrs['nodatavals'] = -9999
-        tmax.attrs['nodatavals'] = -9999
-        
-        # calculate heat index
-        hi = ClimFuncs.heatindex(Tmax = tmax, RH = rh, unit_in = 'C', unit_out = 'C')
-
-        # get array
-        arr = hi.data[0]
-        arr = arr.astype('float32') # to save space 
-        print(type(arr))
-        
-        # CMIP NaN
-        arr[arr < -1000] = -9999
+        # set up the meta data, row windows and counts on the first day
+        if windows is None:
+            meta = day_meta if day_meta is not None else rasterio.open(fns[0]).meta
+            meta['dtype'] = 'float32'
+            meta['nodata'] = -9999
+            if land_only: # packed land pixels in slices, and the full days to write them into
+                assert land is not None, 'land_only needs the land index from main, see land_ref'
+                windows = RasterFuncs.vector_chunks(land['idx'].size, n_threads)
+                tmax_v, rh_v, hi_v, wbgt_v = (np.empty(land['idx'].size, dtype = 'float32') for _ in range(4))
+                hi_full, wbgt_full = (np.full(land['shape'], -9999, dtype = 'float32') for _ in range(2))
+                shape = (land['idx'].size,)
+            else:
+                windows = RasterFuncs.row_windows(fns[1], px_bytes = 48, mem_mb = mem_mb, n_threads = n_threads)
+                shape = (meta['height'], meta['width'])
+            if count_thresh is not None:
+                counts = np.zeros((len(threshs),) + shape, dtype = 'int16')
+                nan_mask = np.zeros(shape, dtype = bool)
 
         # FN out
-        print(date)
-#         fn_out = os.path.join(hi_path, data_out +'.'+date+'.tif') 
-        fn_out = os.path.join(hi_path, SSP_dataset + '.' + data_out + '.' + date+'.tif') # CMIP 
+        hi_fn, wbgt_fn = day_outputs(year, fns)
+        TraceFuncs.set_tag(year = year, day = os.path.basename(hi_fn).split('himax.')[1].split('.tif')[0])
         
-        with rasterio.open(fn_out, 'w', **meta) as out:
-            out.write_band(1, arr)
-        print(fn_out, 'done')
-            
-        # make wbgt
-        data_out = 'wbgtmax'
-        fn_out = os.path.join(wbgt_path, data_out +'.'+date+'.tif')
-#         fn_out = os.path.join(wbgt_path, SSP_dataset + '.' + data_out + '.' + date+'.tif') # CMIP 
-        
-        hi_arr_f = ClimFuncs.C_to_F(arr) # convert hi to F
-        wbgt_arr = ClimFuncs.hi_to_wbgt(hi_arr_f) # write wbgt in c
-        wbgt_arr = wbgt_arr.astype('float32')
+        # make hi and wbgt on the land pixels, scattered back into the full days to write
+        if land_only:
+            with TraceFuncs.stage('pack'):
+                RasterFuncs.pack(tmax, land, out = tmax_v)
+                RasterFuncs.pack(rh, land, out = rh_v)
+            RasterFuncs.map_windows(partial(hi_land, tmax = tmax_v, rh = rh_v, hi = hi_v, wbgt = wbgt_v, 
+                threshs = threshs, counts = counts), windows, n_threads)
+            if write_daily:
+                with TraceFuncs.stage('write', hi_full.nbytes + wbgt_full.nbytes):
+                    RasterFuncs.unpack(hi_v, land, out = hi_full)
+                    RasterFuncs.unpack(wbgt_v, land, out = wbgt_full)
+                    with RasterFuncs.open_out(hi_fn, meta, out_profile) as hi_out, RasterFuncs.open_out(wbgt_fn, meta, out_profile) as wbgt_out:
+                        RasterFuncs.write_window(hi_out, hi_full, None)
+                        RasterFuncs.write_window(wbgt_out, wbgt_full, None)
+                print(hi_fn, 'done')
+                print(wbgt_fn, 'done')
         
-        # CMIP NaN
-        wbgt_arr[wbgt_arr < -1000] = -9999
-             
-        with rasterio.open(fn_out, 'w', **meta) as out:
-            out.write_band(1, wbgt_arr)
-        print(fn_out, 'done')
+        # make hi and wbgt window by window
+        elif write_daily:
+            with RasterFuncs.open_out(hi_fn, meta, out_profile) as hi_out, RasterFuncs.open_out(wbgt_fn, meta, out_profile) as wbgt_out:
+                RasterFuncs.map_windows(partial(hi_window, tmax = tmax, rh = rh, hi_out = hi_out, 
+                    wbgt_out = wbgt_out, threshs = threshs, counts = counts, nan_mask = nan_mask), windows, n_threads)
+            print(hi_fn, 'done')
+            print(wbgt_fn, 'done')
+        else:
+            RasterFuncs.map_windows(partial(hi_window, tmax = tmax, rh = rh, hi_out = None, 
+                wbgt_out = None, threshs = threshs, counts = counts, nan_mask = nan_mask), windows, n_threads)
+    
+    # per-stage timings of the block
+    TraceFuncs.flush()
+    
+    if counts is None:
+        return None
+    
+    # packed counts back on the grid, ocean and the nan of the last day masked
+    if land_only:
+        np.equal(wbgt_v, -9999, out = nan_mask)
+        nan_mask |= ~np.isfinite(wbgt_v)
+        counts = np.stack([RasterFuncs.unpack(c, land, fill = 0) for c in counts])
+        nan_mask = RasterFuncs.unpack(nan_mask, land, fill = True)
+    
+    return counts, nan_mask, meta, start + len(zipped_list)
             
+def write_counts(year, result):
+    """
+    Writes the fused-mode annual counts, one int16 raster per threshold in `count_thresh`, 
+    named like the 02_count_days.py outputs.
+
+    Args:
+        year (int): year of the counts.
+        result (tuple): (counts, nan_mask, meta, stop) from hi_days or hi_cube_loop, with the 
+            count arrays (one band per threshold), the ocean/nan locations of the last day 
+            and the meta data of the grid.
+    """
+    
+    counts, nan_mask, meta, _ = result
+    meta = dict(meta, dtype = 'int16', nodata = -9999)
+    
+    for fn_out, arr_out in zip(count_outputs(year), counts):
+        arr_out[nan_mask] = -9999 # mask ocean/nan with the last day, same as 02
+    
+        with TraceFuncs.stage('write', arr_out.nbytes), rasterio.open(fn_out, 'w', **meta) as out:
+            out.write_band(1, arr_out)
+        print(fn_out, 'done')
+
+def hi_cube_block(block, tmax_cube, rh_cube, hi_cube, wbgt_cube, threshs, counts, nan_mask):
+    """
+    Makes HImax and WBGTmax for all days of one cube chunk. Called by hi_cube_loop for each 
+    chunk, possibly from several threads at once, chunks don't overlap.
+
+    Args:
+        block (tuple): chunk from CubeFuncs.cube_blocks.
+        tmax_cube, rh_cube (np.memmap): Tmax and RHx cubes of the year.
+        hi_cube, wbgt_cube (np.memmap or None): himax and wbgtmax cubes to write, None to skip writing.
+        threshs (list): WBGTmax thresholds to count days above.
+        counts (np.ndarray or None): annual count arrays, one band per threshold, None to skip counting.
+        nan_mask (np.ndarray or None): ocean/nan locations of the last day.
+    """
+    
+    # all days of the chunk, one contiguous read each
+    with TraceFuncs.stage('read') as trace:
+        tmax = CubeFuncs.cube_read_block(tmax_cube, block)
+        rh = CubeFuncs.cube_read_block(rh_cube, block)
+        trace['bytes'] = tmax.nbytes + rh.nbytes
+    
+    # calculate heat index and wbgt reusing the thread's buffers
+    scratch, arr, wbgt_arr = RasterFuncs.thread_buffers(tmax.shape, 
+        lambda: (ClimFuncs.hi_scratch(tmax.shape), np.empty(tmax.shape, dtype = 'float32'), np.empty(tmax.shape, dtype = 'float32')))
+    arr, wbgt_arr = hi_wbgt(tmax, rh, scratch, arr, wbgt_arr)
+    
+    if hi_cube is not None:
+        with TraceFuncs.stage('write', arr.nbytes + wbgt_arr.nbytes):
+            CubeFuncs.cube_write_block(hi_cube, block, arr)
+            CubeFuncs.cube_write_block(wbgt_cube, block, wbgt_arr)
+    
+    # annual counts, same as 02_count_days.py
+    if counts is not None:
+        with TraceFuncs.stage('count'):
+            _, _, rows, cols = block
+            for j, t in enumerate(threshs):
+                counts[j, rows, cols] = (wbgt_arr > t).sum(axis = 0) # nan and -9999 are never above thresh
+            nan_mask[rows, cols] = (wbgt_arr[-1] == -9999) | ~np.isfinite(wbgt_arr[-1]) # ocean/nan locations
+
+def hi_cube_loop(year):
+    """
+    Same as hi_loop but reads the year's Tmax and RHx from the cubes made by 00_make_cube.py 
+    and writes himax and wbgtmax cubes (and/or the fused annual counts), chunk by chunk. 
+
+    Args:
+    year (int): The year to process.
+    Notes:
+    - Cubes are in `path` + `SSP_dataset` + '/cubes/', named Tmax.YEAR.npy, RHx.YEAR.npy, 
+      himax.YEAR.npy and wbgtmax.YEAR.npy.
+    - `write_daily` writes the himax and wbgtmax cubes, `count_thresh` the annual counts and 
+      the chunks are run on `n_threads` threads.
+    """
+    
+    print(multiprocessing.current_process(), year)
+    
+    # cubes
+    cube_path = os.path.join(path, SSP_dataset + '/cubes/')
+    tmax_cube, header = CubeFuncs.cube_open(os.path.join(cube_path, 'Tmax.' + str(year) + '.npy'))
+    rh_cube, _ = CubeFuncs.cube_open(os.path.join(cube_path, rh_handle + str(year) + '.npy'))
+    meta = CubeFuncs.cube_meta(header)
+    meta['nodata'] = -9999
+    
+    hi_cube, wbgt_cube = None, None
+    if write_daily:
+        hi_cube, _ = CubeFuncs.cube_create(os.path.join(cube_path, 'himax.' + str(year) + '.npy'), meta, header['dates'], header['chunk'])
+        wbgt_cube, _ = CubeFuncs.cube_create(os.path.join(cube_path, 'wbgtmax.' + str(year) + '.npy'), meta, header['dates'], header['chunk'])
+    
+    # count arrays
+    threshs = count_thresh if isinstance(count_thresh, (list, tuple)) else [count_thresh]
+    counts, nan_mask = None, None
+    if count_thresh is not None:
+        counts = np.zeros((len(threshs), header['height'], header['width']), dtype = 'int16')
+        nan_mask = np.zeros((header['height'], header['width']), dtype = bool)
+    
+    # run the chunks
+    TraceFuncs.set_tag(year = year, day = 'all')
+    RasterFuncs.map_windows(partial(hi_cube_block, tmax_cube = tmax_cube, rh_cube = rh_cube, hi_cube = hi_cube, 
+        wbgt_cube = wbgt_cube, threshs = threshs, counts = counts, nan_mask = nan_mask), CubeFuncs.cube_blocks(header), n_threads)
+    
+    if write_daily:
+        hi_cube.flush()
+        wbgt_cube.flush()
+        print(cube_path, 'himax and wbgtmax cubes done')
+    
+    if counts is not None:
+        write_counts(year, (counts, nan_mask, meta, len(header['dates'])))
+    
+    TraceFuncs.flush()
+
+def hi_xr_run(years, avg_years = None, ssp = ''):
+    """
+    Lazy version of the cube mode: one dask graph over the Tmax and RHx cubes of all years 
+    (CubeFuncs.cube_xr), with HImax and WBGTmax (ClimFuncs.hi_wbgt_xr), the annual counts 
+    above each `count_thresh` and, with avg_years, their average over those years fused in, 
+    computed in one go on the current dask scheduler, e.g. a dask.distributed LocalCluster 
+    of processes. Chunks are read, reduced and dropped, no daily data is written or read back.
+
+    Args:
+        years (list): years to run.
+        avg_years (tuple): (first, last) years to average the counts over like 03_ten_year_avg.py, 
+            None to skip.
+        ssp (str): scenario in the average file names, as 03 names them, '' for the observations.
+
+    Notes:
+    - Writes the count rasters like write_counts and the averages where 03 writes them, as 
+      refugees/ + ssp + '.wbgtmax' + thresh + '.avg_count_07-16.tif' (for 2007-2016) under path, 
+      int16 like 03 (truncated, the dtype of the counts).
+    - The results (one count per pixel, threshold and year) are held in memory until written.
+    """
+    
+    import dask
+    import xarray
+    
+    cube_path = os.path.join(path, SSP_dataset + '/cubes/')
+    threshs = count_thresh if isinstance(count_thresh, (list, tuple)) else [count_thresh]
+    
+    # the graph, nothing is read yet
+    counts = {}
+    for year in years:
+        tmax = CubeFuncs.cube_xr(os.path.join(cube_path, 'Tmax.' + str(year) + '.npy'))
+        rh = CubeFuncs.cube_xr(os.path.join(cube_path, rh_handle + str(year) + '.npy'))
+        hi, wbgt = ClimFuncs.hi_wbgt_xr(tmax, rh)
+        for t in threshs:
+            counts[(t, year)] = ClimFuncs.count_above_xr(wbgt, t)
+    avgs = {}
+    if avg_years is not None:
+        for t in threshs:
+            members = [counts[(t, year)] for year in years if avg_years[0] <= year <= avg_years[1]]
+            avgs[t] = xarray.concat(members, dim = 'year').mean('year') # NaN years skipped, same as 03
+    
+    # run it
+    print('computing', len(counts), 'annual counts and', len(avgs), 'averages')
+    counts, avgs = dask.compute(counts, avgs)
+    
+    # write them
+    with open(os.path.join(cube_path, 'Tmax.' + str(years[0]) + '.npy.json')) as f:
+        meta = CubeFuncs.cube_meta(json.load(f))
+    meta['nodata'] = -9999
+    for year in years:
+        arrs = [counts[(t, year)].values for t in threshs]
+        write_counts(year, (np.stack([np.nan_to_num(a).astype('int16') for a in arrs]), np.isnan(arrs[0]), meta, None))
+    for t, avg in avgs.items():
+        name = str(avg_years[0])[2:] + '-' + str(avg_years[1])[2:]
+        fn_out = os.path.join(path, 'refugees/' + ssp + '.wbgtmax' + str(t) + '.avg_count_' + name + '.tif')
+        os.makedirs(os.path.dirname(fn_out), exist_ok = True)
+        with rasterio.open(fn_out, 'w', **dict(meta, dtype = 'int16')) as out:
+            out.write_band(1, np.nan_to_num(avg.values, nan = -9999).astype('int16'))
+        print(fn_out, 'done')
+
 def parallel_loop(function, start_list, cpu_num):
     """
     Executes a given function in parallel using multiple CPU cores.
@@ -196,7 +677,59 @@ if __name__ == "__main__":
     #year_list = year_list[:3]# test
     print(year_list)
     
+    # Fused mode: count days above thresh as the rasters are made, optionally skip the daily tifs
+    # write_daily = False
+    # count_thresh = [28, 30, 32]
+    
+    # Compressed daily tifs, e.g. zstd with a float predictor or int16 at 0.01 °C, 02 and 03 read them as is
+    # out_profile = 'zstd'
+    
+    # Windowed mode: threads per year and memory budget per year (MB)
+    # n_threads = 8
+    # mem_mb = 2000
+    # prefetch = 0 # full days aren't read ahead, only the windows are held
+    
+    # Land only: skip the ocean, the land pixels are kept in PATH/SSP_dataset/land.<grid>.npz
+    # land_only = True
+    
+    # Per-stage timings (read, hi, wbgt, write, count) per worker and day, None to skip
+    # TraceFuncs.trace_dir = os.path.join(path, SSP_dataset + '/trace/')
+    
+    # Cube mode: read Tmax and RHx from the 00_make_cube.py cubes instead of the daily tifs
+    use_cube = False
+    
+    # Lazy cube mode: counts (count_thresh) and their average over avg_years in one dask graph, e.g. on a
+    # local cluster of processes, see hi_xr_run
+    use_xr = False
+    avg_years = (2007, 2016)
+    ssp = '' # as 03 names the averages, e.g. '2050_SSP245', '' for the observations
+    # from dask.distributed import Client, LocalCluster
+    # client = Client(LocalCluster(n_workers = os.cpu_count(), threads_per_worker = 1))
+    
+    # Workers and days per task, blocks of days are handed to workers as they free up
+    cpu_num = os.cpu_count() # set to available CPUs for speed
+    day_block = 30
+    
     #Run it
-    parallel_loop(function = hi_loop, start_list = year_list, cpu_num = 7) # set to available CPUs for speed
+    if use_xr:
+        hi_xr_run(year_list, avg_years, ssp)
+    elif use_cube:
+        parallel_loop(function = hi_cube_loop, start_list = year_list, cpu_num = cpu_num)
+    else:
+        # only the days not done yet going by the manifest, a crashed or extended run picks up where it left off
+        manifest_fn = os.path.join(path, SSP_dataset + '/manifest.hi.json')
+        manifest = RunFuncs.manifest_load(manifest_fn)
+        tasks = RunFuncs.day_tasks({year : hi_todo(year, manifest) for year in year_list}, day_block)
+        print(len(tasks), 'tasks to run')
+        if land_only: # one index for every task
+            land = RasterFuncs.land_index(land_ref(year_list), cache_dir = os.path.join(path, SSP_dataset))
+        RunFuncs.schedule(partial(RunFuncs.spill, hi_days, os.path.join(path, SSP_dataset + '/partial/')), tasks, cpu_num, 
+            combine = RunFuncs.add_partials, 
+            finish = partial(hi_finish, manifest = manifest, manifest_fn = manifest_fn) if count_thresh is not None else None, 
+            on_task = partial(hi_record, manifest = manifest, manifest_fn = manifest_fn), settings = {'land' : land})
+    
+    if TraceFuncs.trace_dir is not None:
+        TraceFuncs.flush() # the count writes in main
+        TraceFuncs.summary()
     
     print('done')
\ No newline at end of file
@@ -11,22 +11,116 @@
 #       for 2016 and a wbgtmax threshold of 30°C, then count values for a given
 #       grid-cell could be 16, meaning 16 days in thaat cell exceeded 30°C.
 #
-#       Update args for each run (e.g. wbgt 28, 30, and 32) in main.
+#       Update args for each run in main. thresh can be a list (e.g. wbgt 28, 30, 
+#       and 32) to make the count rasters for every threshold in one read of the 
+#       daily rasters.
+#
+#       With heat_events the same pass also makes the longest run of days above 
+#       each threshold, the number of spells of spell_days or more days and the 
+#       degree-days above it (see EventFuncs), written next to the counts.
+#
+#       With sketch the same pass also keeps a per-pixel histogram of the days
+#       (see SketchFuncs), saved per year, so percentile thresholds (e.g. each 
+#       pixel's 1983-2012 90th percentile) and the days above them come from 
+#       the sketches without reading the daily rasters again. Sketches are
+#       big, see the memory note at sketch in main.
 #
 #################################################################################
 
 # Dependencies 
 import numpy as np
-import xarray 
 import os
 import glob
 import rasterio
 import time
 import multiprocessing as mp 
 from multiprocessing import Pool
+from functools import partial
+import RasterFuncs
+import CubeFuncs
+import RunFuncs
+import TraceFuncs
+import EventFuncs
+import SketchFuncs
 
 # Functions
 
+def count_window(window, fn, threshs, arr_final, nan_mask, events = None, hist = None):
+    
+    """
+    Thresholds one row window of one daily raster and adds it to the annual counts. Called by 
+    annual_count_array for each window, possibly from several threads at once, so it only 
+    reads its own window and updates its own slice of the count arrays.
+
+    Args:
+        window (rasterio.windows.Window): the row window to process.
+        fn (str or np.ndarray): daily raster, or the day already read (see `prefetch`).
+        threshs (list): thresholds to count days above.
+        arr_final (np.ndarray): annual count arrays, one band per threshold.
+        nan_mask (np.ndarray): ocean/nan locations of the day.
+        events (dict): EventFuncs.event_state of the block, None to skip the heat events.
+        hist (np.ndarray): SketchFuncs sketch of the block, None to skip it.
+    """
+    
+    rows, cols = window.toslices()
+    if isinstance(fn, str):
+        with TraceFuncs.stage('read') as trace:
+            arr = RasterFuncs.read_window(fn, window) # read window to array
+            trace['bytes'] = arr.nbytes
+    else:
+        arr = fn[rows, cols] # window of the prefetched day
+    
+    with TraceFuncs.stage('count'):
+        arr = np.nan_to_num(arr, copy=False, nan=-9999.0, posinf=-9999.0, neginf=-9999.0) # revalue nan if inf to -9999
+    
+        mask = RasterFuncs.thread_buffers(('count',) + arr.shape, lambda: np.empty(arr.shape, dtype = bool))
+        for j, t in enumerate(threshs):
+            np.greater(arr, t, out = mask)
+            arr_final[j, rows, cols] += mask # add the binary arrays together
+        np.equal(arr, -9999.0, out = nan_mask[rows, cols]) # track ocean/nan locations
+    
+    if events is not None:
+        with TraceFuncs.stage('events'):
+            scratch = RasterFuncs.thread_buffers(('events',) + arr.shape, lambda: EventFuncs.event_scratch(arr.shape))
+            EventFuncs.event_update(events, arr, threshs, (rows, cols), scratch)
+    
+    if hist is not None: # full-width windows are a run of flat pixels
+        with TraceFuncs.stage('sketch'):
+            width = arr_final.shape[2]
+            SketchFuncs.sketch_update(hist, arr, np.arange(rows.start * width, rows.stop * width), sketch)
+
+def count_land(sl, vec, threshs, arr_final, events = None, hist = None):
+    
+    """
+    Thresholds one slice of the packed land pixels of a day and adds it to the packed annual 
+    counts, the `land_only` version of count_window. 
+
+    Args:
+        sl (slice): the slice of the packed vectors to process.
+        vec (np.ndarray): packed land pixels of the day.
+        threshs (list): thresholds to count days above.
+        arr_final (np.ndarray): packed annual count arrays, one row per threshold.
+        events (dict): packed EventFuncs.event_state of the block, None to skip the heat events.
+        hist (np.ndarray): packed SketchFuncs sketch of the block, None to skip it.
+    """
+    
+    with TraceFuncs.stage('count'):
+        arr = np.nan_to_num(vec[sl], copy=False, nan=-9999.0, posinf=-9999.0, neginf=-9999.0) # revalue nan if inf to -9999
+    
+        mask = RasterFuncs.thread_buffers(('count',) + arr.shape, lambda: np.empty(arr.shape, dtype = bool))
+        for j, t in enumerate(threshs):
+            np.greater(arr, t, out = mask)
+            arr_final[j, sl] += mask # add the binary arrays together
+    
+    if events is not None:
+        with TraceFuncs.stage('events'):
+            scratch = RasterFuncs.thread_buffers(('events',) + arr.shape, lambda: EventFuncs.event_scratch(arr.shape))
+            EventFuncs.event_update(events, arr, threshs, (sl,), scratch)
+    
+    if hist is not None:
+        with TraceFuncs.stage('sketch'):
+            SketchFuncs.sketch_update(hist, arr, np.arange(sl.start, sl.stop), sketch)
+
 def annual_count_array(year):
     
     """
@@ -38,15 +132,25 @@ def annual_count_array(year):
     The output is a count array where each pixel value represents the number of days exceeding 
     the threshold during that year. The result is saved to a GeoTIFF file.
 
+    If `thresh` is a list of thresholds, every daily raster is still read only once and 
+    compared against each threshold in turn, and one count raster is written per threshold.
+
+    Each day is read in row windows (see `count_window`) on `n_threads` threads, so one year 
+    can use several cores while the working set stays under `mem_mb`. The work is done by 
+    `count_days`, main can instead schedule blocks of days of every year over the workers 
+    with RunFuncs.schedule. With `land_only` only the land pixels of each day are counted 
+    (see `count_land`) and the ocean mask is made once, not every day.
+
     Args:
         year (int): The year for which to process raster files and compute the count array.
 
 
     Output:
-        - A GeoTIFF file with the annual count array saved in the output directory.
+        - A GeoTIFF file with the annual count array saved in the output directory, one per 
+          threshold.
     
-        - Ensure that the `path_in`, `path_out`, `data_in`, and `thresh` variables are 
-          defined and accessible in the global scope.
+        - Ensure that the `path_in`, `path_out`, `data_in`, `thresh`, `n_threads`, `mem_mb`, `prefetch`, `land_only`, `heat_events`, `spell_days` and `sketch` 
+          variables are defined and accessible in the global scope.
         - Input rasters should have the same spatial dimensions and CRS.
 
     """
@@ -54,6 +158,20 @@ def annual_count_array(year):
     # print process
     print(mp.current_process(), year)
     
+    # count all the days and write them
+    write_year_counts(year, count_days((year, 0, None)))
+    TraceFuncs.flush()
+
+def year_files(year):
+    """
+    Lists the daily rasters of a year.
+
+    Args:
+        year (int): year to list.
+
+    Returns sorted list of file names
+    """
+    
     # Get the rasters and check them
     fn_list = sorted(glob.glob(path_in+str(year)+'/*.tif'))
     #print(fn_list[0])
@@ -61,41 +179,357 @@ def annual_count_array(year):
     # Test
     # fn_list = fn_list[180:185]
     
-    # out path and fn out
-    fn_out = os.path.join(path_out, data_in+str(thresh) + '/'+ data_in+str(thresh)+'.count.'+str(year)+'.tif')
-    print(fn_out)
-    print(thresh)
+    return fn_list
+
+def land_ref(years):
+    
+    """
+    Daily rasters to make the land index from, the first day of each year, so a land pixel 
+    is only left out if it is nodata on all of them.
+    """
+    
+    return [year_files(year)[0] for year in years if year_files(year)]
+
+def count_outputs(year):
+    
+    """
+    File names of the annual count rasters of a year, one per threshold in `thresh`.
+    """
+    
+    # one or many thresholds
+    threshs = thresh if isinstance(thresh, (list, tuple)) else [thresh]
+    
+    return [os.path.join(path_out, data_in+str(t) + '/'+ data_in+str(t)+'.count.'+str(year)+'.tif') for t in threshs]
+
+def event_outputs(year):
+    
+    """
+    File names of the heat-event rasters of a year, one dict of metric: file name per threshold 
+    in `thresh`, in a data_in + thresh + '_events' folder next to the counts so globs of the 
+    count folders don't pick them up. Empty dicts unless `heat_events` is set.
+    """
+    
+    threshs = thresh if isinstance(thresh, (list, tuple)) else [thresh]
+    if not heat_events:
+        return [{} for t in threshs]
+    
+    names = {'longest_run' : 'longest_run', 'spells' : 'spells' + str(spell_days), 'degree_days' : 'degree_days'}
+    
+    return [{k : os.path.join(path_out, data_in+str(t) + '_events/' + data_in+str(t) + '.' + name + '.' + str(year) + '.tif') 
+             for k, name in names.items()} for t in threshs]
+
+def sketch_output(year):
+    
+    """File name of the histogram sketch of a year, in a data_in + '_sketch' folder next to the counts."""
+    
+    return os.path.join(path_out, data_in + '_sketch/' + data_in + '.sketch.' + str(year) + '.npz')
+
+def count_params(t):
+    
+    """Run parameters the count rasters of threshold t depend on, for the run manifest."""
+    
+    params = {'data_in' : data_in, 'thresh' : t}
+    if heat_events:
+        params['spell_days'] = spell_days
+    if sketch is not None:
+        params['sketch'] = list(sketch)
+        params['sketch_version'] = SketchFuncs.__version__
+    
+    return params
+
+def year_outputs(year):
+    
+    """Every output of a year with the threshold its manifest key is made with, counts, heat 
+    events and the sketch (keyed with the first threshold)."""
+    
+    threshs = thresh if isinstance(thresh, (list, tuple)) else [thresh]
+    outputs = [(t, fn) for t, fn, fns_ev in zip(threshs, count_outputs(year), event_outputs(year)) 
+               for fn in [fn] + list(fns_ev.values())]
+    if sketch is not None:
+        outputs.append((threshs[0], sketch_output(year)))
+    
+    return outputs
+
+def count_done(year, manifest):
+    
+    """
+    True if every output of a year (year_outputs) is in the run manifest with the key of the 
+    year's current daily rasters and count_params, so the year can be skipped.
+
+    Args:
+        year (int): year to check.
+        manifest (dict): run manifest from RunFuncs.manifest_load.
+    """
+    
+    fn_list = year_files(year)
+    
+    return all(RunFuncs.manifest_done(manifest, fn, RunFuncs.run_key(fn_list, count_params(t))) 
+               for t, fn in year_outputs(year))
+
+def count_finish(year, result, manifest, manifest_fn):
+    
+    """
+    Writes the annual count rasters of a finished year, from the handles of its partial counts 
+    (RunFuncs.spill), and adds them to the run manifest.
+    """
+    
+    write_year_counts(year, RunFuncs.partial_merge(result))
+    
+    fn_list = year_files(year)
+    for t, fn in year_outputs(year):
+        RunFuncs.manifest_add(manifest, fn, RunFuncs.run_key(fn_list, count_params(t)))
+    RunFuncs.manifest_save(manifest, manifest_fn)
+
+def count_days(task):
+    
+    """
+    Counts the days above each threshold for a block of days of a year, the work of 
+    annual_count_array split so the days of a year can be spread over workers (see 
+    RunFuncs.schedule).
+
+    Args:
+        task (tuple): (year, start, stop), the days year_files(year)[start:stop].
+
+    Returns (arr_final, nan_mask, meta, stop, events, hist, idx) with the partial counts of the 
+    block, one band per threshold, the ocean/nan locations of its last day, with `heat_events` 
+    a list with the EventFuncs state of the block (else None), with `sketch` the block's uint8 
+    histogram sketch (else None) and with `land_only` the land idx the sketch is packed with 
+    (else None), for RunFuncs.add_counts and write_year_counts
+    """
+    
+    year, start, stop = task
+    fn_list = year_files(year)[start:stop]
+    
+    # one or many thresholds
+    threshs = thresh if isinstance(thresh, (list, tuple)) else [thresh]
     
-    # Open rasters, mask them to binary, and add the binary arrays
-    for i, fn in enumerate(fn_list):
+    # days read ahead into reused buffers, or just the file names for each window to read its own part
+    if prefetch > 0 or land_only:
+        days = RasterFuncs.prefetch([[fn] for fn in fn_list], prefetch)
+    else:
+        days = (([fn], [fn], None) for fn in fn_list)
+    
+    # Open rasters window by window, mask them to binary for each threshold, and add the binary arrays
+    for i, ((fn,), (day,), day_meta) in enumerate(days):
         
         print(fn)
 
-        if i == 0: # first year
-            meta = rasterio.open(fn).meta   # get meta data to write raster
-            arr = rasterio.open(fn).read(1) # read raster to array
-            arr = np.nan_to_num(arr, copy=False, nan=-9999.0, posinf=-9999.0, neginf=-9999.0) # revalue nan if inf to -9999
-            nan_mask = np.where(arr == -9999.0, -9999.0, 0) # make an nan mask to track ocean/nan locations
-            arr_final = np.where(arr > thresh, 1, 0) # set mask to one, else 0 
+        if i == 0: # first day
+            meta = day_meta if day_meta is not None else rasterio.open(fn).meta   # get meta data to write raster
+            if land_only: # packed land pixels in slices
+                assert land is not None, 'land_only needs the land index from main, see land_ref'
+                windows = RasterFuncs.vector_chunks(land['idx'].size, n_threads)
+                vec = np.empty(land['idx'].size, dtype = 'float32')
+                arr_final = np.zeros((len(threshs), land['idx'].size), dtype = 'int16') # one packed count row per threshold
+            else:
+                windows = RasterFuncs.row_windows(fn, px_bytes = 8, mem_mb = mem_mb, n_threads = n_threads)
+                arr_final = np.zeros((len(threshs), meta['height'], meta['width']), dtype = 'int16') # one count band per threshold
+                nan_mask = np.zeros((meta['height'], meta['width']), dtype = bool)
+            events = None
+            if heat_events: # runs, spells and degree-days, same pixels as the counts
+                events = EventFuncs.event_state(arr_final.shape[1:], len(threshs), spell_days, start, start + len(fn_list))
+            hist = None
+            if sketch is not None: # per-pixel histogram, packed like the counts, uint8 for the block's days
+                hist = SketchFuncs.sketch_new(int(np.prod(arr_final.shape[1:])), sketch, 'uint8' if len(fn_list) < 256 else 'uint16')
+        
+        TraceFuncs.set_tag(year = year, day = os.path.basename(fn))
+        if land_only:
+            with TraceFuncs.stage('pack'):
+                RasterFuncs.pack(day, land, out = vec)
+            RasterFuncs.map_windows(partial(count_land, vec = vec, threshs = threshs, arr_final = arr_final, 
+                events = events, hist = hist), windows, n_threads)
+        else:
+            RasterFuncs.map_windows(partial(count_window, fn = day, threshs = threshs, arr_final = arr_final, 
+                nan_mask = nan_mask, events = events, hist = hist), windows, n_threads)
+    
+    # per-stage timings of the block
+    TraceFuncs.flush()
+    
+    # packed counts back on the grid, the ocean and the nan of the last day masked
+    if land_only:
+        arr_final = np.stack([RasterFuncs.unpack(c, land, fill = 0) for c in arr_final])
+        nan_mask = RasterFuncs.unpack(vec == -9999.0, land, fill = True)
+        if events is not None:
+            for k in ['cur', 'head', 'longest', 'spells', 'full', 'dd']:
+                events[k] = np.stack([RasterFuncs.unpack(e, land, fill = 0) for e in events[k]])
+    
+    idx = land['idx'] if land_only and hist is not None else None
+    
+    return arr_final, nan_mask, meta, start + len(fn_list), None if events is None else [events], hist, idx
+
+def write_year_counts(year, result):
+    
+    """
+    Writes the annual count rasters of a year, one per threshold, and the heat-event rasters 
+    if the result has them.
 
-        if i > 0: # add additional years
-            arr = rasterio.open(fn).read(1) # read raster to array
-            arr = np.nan_to_num(arr, copy=False, nan=-9999.0, posinf=-9999.0, neginf=-9999.0) # revalue nan if inf to -9999
-            nan_mask = np.where(arr == -9999.0, -9999.0, 0) # make an nan mask to track ocean/nan locations
-            arr_thresh = np.where(arr > thresh, 1, 0) # set mask to one, else 0 
-            arr_final = arr_final + arr_thresh # add the binary arrays together
+    Args:
+        year (int): year of the counts.
+        result (tuple): (arr_final, nan_mask, meta, stop, events, hist, idx) from count_days or annual_count_cube.
+    """
     
-    # mask ocean
-    arr_out = arr_final + nan_mask # sets any zero values that were nan at the start to -9999
+    arr_final, nan_mask, meta, _, events, hist, idx = result
+    
+    # out path and fn out for each threshold
+    fns_out = count_outputs(year)
+    print(fns_out)
     
     # update data types
-    arr_out = arr_out.astype('int16') # set array int16 to keep it small type
-    meta['dtype'] = 'int16'
-    meta['nodata'] = -9999
+    meta = dict(meta, dtype = 'int16', nodata = -9999) # int16 to keep it small type
+    
+    # write them
+    for arr_out, fn_out in zip(arr_final, fns_out):
+        arr_out[nan_mask] = -9999 # sets any zero values that were nan on the last day to -9999
+        with TraceFuncs.stage('write', arr_out.nbytes), rasterio.open(fn_out, 'w', **meta) as out:
+            out.write_band(1, arr_out)
+    
+    # heat events, the year's blocks merged into one state
+    if events is not None:
+        assert len(events) == 1, 'heat events need every day of the year'
+        final = EventFuncs.event_final(events[0])
+        for j, fns_ev in enumerate(event_outputs(year)):
+            for k, fn_out in fns_ev.items():
+                arr_out = final[k][j]
+                arr_out[nan_mask] = -9999
+                os.makedirs(os.path.dirname(fn_out), exist_ok = True)
+                with TraceFuncs.stage('write', arr_out.nbytes), rasterio.open(fn_out, 'w', **dict(meta, dtype = arr_out.dtype.name)) as out:
+                    out.write_band(1, arr_out)
+            print(list(fns_ev.values()))
+    
+    # histogram sketch, with the land idx its blocks were packed with (land_only)
+    if hist is not None:
+        fn_out = sketch_output(year)
+        os.makedirs(os.path.dirname(fn_out), exist_ok = True)
+        hist = hist.astype('uint16', copy = False) # a year of one block is still uint8
+        with TraceFuncs.stage('write', hist.nbytes):
+            SketchFuncs.sketch_save(fn_out, hist, sketch, nan_mask.shape, idx)
+        print(fn_out)
+
+def percentile_threshold(years, q, fn_out):
+    
+    """
+    Writes each pixel's q percentile (0 to 1) of the days of years, e.g. 0.9 over 1983-2012, 
+    as a float32 raster with -9999 nodata, from the years' sketches (see SketchFuncs.sketch_quantile 
+    for the error). Run with `sketch` set first.
+
+    Args:
+        years (list): years of the climatology.
+        q (float): quantile, 0 to 1.
+        fn_out (str): raster to write.
+    """
+    
+    hist, bins, shape, idx = SketchFuncs.sketch_load([sketch_output(year) for year in years])
+    arr = SketchFuncs.sketch_quantile(hist, bins, q)
+    arr = arr.reshape(shape) if idx is None else RasterFuncs.unpack(arr, {'idx' : idx, 'shape' : shape})
+    
+    meta = dict(rasterio.open(year_files(years[0])[0]).meta, dtype = 'float32', nodata = -9999)
+    with rasterio.open(fn_out, 'w', **meta) as out:
+        out.write_band(1, arr)
+    print(fn_out, 'done')
+
+def percentile_counts(year, fn_thresh, fn_out):
+    
+    """
+    Writes the days of a year above a per-pixel threshold raster (e.g. from percentile_threshold) 
+    as an int16 count raster, from the year's sketch, no daily rasters read (see 
+    SketchFuncs.sketch_exceed for the error).
+
+    Args:
+        year (int): year to count.
+        fn_thresh (str): threshold raster on the grid of the sketches, -9999 nodata.
+        fn_out (str): count raster to write.
+    """
+    
+    hist, bins, shape, idx = SketchFuncs.sketch_load(sketch_output(year))
+    with rasterio.open(fn_thresh) as src:
+        meta = dict(src.meta, dtype = 'int16', nodata = -9999)
+        thresh_arr = src.read(1).reshape(-1)
+    
+    land = None if idx is None else {'idx' : idx, 'shape' : shape}
+    days = SketchFuncs.sketch_exceed(hist, bins, thresh_arr if land is None else RasterFuncs.pack(thresh_arr, land))
+    days = days.reshape(shape) if land is None else RasterFuncs.unpack(days, land)
     
-    # write it
     with rasterio.open(fn_out, 'w', **meta) as out:
-        out.write_band(1, arr_out)
+        out.write_band(1, days)
+    print(fn_out, 'done')
+
+def count_block(block, cube, threshs, arr_final, nan_mask, events = None, hist = None):
+    
+    """
+    Counts the days above each threshold for one cube chunk, all days at once. Called by 
+    annual_count_cube for each chunk, possibly from several threads at once.
+
+    Args:
+        block (tuple): chunk from CubeFuncs.cube_blocks.
+        cube (np.memmap): daily cube of the year.
+        threshs (list): thresholds to count days above.
+        arr_final (np.ndarray): annual count arrays, one band per threshold.
+        nan_mask (np.ndarray): ocean/nan locations of the last day.
+        events (dict): EventFuncs.event_state of the year, None to skip the heat events.
+        hist (np.ndarray): SketchFuncs sketch of the year, None to skip it.
+    """
+    
+    with TraceFuncs.stage('read') as trace:
+        arr = CubeFuncs.cube_read_block(cube, block) # (time, rows, cols), one contiguous read
+        trace['bytes'] = arr.nbytes
+    
+    with TraceFuncs.stage('count'):
+        arr = np.nan_to_num(arr, nan=-9999.0, posinf=-9999.0, neginf=-9999.0) # revalue nan if inf to -9999
+    
+        _, _, rows, cols = block
+        for j, t in enumerate(threshs):
+            arr_final[j, rows, cols] = (arr > t).sum(axis = 0)
+        nan_mask[rows, cols] = arr[-1] == -9999.0 # track ocean/nan locations with the last day
+    
+    # heat events, the chunk's days in order
+    if events is not None:
+        with TraceFuncs.stage('events'):
+            scratch = EventFuncs.event_scratch(arr.shape[1:])
+            for day in arr:
+                EventFuncs.event_update(events, day, threshs, (rows, cols), scratch)
+    
+    # sketch, the chunk's pixels on the full grid
+    if hist is not None:
+        with TraceFuncs.stage('sketch'):
+            pix = (np.arange(rows.start, rows.stop)[:, None] * arr_final.shape[2] + np.arange(cols.start, cols.stop)).reshape(-1)
+            for day in arr:
+                SketchFuncs.sketch_update(hist, day, pix, sketch)
+
+def annual_count_cube(year):
+    
+    """
+    Same as annual_count_array but reads the year from its cube (see 00_make_cube.py), 
+    `cube_in` + `data_in` + '.' + year + '.npy', chunk by chunk on `n_threads` threads.
+
+    Args:
+        year (int): The year for which to compute the count arrays.
+    """
+    
+    # print process
+    print(mp.current_process(), year)
+    
+    # one or many thresholds
+    threshs = thresh if isinstance(thresh, (list, tuple)) else [thresh]
+    
+    # open the cube
+    cube, header = CubeFuncs.cube_open(os.path.join(cube_in, data_in + '.' + str(year) + '.npy'))
+    arr_final = np.zeros((len(threshs), header['height'], header['width']), dtype = 'int16') # one count band per threshold
+    nan_mask = np.zeros((header['height'], header['width']), dtype = bool)
+    events = None
+    if heat_events:
+        events = EventFuncs.event_state(nan_mask.shape, len(threshs), spell_days, 0, len(header['dates']))
+    hist = None
+    if sketch is not None:
+        hist = SketchFuncs.sketch_new(nan_mask.size, sketch)
+    
+    TraceFuncs.set_tag(year = year, day = 'all')
+    RasterFuncs.map_windows(partial(count_block, cube = cube, threshs = threshs, arr_final = arr_final, 
+        nan_mask = nan_mask, events = events, hist = hist), CubeFuncs.cube_blocks(header), n_threads)
+    
+    # write them
+    write_year_counts(year, (arr_final, nan_mask, CubeFuncs.cube_meta(header), len(header['dates']), 
+        None if events is None else [events], hist, None))
+    TraceFuncs.flush()
 
 def parallel_loop(function, start_list, cpu_num):
     """
@@ -132,7 +566,22 @@ if __name__ == "__main__":
     path_in = os.path.join('') # path to himax or wbgtmax files 
     path_out = os.path.join('') # path to annualcounts
     data_in = 'wbgtmax'
-    thresh = 30
+    thresh = 30 # or a list, e.g. [28, 30, 32]
+    n_threads = 1 # threads per year, each reads its own row window of the rasters
+    mem_mb = None # memory budget per year in MB for the row windows, None to split rows evenly across threads
+    prefetch = 1 # days read ahead in a background thread (full days, 4 bytes per pixel each), 0 to read each window in its thread within mem_mb
+    land_only = False # count the land pixels only, RasterFuncs.land_index of land_ref kept in path_out
+    land = None # the land index, made below before the pool
+    heat_events = False # also the longest run, spells and degree-days above each thresh, see EventFuncs
+    spell_days = 3 # days in a row above thresh that make a spell
+    # (lo, hi, step) °C bins of a per-pixel histogram of the days, e.g. (10, 40, 0.25), see SketchFuncs, None to skip.
+    # Memory: a day-block task holds a uint8 sketch, (n_bins + 3) bytes per pixel, 123 for (10, 40, 0.25), so
+    # 2.3 GB on the 7200 x 2600 grid, about 0.8 GB with land_only (a third land), times cpu_num workers. Main holds
+    # the year's uint16 sketch and a block's for the merge, 3 x that. Lower cpu_num or set land_only to fit.
+    # use_cube keeps one full-grid uint16 sketch per year.
+    sketch = None
+    cube_in = os.path.join('') # path to the 00_make_cube.py cubes, used with use_cube
+    use_cube = False # read each year from its cube instead of the daily tifs
     
     # set year list to feed annual_count_array 
     year_list = list(range(1983,2016+1))
@@ -140,7 +589,37 @@ if __name__ == "__main__":
     # test
     # year_list = year_list[:3]
     
+    # workers and days per task, blocks of days are handed to workers as they free up
+    cpu_num = os.cpu_count() # number of CPUS available 
+    day_block = 30
+    
+    # per-stage timings (read, count, write) per worker and day, None to skip
+    # TraceFuncs.trace_dir = os.path.join(path_out, 'trace/')
+    
     # run it
-    parallel_loop(function = annual_count_array, start_list = year_list, cpu_num = 24) # number of CPUS available 
+    if use_cube:
+        parallel_loop(function = annual_count_cube, start_list = year_list, cpu_num = cpu_num)
+    else:
+        # skip the years already done going by the manifest, a crashed or extended run picks up where it left off
+        manifest_fn = os.path.join(path_out, 'manifest.' + data_in + '.json')
+        manifest = RunFuncs.manifest_load(manifest_fn)
+        todo = [year for year in year_list if not count_done(year, manifest)]
+        print(len(todo), 'years to run')
+        tasks = RunFuncs.day_tasks({year : len(year_files(year)) for year in todo}, day_block)
+        if land_only: # one index for every task
+            land = RasterFuncs.land_index(land_ref(year_list), cache_dir = path_out)
+        RunFuncs.schedule(partial(RunFuncs.spill, count_days, os.path.join(path_out, 'partial/')), tasks, cpu_num, 
+            combine = RunFuncs.add_partials, 
+            finish = partial(count_finish, manifest = manifest, manifest_fn = manifest_fn), settings = {'land' : land})
+    
+    if TraceFuncs.trace_dir is not None:
+        TraceFuncs.flush() # the count writes in main
+        TraceFuncs.summary()
+    
+    # percentile thresholds and the days above them from the sketches, no daily rasters read
+    # fn_p90 = os.path.join(path_out, data_in + '_sketch/' + data_in + '.p90.83-12.tif')
+    # percentile_threshold(list(range(1983, 2012+1)), 0.9, fn_p90)
+    # for year in year_list:
+    #     percentile_counts(year, fn_p90, os.path.join(path_out, data_in + 'p90/' + data_in + 'p90.count.' + str(year) + '.tif'))
     
     print('done!')
\ No newline at end of file
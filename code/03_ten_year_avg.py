@@ -16,21 +16,10 @@
 
 # Dependencies 
 import numpy as np
-import xarray 
 import os
 import glob
 import rasterio
-import time
-import multiprocessing as mp 
-from multiprocessing import Pool
-import sys
-import matplotlib.pyplot as plt
-import rasterstats
-import geopandas as gpd
-import xarray as xr
-from rasterstats import zonal_stats
-import matplotlib
-import pandas as pd
+import RasterFuncs
 
 def raster_avg(fns, fn_out):
     
@@ -48,25 +37,82 @@ def raster_avg(fns, fn_out):
     Note:
         - The output file inherits metadata from the first raster in the input list.
         - Ensure all input rasters have the same dimensions and coordinate reference system (CRS).
+        - Streams the rasters one at a time, see raster_avgs.
     """
-     
-    # Open the files into an Xarray Data Array
-    ds = xr.concat([xr.open_dataset(f) for f in fns], dim='band')
     
-    # Get the ten year average as an array
-    avg = ds.band_data.mean(dim = 'band').data
+    raster_avgs(fns, {fn_out : fns})
+
+def raster_avgs(fns, windows, land = None):
     
-    # write it to disk
-    avg = np.nan_to_num(avg, nan = -9999) # fill nan
-    meta = rasterio.open(fns[0]).meta # meta data
+    """ Averages any number of windows of raster files (e.g. 2007-2016, rolling decades, 
+    30-year normals) in a single pass over the files.
+
+    Each file is read once, in the order of fns. A window's running sum and count of valid 
+    (not nodata, not NaN) values are made when its first file is read and the average is 
+    written, and the window dropped, after its last file, so memory holds two bands per 
+    window open at the same time, not one band per year. Pixels with no valid year are 
+    -9999, and the average is written with the meta data of the window's first raster, same 
+    as the old xr.concat version.
 
-    with rasterio.open(fn_out, 'w', **meta) as out:
-        out.write_band(1, avg)
+    With a land index the sums are kept for the land pixels only and scattered back into the 
+    grid on write, the ocean is -9999 like any pixel with no valid year.
+
+    Args:
+        fns (list of str): all the raster files, in time order.
+        windows (dict): fn_out: list of the files in fns to average into fn_out.
+        land (dict): RasterFuncs.land_index of the grid, None to average every pixel.
+    """
+    
+    first = {fn_out : min(members, key = fns.index) for fn_out, members in windows.items()}
+    last = {fn_out : max(members, key = fns.index) for fn_out, members in windows.items()}
+    sums, valids, metas = {}, {}, {}
+    
+    for fn in fns:
         
-    # clear memory
-    del(ds)
-    del(avg)
-    print('done')
+        # skip files no window needs
+        if not any(fn in members for members in windows.values()):
+            continue
+        
+        with rasterio.open(fn) as src:
+            meta = src.meta
+            arr = RasterFuncs.decode(src.read(1), src)
+            arr = (arr if land is None else RasterFuncs.pack(arr, land)).astype('float64')
+            if src.scales[0] != 1 or src.offsets[0] != 0: # decoded to float32, -9999 nodata
+                meta.update(dtype = 'float32', nodata = -9999)
+        valid = np.isfinite(arr)
+        if meta['nodata'] is not None:
+            valid &= arr != meta['nodata']
+        arr[~valid] = 0
+        
+        for fn_out, members in windows.items():
+            if fn not in members:
+                continue
+            
+            # open the window 
+            if fn == first[fn_out]:
+                sums[fn_out] = np.zeros(arr.shape, dtype = 'float64')
+                valids[fn_out] = np.zeros(arr.shape, dtype = 'int16')
+                metas[fn_out] = meta
+            
+            sums[fn_out] += arr
+            valids[fn_out] += valid
+            
+            # close it
+            if fn == last[fn_out]:
+                n = valids.pop(fn_out)
+                avg = np.full(n.shape, -9999, dtype = 'float64') # fill nan
+                np.divide(sums.pop(fn_out), n, out = avg, where = n > 0)
+                if land is not None:
+                    avg = RasterFuncs.unpack(avg, land)
+                
+                with rasterio.open(fn_out, 'w', **metas.pop(fn_out)) as out:
+                    out.write_band(1, avg)
+                print(fn_out, 'done')
+
+def count_year(fn):
+    """Year of an annual count raster, e.g. 2016 from wbgtmax30.count.2016.tif."""
+    
+    return int(os.path.basename(fn).split('.')[-2])
 
 # Run it 
 if __name__ == "__main__":
@@ -86,12 +132,23 @@ if __name__ == "__main__":
     print(len(fns), fns[0])
 
     # Get 2007- 2016
-    fns = fns[24:]
-    print(len(fns), fns[0])
+    fns_avg = [fn for fn in fns if 2007 <= count_year(fn) <= 2016]
+    print(len(fns_avg), fns_avg[0])
     
     # fn out
     fn_out = os.path.join(path + 'refugees/' + ssp + '.' +data + thresh + '.avg_count_07-16.tif')
     print(fn_out)
+    windows = {fn_out : fns_avg}
+    
+    # more windows can be made in the same pass, e.g. rolling decades and the 1983-2012 normal
+    # for start in range(1983, 2007+1):
+    #     fn_win = os.path.join(path + 'refugees/' + ssp + '.' + data + thresh + '.avg_count_' + str(start) + '-' + str(start+9) + '.tif')
+    #     windows[fn_win] = [fn for fn in fns if start <= count_year(fn) <= start+9]
+    # windows[os.path.join(path + 'refugees/' + ssp + '.' + data + thresh + '.avg_count_83-12.tif')] = [fn for fn in fns if 1983 <= count_year(fn) <= 2012]
+
+    # land pixels only, made from the first count raster and kept next to the averages
+    land = None
+    # land = RasterFuncs.land_index(fns[0], cache_dir = os.path.join(path + 'refugees/'))
 
     # run it
-    raster_avg(fns, fn_out)
\ No newline at end of file
+    raster_avgs(fns, windows, land)
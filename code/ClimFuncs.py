@@ -13,8 +13,9 @@
 
 #### Dependencies
 import numpy as np
-import xarray
-import pandas as pd
+
+# bump when the math changes, run manifests use it to know outputs are out of date
+__version__ = '1.1.0'
 
 #### Functions
 def C_to_F(Tmax_C):
@@ -70,7 +71,7 @@ def heatindex(Tmax, RH, unit_in, unit_out):
     ADJ1_Tmax = USE_ADJ1 * Tmax # .astype(int)
     ADJ1_Tmax = ADJ1_Tmax.where(ADJ1_Tmax != 0) #ADJ1_Tmax[ADJ1_Tmax == 0] = np.nan
     ADJ1 = ((13-ADJ1_RH)/4)*np.sqrt((17-abs(ADJ1_Tmax-95.))/17)
-    ADJ1 = np.nan_to_num(ADJ1, 0)
+    ADJ1 = ADJ1.fillna(0) # np.nan_to_num would compute a dask-backed array
     
     ADJ1_ROTH = ROTH * USE_ADJ1
     ADJ1_ROTH = ADJ1_ROTH - ADJ1
@@ -82,7 +83,7 @@ def heatindex(Tmax, RH, unit_in, unit_out):
     ADJ2_Tmax = USE_ADJ2.astype(int) * Tmax
     ADJ2_Tmax = ADJ2_Tmax.where(ADJ2_Tmax != 0) #ADJ2_Tmax[ADJ2_Tmax == 0] = np.nan
     ADJ2 = ((ADJ2_RH-85)/10) * ((87-ADJ2_Tmax)/5)
-    ADJ2 = np.nan_to_num(ADJ2, 0)
+    ADJ2 = ADJ2.fillna(0)
     
     ADJ2_ROTH = ROTH * USE_ADJ2
     ADJ2_ROTH = ADJ2_ROTH + ADJ2
@@ -102,6 +103,131 @@ def heatindex(Tmax, RH, unit_in, unit_out):
     
     return HI
 
+def hi_scratch(shape):
+    """Make the scratch buffers used by heatindex_np so they can be reused day to day.
+    
+    Args:
+        shape = shape of the Tmax and RH arrays
+        
+    Returns three float32 and two bool arrays of that shape
+    """
+    
+    return (np.empty(shape, dtype = 'float32'), np.empty(shape, dtype = 'float32'), 
+            np.empty(shape, dtype = 'float32'), np.empty(shape, dtype = bool), np.empty(shape, dtype = bool))
+
+def heatindex_np(Tmax, RH, unit_in, unit_out, out = None, scratch = None):
+    
+    """Same NOAA heat index as heatindex, but for plain numpy arrays. Everything stays float32, 
+    the work is done in out and the scratch buffers, so no full-size temporaries are made, and the 
+    adjustments 1 and 2 are only computed for the pixels their masks apply to. 
+    Agrees with heatindex to float32 rounding, including NaN in -> NaN out and HI = 0 where 
+    (Steadman + Tmax) / 2 is exactly 80.
+    
+    Args:
+        Tmax = array of tempatures
+        RH = array of realtive humitity
+        unit_in = F or C, will convert C to F to apply heat index
+        unit_out = If C is desired, will convert data to C
+        out = optional C-contiguous float32 array to write HI into
+        scratch = optional buffers from hi_scratch, pass them in to reuse them across days
+        
+    Returns HI
+    """
+    
+    Tmax = np.asarray(Tmax, dtype = 'float32')
+    RH = np.asarray(RH, dtype = 'float32')
+    if out is None:
+        out = np.empty(Tmax.shape, dtype = 'float32')
+    if scratch is None:
+        scratch = hi_scratch(Tmax.shape)
+    T, a, b, use1, use2 = scratch
+    
+    # 1 convert C to F if needed
+    if unit_in == 'C':
+        np.multiply(Tmax, 9/5, out = T)
+        T += 32
+    else:
+        np.copyto(T, Tmax)
+    
+    # 2 Steadman's into out, (Steadman + Tmax) / 2 into a
+    np.add(T, 61.0, out = out)
+    np.subtract(T, 68.0, out = a)
+    a *= 1.2
+    out += a
+    np.multiply(RH, 0.094, out = a)
+    out += a
+    out *= 0.5
+    np.add(out, T, out = a)
+    a /= 2
+    np.less(a, 80, out = use1)
+    np.greater(a, 80, out = use2)
+    out *= use1 # keeps NaN where Tmax or RH are NaN
+    
+    # 3 Rothfusz where (Steadman + Tmax) / 2 > 80, terms added in the same order as heatindex. 
+    # Done in place over the full buffers (vectorizes far better than masked ufuncs), only 
+    # the final add is masked
+    np.multiply(T, 2.04901523, out = a)
+    a -= 42.379
+    np.multiply(RH, 10.14333127, out = b)
+    a += b
+    np.multiply(T, .22475541, out = b)
+    b *= RH
+    a -= b
+    np.multiply(T, .00683783, out = b)
+    b *= T
+    a -= b
+    np.multiply(RH, .05481717, out = b)
+    b *= RH
+    a -= b
+    np.multiply(T, .00122874, out = b)
+    b *= T
+    b *= RH
+    a += b
+    np.multiply(T, .00085282, out = b)
+    b *= RH
+    b *= RH
+    a += b
+    np.multiply(T, .00000199, out = b)
+    b *= T
+    b *= RH
+    b *= RH
+    a -= b
+    np.add(out, a, out = out, where = use2)
+    
+    # 4 Adjust 1, only on the (few) pixels it applies to. RH == 0 is treated as no 
+    # adjustment like heatindex does
+    np.less(RH, 13, out = use1)
+    np.greater(T, 80, out = use2)
+    use1 &= use2
+    np.less(T, 112, out = use2)
+    use1 &= use2
+    np.not_equal(RH, 0, out = use2)
+    use1 &= use2
+    idx = np.flatnonzero(use1)
+    if idx.size > 0:
+        t = T.ravel()[idx]
+        rh = RH.ravel()[idx]
+        out.ravel()[idx] -= ((13-rh)/4)*np.sqrt((17-abs(t-95.))/17)
+    
+    # 5 Adjust 2, only on the pixels it applies to
+    np.greater(RH, 85, out = use1)
+    np.greater(T, 80, out = use2)
+    use1 &= use2
+    np.less(T, 87, out = use2)
+    use1 &= use2
+    idx = np.flatnonzero(use1)
+    if idx.size > 0:
+        t = T.ravel()[idx]
+        rh = RH.ravel()[idx]
+        out.ravel()[idx] += ((rh-85)/10) * ((87-t)/5)
+    
+    # Convert HI to C if desired
+    if unit_out == 'C':
+        out -= 32
+        out *= 5/9
+    
+    return out
+
 def make_rh(tmax, vpdmax):
     """ Equation from Spangler et al 2018 to caluclate relative min humidity from Tmax and vpdmax 
     with the assumption that RHmin happens at Tmax during a diurnal period.
@@ -126,4 +252,67 @@ def hi_to_wbgt(HI):
     
     WBGT = -0.0034*HI**2 + 0.96*HI - 34
     
-    return WBGT
\ No newline at end of file
+    return WBGT
+#### Lazy xarray path, chunk by chunk with dask
+def _hi_wbgt_block(Tmax, RH, nodata = -9999):
+    """HImax and WBGTmax in °C of one block of Tmax (°C) and RH, the float32 math of 
+    heatindex_np + C_to_F + hi_to_wbgt, with nodata or NaN in -> NaN out."""
+    
+    Tmax = np.asarray(Tmax, dtype = 'float32')
+    RH = np.asarray(RH, dtype = 'float32')
+    bad = (Tmax == nodata) | (RH == nodata)
+    
+    hi = heatindex_np(Tmax, RH, unit_in = 'C', unit_out = 'C')
+    hi_f = hi * np.float32(9/5) + np.float32(32)
+    wbgt = (np.float32(-0.0034) * hi_f**2 + np.float32(0.96) * hi_f - np.float32(34)).astype('float32')
+    hi[bad] = np.nan
+    wbgt[bad] = np.nan
+    
+    return hi, wbgt
+
+def _heatindex_block(Tmax, RH, unit_in, unit_out):
+    """heatindex_np of one block, new output array."""
+    
+    return heatindex_np(np.asarray(Tmax, dtype = 'float32'), np.asarray(RH, dtype = 'float32'), unit_in, unit_out)
+
+def heatindex_xr(Tmax, RH, unit_in = 'C', unit_out = 'C'):
+    """Same as heatindex, lazily chunk by chunk: for dask-backed DataArrays (e.g. CubeFuncs.cube_xr)
+    nothing is computed until asked for, each chunk runs heatindex_np. NaN in -> NaN out.
+    
+    Returns float32 DataArray like Tmax
+    """
+    
+    import xarray
+    
+    return xarray.apply_ufunc(_heatindex_block, Tmax, RH, kwargs = {'unit_in' : unit_in, 'unit_out' : unit_out}, 
+                              dask = 'parallelized', output_dtypes = ['float32'])
+
+def hi_wbgt_xr(Tmax, RH, nodata = -9999):
+    """
+    HImax and WBGTmax in °C from Tmax (°C) and RH DataArrays, lazily chunk by chunk, the same 
+    float32 math as the 01_Make-HI-WBGT.py daily loop. Nodata and NaN pixels are NaN, so xarray 
+    reductions (counts, means) skip them.
+    
+    Args:
+        Tmax, RH = DataArrays of the same shape, e.g. (time, y, x) from CubeFuncs.cube_xr
+        nodata = input nodata value
+    
+    Returns (HI, WBGT) float32 DataArrays
+    """
+    
+    import xarray
+    
+    return xarray.apply_ufunc(_hi_wbgt_block, Tmax, RH, kwargs = {'nodata' : nodata}, 
+                              output_core_dims = [[], []], dask = 'parallelized', output_dtypes = ['float32', 'float32'])
+
+def count_above_xr(da, thresh, dim = 'time'):
+    """
+    Days above thresh along dim, lazily, same as 02_count_days.py: NaN never counts and pixels 
+    that are NaN on the last day are NaN (ocean/nan mask).
+    
+    Returns float32 DataArray of day counts, NaN masked
+    """
+    
+    counts = (da > thresh).sum(dim, dtype = 'float32')
+    
+    return counts.where(da.isel({dim : -1}).notnull())
@@ -0,0 +1,188 @@
+##################################################################################
+#
+#    Cube Funcs
+#    By Cascade Tuholske
+#
+#    A chunked (time, y, x) store for a year of daily rasters, so a stage can
+#    read a year from one memory-mapped file instead of opening ~365 GeoTIFFs.
+#
+#    A cube is a .npy file (np.memmap) laid out as (y chunk, x chunk, time,
+#    chunk rows, chunk cols) plus a .json header with the raster meta data and
+#    the dates. Every chunk holds the full time series of a chunk x chunk patch
+#    of pixels back to back, so reading a chunk for all days is one contiguous
+#    read. Edge chunks are padded with nodata.
+#
+#    cube_xr opens a cube as a lazy (time, y, x) xarray DataArray with one dask
+#    chunk per cube chunk (needs dask), for ClimFuncs.hi_wbgt_xr and friends.
+#
+#################################################################################
+
+
+#### Dependencies
+import json
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from affine import Affine
+import RasterFuncs
+
+#### Functions
+def cube_create(fn, meta, dates, chunk = 128):
+    """Make an empty cube on disk for len(dates) days on the grid of meta.
+
+    Args:
+        fn = cube file, .npy, the header is written next to it as fn + '.json'
+        meta = rasterio meta data of the daily rasters
+        dates = list of date strings, one per day
+        chunk = chunk size in pixels (rows and cols)
+
+    Returns (cube, header) with the cube opened for writing
+    """
+
+    nby = -(-meta['height'] // chunk)
+    nbx = -(-meta['width'] // chunk)
+    nodata = -9999 if meta.get('nodata') is None else meta['nodata']
+
+    header = {'height' : meta['height'], 'width' : meta['width'], 'chunk' : chunk, 'nodata' : nodata,
+              'crs' : meta['crs'].to_wkt() if meta.get('crs') is not None else None,
+              'transform' : list(meta['transform'])[:6], 'dates' : list(dates)}
+    with open(fn + '.json', 'w') as f:
+        json.dump(header, f)
+
+    cube = np.lib.format.open_memmap(fn, mode = 'w+', dtype = 'float32', shape = (nby, nbx, len(dates), chunk, chunk))
+
+    # pad only the part of the edge chunks past the grid, the rest is written day by day
+    pad_h, pad_w = meta['height'] % chunk, meta['width'] % chunk
+    if pad_h:
+        cube[-1, :, :, pad_h:, :] = nodata
+    if pad_w:
+        cube[:, -1, :, :, pad_w:] = nodata
+
+    return cube, header
+
+def cube_open(fn, mode = 'r'):
+    """Open a cube memory-mapped, mode 'r' to read or 'r+' to write. Returns (cube, header)."""
+
+    with open(fn + '.json') as f:
+        header = json.load(f)
+
+    return np.load(fn, mmap_mode = mode), header
+
+def cube_meta(header, dtype = 'float32'):
+    """rasterio meta data to write a GeoTIFF on the grid of a cube."""
+
+    return {'driver' : 'GTiff', 'dtype' : dtype, 'nodata' : header['nodata'], 'count' : 1,
+            'width' : header['width'], 'height' : header['height'],
+            'crs' : CRS.from_wkt(header['crs']) if header['crs'] else None,
+            'transform' : Affine(*header['transform'])}
+
+def cube_blocks(header):
+    """List the chunks of a cube as (bi, bj, rows, cols), with the row and col slices of
+    the chunk on the full grid."""
+
+    chunk = header['chunk']
+    blocks = []
+    for bi in range(-(-header['height'] // chunk)):
+        for bj in range(-(-header['width'] // chunk)):
+            rows = slice(bi * chunk, min((bi + 1) * chunk, header['height']))
+            cols = slice(bj * chunk, min((bj + 1) * chunk, header['width']))
+            blocks.append((bi, bj, rows, cols))
+
+    return blocks
+
+def cube_read_block(cube, block):
+    """Read all days of one chunk as a (time, rows, cols) array, padding dropped."""
+
+    bi, bj, rows, cols = block
+
+    return np.asarray(cube[bi, bj, :, :rows.stop - rows.start, :cols.stop - cols.start])
+
+def cube_write_block(cube, block, arr):
+    """Write a (time, rows, cols) array into one chunk."""
+
+    bi, bj, rows, cols = block
+    cube[bi, bj, :, :rows.stop - rows.start, :cols.stop - cols.start] = arr
+
+def cube_read_day(cube, header, i):
+    """Read day i of a cube as a full (height, width) array."""
+
+    nby, nbx, _, chunk, _ = cube.shape
+    arr = np.asarray(cube[:, :, i]).transpose(0, 2, 1, 3).reshape(nby * chunk, nbx * chunk)
+
+    return arr[:header['height'], :header['width']]
+
+def cube_write_day(cube, header, i, arr):
+    """Write a full (height, width) array as day i of a cube."""
+
+    for block in cube_blocks(header):
+        bi, bj, rows, cols = block
+        cube[bi, bj, i, :rows.stop - rows.start, :cols.stop - cols.start] = arr[rows, cols]
+
+def _cube_chunk(fn, bi, bj, rows, cols):
+    """All days of one chunk read from the cube file, padding dropped. Opens the file itself so
+    dask tasks can run in other processes."""
+
+    cube, _ = cube_open(fn)
+
+    return np.array(cube[bi, bj, :, :rows, :cols])
+
+def cube_xr(fn):
+    """
+    Open a cube as a lazy (time, y, x) float32 DataArray, one dask chunk per cube chunk with
+    all its days, so time reductions stay within a chunk. Nodata is NaN, time holds the cube
+    dates and y, x the pixel centres. Nothing is read until computed.
+
+    Args:
+        fn = cube file, .npy
+
+    Returns xarray.DataArray
+    """
+
+    import dask
+    import dask.array as da
+    import xarray
+
+    with open(fn + '.json') as f:
+        header = json.load(f)
+    chunk, n_days = header['chunk'], len(header['dates'])
+
+    # chunk grid of delayed reads
+    rows_of = {}
+    for bi, bj, rows, cols in cube_blocks(header):
+        shape = (n_days, rows.stop - rows.start, cols.stop - cols.start)
+        block = da.from_delayed(dask.delayed(_cube_chunk)(fn, bi, bj, shape[1], shape[2]), shape, dtype = 'float32')
+        rows_of.setdefault(bi, []).append(block)
+    arr = da.block([[row for row in rows_of[bi]] for bi in sorted(rows_of)])
+
+    a, b, c, d, e, f = header['transform']
+    x = c + a * (np.arange(header['width']) + 0.5)
+    y = f + e * (np.arange(header['height']) + 0.5)
+    out = xarray.DataArray(arr, dims = ('time', 'y', 'x'), coords = {'time' : header['dates'], 'y' : y, 'x' : x},
+                           attrs = {'nodata' : header['nodata'], 'crs' : header['crs']})
+
+    return out.where(out != header['nodata'])
+
+def ingest(fns, dates, fn, chunk = 128):
+    """Load a year of daily GeoTIFFs into a new cube. Values are stored as they are, NaN
+    included, so the stages downstream see exactly what the GeoTIFFs hold. Scaled int16
+    rasters (RasterFuncs.out_profiles) are decoded to float32 with -9999 nodata.
+
+    Args:
+        fns = daily rasters in time order
+        dates = date string of each raster
+        fn = cube file to make
+        chunk = chunk size in pixels
+    """
+
+    with rasterio.open(fns[0]) as src:
+        meta = src.meta
+        if src.scales[0] != 1 or src.offsets[0] != 0:
+            meta['nodata'] = -9999
+    cube, header = cube_create(fn, meta, dates, chunk)
+
+    for i, fn_day in enumerate(fns):
+        arr = RasterFuncs.read_window(fn_day, None)
+        cube_write_day(cube, header, i, arr)
+
+    cube.flush()
+    print(fn, 'done')
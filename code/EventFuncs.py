@@ -0,0 +1,126 @@
+##################################################################################
+#
+#    Event Funcs
+#    By Cascade Tuholske
+#
+#    Heat-event metrics per pixel, kept as state updated one day at a time in
+#    the count pass so the daily stack is never reloaded: the longest run of
+#    consecutive days above a threshold, the number of spells of at least
+#    spell_days days and the degree-days above the threshold.
+#
+#    A state covers a block of days. Besides the running totals it keeps the
+#    run at the start of the block (head), the run at the end (cur) and
+#    whether every day was above (full), so the states of consecutive blocks
+#    of a year (see RunFuncs.schedule) merge into the state of the whole year.
+#
+#################################################################################
+
+
+#### Dependencies
+import numpy as np
+
+#### Functions
+def event_state(shape, n_thresh, spell_days, start, stop):
+    """Empty state for the days start to stop of a year, one band per threshold.
+
+    Args:
+        shape = pixel shape, (height, width) or (n,) for packed land pixels
+        n_thresh = number of thresholds
+        spell_days = days in a row that make a spell
+        start, stop = day indices of the block
+
+    Returns dict of the state arrays, (n_thresh,) + shape each
+    """
+
+    shape = (n_thresh,) + tuple(shape)
+
+    return {'start' : start, 'stop' : stop, 'spell_days' : spell_days,
+            'cur' : np.zeros(shape, dtype = 'int16'), # run ending on the last day
+            'head' : np.zeros(shape, dtype = 'int16'), # run starting on the first day
+            'longest' : np.zeros(shape, dtype = 'int16'),
+            'spells' : np.zeros(shape, dtype = 'int16'), # spells that start and end inside the block
+            'full' : np.ones(shape, dtype = bool), # every day so far above
+            'dd' : np.zeros(shape, dtype = 'float32')}
+
+def event_scratch(shape):
+    """Scratch buffers for event_update of a window of shape, reused day to day."""
+
+    return (np.empty(shape, dtype = bool), np.empty(shape, dtype = bool), np.empty(shape, dtype = bool),
+            np.empty(shape, dtype = 'float32'))
+
+def event_update(state, arr, threshs, where, scratch):
+    """Add one day to the state. Windows of a day don't overlap, so threads can update
+    their own windows at the same time.
+
+    Args:
+        state = from event_state
+        arr = window of the day, float32 with -9999 nodata and no NaN
+        threshs = thresholds, same order as the state bands
+        where = tuple of slices of the window in the pixel shape, e.g. (rows, cols)
+        scratch = event_scratch of the window shape
+    """
+
+    above, end, either, diff = scratch
+    for j, t in enumerate(threshs):
+        idx = (j,) + tuple(where)
+        cur, head, full = state['cur'][idx], state['head'][idx], state['full'][idx]
+
+        np.greater(arr, t, out = above)
+
+        # a run that didn't start on the first day ends today, a spell if long enough
+        np.greater_equal(cur, state['spell_days'], out = end)
+        np.logical_or(above, full, out = either)
+        np.greater(end, either, out = end)
+        state['spells'][idx] += end
+
+        # runs
+        cur += 1
+        cur *= above
+        np.maximum(state['longest'][idx], cur, out = state['longest'][idx])
+        full &= above
+        np.copyto(head, cur, where = full)
+
+        # degree-days, nodata is far below any threshold
+        np.subtract(arr, t, out = diff)
+        np.maximum(diff, 0, out = diff)
+        state['dd'][idx] += diff
+
+def event_merge(a, b):
+    """State of two consecutive blocks, a right before b."""
+
+    joined = a['cur'] + b['head'] # the run across the boundary
+    inside = ~a['full'] & ~b['full'] # it starts and ends inside the merged block
+
+    return {'start' : a['start'], 'stop' : b['stop'], 'spell_days' : a['spell_days'],
+            'cur' : np.where(b['full'], a['cur'] + b['cur'], b['cur']),
+            'head' : np.where(a['full'], a['head'] + b['head'], a['head']),
+            'longest' : np.maximum(np.maximum(a['longest'], b['longest']), joined),
+            'spells' : a['spells'] + b['spells'] + (inside & (joined >= a['spell_days'])),
+            'full' : a['full'] & b['full'],
+            'dd' : a['dd'] + b['dd']}
+
+def event_combine(a, b):
+    """Combine two lists of block states of a year, as they come back from the workers in any
+    order, merging the blocks that follow each other. None is an empty list."""
+
+    parts = sorted((a or []) + (b or []), key = lambda s: s['start'])
+    out = []
+    for part in parts:
+        if out and out[-1]['stop'] == part['start']:
+            out[-1] = event_merge(out[-1], part)
+        else:
+            out.append(part)
+
+    return out
+
+def event_final(state):
+    """Metrics of a finished year from its state, counting the runs at the start and end of the year.
+
+    Returns dict of longest_run, spells and degree_days arrays, one band per threshold
+    """
+
+    n = state['spell_days']
+    spells = state['spells'] + np.where(state['full'], state['cur'] >= n,
+                                        (state['head'] >= n).astype('int16') + (state['cur'] >= n))
+
+    return {'longest_run' : state['longest'], 'spells' : spells.astype('int16'), 'degree_days' : state['dd']}
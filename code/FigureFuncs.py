@@ -0,0 +1,256 @@
+##################################################################################
+#
+#    Figure Funcs
+#    By Cascade Tuholske
+#
+#    Functions for refugee_figure.py, the scripted version of the maps in
+#    refugee_figure.ipynb. The countries shapefile is read once per zoom level
+#    (world, West Africa, East Africa, ...), clipped to the zoom's bounds,
+#    simplified to what shows at that scale, projected if asked, and cached as
+#    one compound path, so later figures never open the shapefile and draw the
+#    countries of a panel as a single patch. Settlements are drawn with one
+#    scatter per panel, their values for every scenario and threshold taken in
+#    one go from the cached PointFuncs weight index.
+#
+#    Only a cache miss needs geopandas.
+#
+#################################################################################
+
+
+#### Dependencies
+import os
+import json
+import hashlib
+import numpy as np
+import matplotlib.colors as mcolors
+import matplotlib.patches as patches
+from matplotlib.path import Path
+from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+from rasterio.warp import transform
+import PointFuncs
+
+#### Basemaps
+def _cache_fn(cache_dir, name, fn_shp, parts, ext):
+    """Cache file for fn_shp, keyed by its size and mtime and parts."""
+
+    st = os.stat(fn_shp)
+    blob = json.dumps([fn_shp, st.st_size, st.st_mtime_ns] + list(parts), default = str)
+
+    return os.path.join(cache_dir, name + '.' + hashlib.sha1(blob.encode()).hexdigest()[:12] + ext)
+
+def _rings(geom):
+    """Rings of a (multi)polygon, exteriors counter-clockwise and holes clockwise so the
+    compound path fills with the holes left open."""
+
+    from shapely.geometry.polygon import orient
+
+    polys = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
+    for poly in polys:
+        if poly.is_empty or poly.geom_type != 'Polygon':
+            continue
+        poly = orient(poly, 1.0)
+        yield np.asarray(poly.exterior.coords)
+        for ring in poly.interiors:
+            yield np.asarray(ring.coords)
+
+def basemap(fn_shp, bounds = None, tol = 0, crs = None, drop = ('Antarctica',), cache_dir = None):
+    """Countries of a zoom level as one matplotlib Path, made once and cached.
+
+    Args:
+        fn_shp = countries shapefile, e.g. Natural Earth 1:10m admin 0
+        bounds = (xmin, ymin, xmax, ymax) to clip to, in crs, None for all of it
+        tol = simplify tolerance in crs units, about a pixel at the zoom's scale, 0 for none
+        crs = crs to project to, None to keep the shapefile's (lon/lat for Natural Earth)
+        drop = CONTINENT values to leave out
+        cache_dir = folder to cache the path in, None to not cache
+
+    Returns Path
+    """
+
+    fn_cache = None
+    if cache_dir is not None:
+        fn_cache = _cache_fn(cache_dir, 'basemap', fn_shp, [bounds, tol, crs, drop], '.npz')
+        if os.path.exists(fn_cache):
+            with np.load(fn_cache) as f:
+                return Path(f['xy'], f['codes'])
+
+    import geopandas as gpd # only needed to make the cache
+
+    countries = gpd.read_file(fn_shp)
+    countries = countries[~countries['CONTINENT'].isin(drop)]
+    if crs is not None:
+        countries = countries.to_crs(crs)
+    geoms = countries.geometry
+    if bounds is not None:
+        geoms = geoms.clip_by_rect(*bounds)
+    if tol > 0:
+        geoms = geoms.simplify(tol)
+
+    xy, codes = [], []
+    for geom in geoms:
+        if geom is None or geom.is_empty:
+            continue
+        parts = geom.geoms if geom.geom_type == 'GeometryCollection' else [geom]
+        for part in parts:
+            if part.geom_type not in ('Polygon', 'MultiPolygon'):
+                continue
+            for ring in _rings(part):
+                if len(ring) < 4:
+                    continue
+                c = np.full(len(ring), Path.LINETO, dtype = 'uint8')
+                c[0], c[-1] = Path.MOVETO, Path.CLOSEPOLY
+                xy.append(ring[:, :2])
+                codes.append(c)
+    xy = np.concatenate(xy) if xy else np.zeros((0, 2))
+    codes = np.concatenate(codes) if codes else np.zeros(0, dtype = 'uint8')
+
+    if fn_cache is not None:
+        np.savez(fn_cache, xy = xy, codes = codes)
+
+    return Path(xy, codes)
+
+def country_names(fn_shp, cache_dir = None):
+    """Country name by ISO3 code (ADM0_A3 to NAME) from the countries shapefile, cached as a json."""
+
+    fn_cache = None
+    if cache_dir is not None:
+        fn_cache = _cache_fn(cache_dir, 'names', fn_shp, [], '.json')
+        if os.path.exists(fn_cache):
+            with open(fn_cache) as f:
+                return json.load(f)
+
+    import geopandas as gpd
+
+    countries = gpd.read_file(fn_shp, ignore_geometry = True)
+    names = dict(zip(countries['ADM0_A3'], countries['NAME']))
+
+    if fn_cache is not None:
+        with open(fn_cache, 'w') as f:
+            json.dump(names, f)
+
+    return names
+
+#### Settlements
+def settlements(fn_pts, crs = None):
+    """Settlement points from the UNHCR geojson.
+
+    Args:
+        fn_pts = settlement geojson with pcode, gis_name and iso3 properties (lon/lat)
+        crs = crs to project the points to, same as the basemaps, None for lon/lat
+
+    Returns DataFrame with pcode, gis_name, iso3, x and y, in the order of the geojson
+    """
+
+    import pandas as pd
+
+    with open(fn_pts) as f:
+        feats = json.load(f)['features']
+
+    pts = pd.DataFrame({'pcode' : [feat['properties']['pcode'] for feat in feats],
+                        'gis_name' : [feat['properties'].get('gis_name') for feat in feats],
+                        'iso3' : [feat['properties'].get('iso3') for feat in feats],
+                        'x' : [feat['geometry']['coordinates'][0] for feat in feats],
+                        'y' : [feat['geometry']['coordinates'][1] for feat in feats]})
+    if crs is not None:
+        pts['x'], pts['y'] = transform('EPSG:4326', crs, pts['x'].tolist(), pts['y'].tolist())
+
+    return pts
+
+def settlement_values(fn_pts, fns, cache_dir = None):
+    """Value of each settlement's pixel in each raster (e.g. the avg counts of every
+    scenario and threshold), same as the notebook's zonal_stats on the points, read in
+    one go with the cached weight index. The rasters must share a grid.
+
+    Returns DataFrame (settlements, fns), NaN off the grid or on nodata
+    """
+
+    import pandas as pd
+
+    index = PointFuncs.weight_index(fn_pts, fns[0], mode = 'point', cache_dir = cache_dir)
+
+    return pd.DataFrame(PointFuncs.zonal_mean(index, fns), columns = fns)
+
+#### Drawing
+def hot_cmap():
+    """Light yellow to orange to red, the colormap of the refugee figures."""
+
+    colors = [(1, 1, 0.7), (1, 0.65, 0), (1, 0, 0)]
+
+    return mcolors.LinearSegmentedColormap.from_list('custom_hot', colors, N = 256)
+
+def draw_base(ax, base, facecolor = 'grey', edgecolor = 'black', linewidth = 0.07, zorder = 1):
+    """Draw a basemap Path as one patch."""
+
+    ax.add_patch(patches.PathPatch(base, facecolor = facecolor, edgecolor = edgecolor,
+                                   linewidth = linewidth, zorder = zorder))
+
+def draw_points(ax, x, y, vals, cmap, norm, s = 10, zorder = 2):
+    """Draw settlements with one scatter: white at zero days or less, colored by value
+    above, higher values on top. NaN settlements are left out, as in the notebook.
+
+    Args:
+        x, y, vals = arrays of the settlements
+        cmap, norm = colormap and its Normalize
+        s = marker size
+    """
+
+    x, y, vals = np.asarray(x), np.asarray(y), np.asarray(vals, dtype = 'float64')
+    keep = np.isfinite(vals)
+    order = np.argsort(vals[keep], kind = 'stable')
+    x, y, vals = x[keep][order], y[keep][order], vals[keep][order]
+
+    colors = cmap(norm(vals))
+    colors[vals <= 0] = (1, 1, 1, 1)
+
+    ax.scatter(x, y, c = colors, s = s, linewidths = 0, zorder = zorder)
+
+def _aspect(ylim, lonlat):
+    """Axes aspect, 1 / cos(mid latitude) for lon/lat like geopandas plots, else equal."""
+
+    return 1 / np.cos(np.radians(np.mean(ylim))) if lonlat else 'equal'
+
+def map_panel(ax, base, pts, vals, cmap, norm, s = 10, bounds = None, lonlat = True):
+    """A map of the settlements over a basemap, no ticks, bounds = (xmin, ymin, xmax, ymax)
+    or None for the basemap's extent, lonlat False for projected basemaps."""
+
+    draw_base(ax, base)
+    draw_points(ax, pts['x'], pts['y'], vals, cmap, norm, s = s)
+    if bounds is None:
+        ext = base.get_extents()
+        bounds = (ext.x0, ext.y0, ext.x1, ext.y1)
+    ax.set_xlim(bounds[0], bounds[2])
+    ax.set_ylim(bounds[1], bounds[3])
+    ax.set_aspect(_aspect(bounds[1::2], lonlat))
+    ax.set_facecolor('darkgrey')
+    ax.set_xticks([])
+    ax.set_yticks([])
+
+def inset_panel(ax, base, pts, vals, cmap, norm, inset, s = 15, edgecolor = 'cyan', lonlat = True):
+    """An inset map in ax with a box around its area on ax.
+
+    Args:
+        inset = dict with the inset's title, xlim, ylim, box (xmin, ymin, width, height)
+            on the main map, and width, height and bbox_to_anchor for inset_axes
+
+    Returns the inset's axes
+    """
+
+    ax_in = inset_axes(ax, width = inset['width'], height = inset['height'], loc = 'lower left',
+                       bbox_to_anchor = inset['bbox_to_anchor'], bbox_transform = ax.transAxes, borderpad = 2)
+    draw_base(ax_in, base)
+    draw_points(ax_in, pts['x'], pts['y'], vals, cmap, norm, s = s)
+    ax_in.set_xlim(*inset['xlim'])
+    ax_in.set_ylim(*inset['ylim'])
+    ax_in.set_aspect(_aspect(inset['ylim'], lonlat))
+    ax_in.set_xticks([])
+    ax_in.set_yticks([])
+    ax_in.set_title(inset['title'], fontsize = 10)
+    ax_in.patch.set_alpha(0)
+    for spine in ax_in.spines.values():
+        spine.set_edgecolor(edgecolor)
+        spine.set_linewidth(0.7)
+
+    x0, y0, w, h = inset['box']
+    ax.add_patch(patches.Rectangle((x0, y0), w, h, linewidth = 1, edgecolor = edgecolor, facecolor = 'none', zorder = 4))
+
+    return ax_in
@@ -0,0 +1,253 @@
+##################################################################################
+#
+#    Point Funcs
+#    By Cascade Tuholske
+#
+#    Functions to pull daily raster values at the UNHCR settlement points for
+#    settlement_points.py. Each settlement is mapped to the raster row/col it
+#    falls in once, and only the raster blocks that hold settlements are read.
+#
+#    Also a sparse settlement x pixel weight index (points, buffered catchments
+#    or area-weighted catchments) made once per grid and cached, to take the
+#    mean of a whole stack of rasters per settlement in one go instead of
+#    running zonal_stats raster by raster.
+#
+#################################################################################
+
+
+#### Dependencies
+import os
+import json
+import hashlib
+import numpy as np
+import rasterio
+from rasterio.transform import rowcol
+import RasterFuncs
+from rasterio.windows import Window
+
+#### Functions
+def settlement_pixels(fn_pts, fn_rst):
+    """Map each settlement point to the row and col of the raster pixel it falls in. For
+    points this is the same pixel zonal_stats uses. Assumes the points and raster share
+    a CRS (lon/lat), as the refugee notebook does.
+
+    Args:
+        fn_pts = settlement geojson with a pcode property
+        fn_rst = any raster on the grid to sample
+
+    Returns DataFrame with pcode, lon, lat, row, col and valid (point is on the grid)
+    """
+
+    import pandas as pd # only needed for the DataFrames
+
+    with open(fn_pts) as f:
+        feats = json.load(f)['features']
+
+    df = pd.DataFrame({'pcode' : [feat['properties']['pcode'] for feat in feats],
+                       'lon' : [feat['geometry']['coordinates'][0] for feat in feats],
+                       'lat' : [feat['geometry']['coordinates'][1] for feat in feats]})
+
+    with rasterio.open(fn_rst) as src:
+        rows, cols = rowcol(src.transform, df['lon'], df['lat'])
+        df['row'] = np.asarray(rows)
+        df['col'] = np.asarray(cols)
+        df['valid'] = (df['row'] >= 0) & (df['row'] < src.height) & (df['col'] >= 0) & (df['col'] < src.width)
+
+    return df
+
+def point_blocks(pts, fn_rst):
+    """Group the settlement pixels by the raster block they fall in, so a day is read
+    block by block and blocks without settlements are never read.
+
+    Args:
+        pts = DataFrame from settlement_pixels
+        fn_rst = any raster on the grid to sample, for its block shape
+
+    Returns list of (window, idx, rows, cols) with the block window, the positions of its
+    settlements in pts and their row/col inside the block
+    """
+
+    with rasterio.open(fn_rst) as src:
+        block_h, block_w = src.block_shapes[0]
+        height, width = src.height, src.width
+
+    valid = pts[pts['valid']].copy()
+    valid['idx'] = np.flatnonzero(pts['valid'])
+
+    blocks = []
+    for (bi, bj), sub in valid.groupby([valid['row'] // block_h, valid['col'] // block_w]):
+        row_off, col_off = int(bi) * block_h, int(bj) * block_w
+        window = Window(col_off, row_off, min(block_w, width - col_off), min(block_h, height - row_off))
+        blocks.append((window, sub['idx'].values, sub['row'].values - row_off, sub['col'].values - col_off))
+
+    return blocks
+
+def read_points(fn, blocks, n, band = 1):
+    """Read a raster's values at the settlement pixels, only reading the blocks that hold them.
+
+    Args:
+        fn = raster to read
+        blocks = from point_blocks
+        n = number of settlements, settlements off the grid are NaN
+        band = band to read
+
+    Returns float32 array of length n
+    """
+
+    out = np.full(n, np.nan, dtype = 'float32')
+    with rasterio.open(fn) as src:
+        for window, idx, rows, cols in blocks:
+            arr = RasterFuncs.decode(src.read(band, window = window), src, band)
+            out[idx] = arr[rows, cols]
+
+    return out
+
+#### Settlement x pixel weight index, for zonal means of any number of rasters
+def _disc_weights(lon, lat, radius_km, transform, height, width, supersample):
+    """Pixels within radius_km of a point and their weights. With supersample 1 a pixel is
+    in if its center is in the disc (like zonal_stats), weight 1. With supersample > 1
+    each pixel is split in supersample x supersample sub-pixels and weighted by its area
+    covered by the disc, so partly covered pixels count partly.
+
+    Returns (flat pixel index, weight)
+    """
+
+    res_x, res_y = transform.a, -transform.e
+    dlat = radius_km / 111.32
+    dlon = dlat / max(np.cos(np.radians(lat)), 1e-6)
+
+    # candidate pixels, one pixel of slack each side
+    row0, col0 = rowcol(transform, lon - dlon, lat + dlat)
+    row1, col1 = rowcol(transform, lon + dlon, lat - dlat)
+    rows = np.arange(max(row0 - 1, 0), min(row1 + 2, height))
+    cols = np.arange(max(col0 - 1, 0), min(col1 + 2, width))
+    if len(rows) == 0 or len(cols) == 0:
+        return np.array([], dtype = 'int64'), np.array([], dtype = 'float64')
+
+    # sub-pixel centers, offsets as a fraction of a pixel
+    sub = (np.arange(supersample) + 0.5) / supersample
+    ys = transform.f - (rows[:, None] + sub[None, :]) * res_y # (rows, sub)
+    xs = transform.c + (cols[:, None] + sub[None, :]) * res_x # (cols, sub)
+
+    # haversine distance of each sub-pixel center to the point
+    lat1, lat2 = np.radians(lat), np.radians(ys)[:, None, :, None]
+    dphi = lat2 - lat1
+    dlam = np.radians(xs - lon)[None, :, None, :]
+    h = np.sin(dphi / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlam / 2)**2
+    dist = 2 * 6371.0 * np.arcsin(np.sqrt(np.minimum(h, 1)))
+
+    # covered fraction of each pixel times its area (cos lat)
+    frac = (dist <= radius_km).mean(axis = (2, 3))
+    if supersample == 1:
+        weight = frac
+    else:
+        weight = frac * np.cos(np.radians(ys.mean(axis = 1)))[:, None]
+
+    r, c = np.nonzero(weight)
+
+    return rows[r] * width + cols[c], weight[r, c]
+
+def weight_index(fn_pts, fn_rst, mode = 'point', radius_km = None, supersample = 4, cache_dir = None):
+    """Sparse settlement x pixel weights on the grid of fn_rst, made once and cached, so any
+    number of rasters on that grid can be reduced per settlement with zonal_mean.
+
+    Args:
+        fn_pts = settlement geojson with a pcode property
+        fn_rst = any raster on the grid
+        mode = 'point' for the pixel each settlement falls in (zonal_stats on the points),
+            'buffer' for equal weights on the pixels whose centers are within radius_km
+            (zonal_stats on buffered points), 'area' for pixels weighted by their area
+            covered by the radius_km disc
+        radius_km = catchment radius for 'buffer' and 'area'
+        supersample = sub-pixels per side for 'area'
+        cache_dir = folder to cache the index in, None to not cache
+
+    Returns dict with pcode, indptr, pix and w in CSR order (settlement i has pixels
+    pix[indptr[i]:indptr[i+1]], weights summing to 1) and the grid shape. A buffer
+    with no pixel center inside falls back to the pixel the settlement is in, where
+    zonal_stats would give None. Settlements off the grid have no pixels.
+    """
+
+    with rasterio.open(fn_rst) as src:
+        transform, height, width = src.transform, src.height, src.width
+        crs = src.crs.to_wkt() if src.crs is not None else ''
+
+    # cached per grid, settlements and mode
+    fn_cache = None
+    if cache_dir is not None:
+        st = os.stat(fn_pts)
+        blob = json.dumps([list(transform)[:6], height, width, crs, fn_pts, st.st_size, st.st_mtime_ns,
+                           mode, radius_km, supersample if mode == 'area' else None])
+        fn_cache = os.path.join(cache_dir, 'weights.' + mode + '.' + hashlib.sha1(blob.encode()).hexdigest()[:12] + '.npz')
+        if os.path.exists(fn_cache):
+            with np.load(fn_cache, allow_pickle = False) as f:
+                return {key : f[key] for key in f.files}
+
+    pts = settlement_pixels(fn_pts, fn_rst)
+
+    pix_list, w_list, indptr = [], [], [0]
+    for lon, lat, row, col, valid in zip(pts['lon'], pts['lat'], pts['row'], pts['col'], pts['valid']):
+        pix, w = np.array([], dtype = 'int64'), np.array([], dtype = 'float64')
+        if valid and mode != 'point':
+            pix, w = _disc_weights(lon, lat, radius_km, transform, height, width, supersample if mode == 'area' else 1)
+        if valid and len(pix) == 0:
+            pix, w = np.array([row * width + col], dtype = 'int64'), np.ones(1)
+        pix_list.append(pix)
+        w_list.append(w / w.sum() if len(w) else w)
+        indptr.append(indptr[-1] + len(pix))
+
+    index = {'pcode' : np.array(pts['pcode'].tolist(), dtype = str), 'indptr' : np.array(indptr, dtype = 'int64'),
+             'pix' : np.concatenate(pix_list).astype('int64'), 'w' : np.concatenate(w_list),
+             'shape' : np.array([height, width])}
+
+    if fn_cache is not None:
+        np.savez(fn_cache, **index)
+
+    return index
+
+def zonal_mean(index, fns, band = 1):
+    """Weighted mean per settlement of a stack of rasters on the grid of a weight_index. Only
+    the raster blocks holding weighted pixels are read, and nodata/NaN pixels are dropped
+    from each settlement's weights per raster, as zonal_stats drops them.
+
+    Args:
+        index = from weight_index
+        fns = rasters to reduce (counts, averages, daily files, ...)
+        band = band to read
+
+    Returns float64 array (settlements, rasters), NaN where a settlement has no valid pixel
+    """
+
+    import pandas as pd
+
+    # unique pixels to read, and the blocks that hold them
+    upix, inv = np.unique(index['pix'], return_inverse = True)
+    width = int(index['shape'][1])
+    px = pd.DataFrame({'row' : upix // width, 'col' : upix % width, 'valid' : True})
+    blocks = point_blocks(px, fns[0])
+
+    # (unique pixels, rasters) of values and valid masks
+    vals = np.empty((len(upix), len(fns)), dtype = 'float64')
+    for j, fn in enumerate(fns):
+        with rasterio.open(fn) as src:
+            nodata = -9999 if src.scales[band - 1] != 1 or src.offsets[band - 1] != 0 else src.nodata # decoded
+        vals[:, j] = read_points(fn, blocks, len(upix), band)
+        if nodata is not None:
+            vals[vals[:, j] == nodata, j] = np.nan
+    valid = np.isfinite(vals)
+
+    # one vectorized weighted sum per settlement, over all rasters at once
+    w = index['w'][:, None]
+    num = w * np.where(valid, vals, 0)[inv]
+    den = w * valid[inv]
+
+    n = len(index['pcode'])
+    out = np.full((n, len(fns)), np.nan)
+    starts = index['indptr'][:-1]
+    has = np.diff(index['indptr']) > 0
+    if has.any():
+        num_s = np.add.reduceat(num, starts[has], axis = 0)
+        den_s = np.add.reduceat(den, starts[has], axis = 0)
+        out[has] = np.where(den_s > 0, num_s / np.where(den_s > 0, den_s, 1), np.nan)
+
+    return out
@@ -0,0 +1,301 @@
+##################################################################################
+#
+#    Raster Funcs
+#    By Cascade Tuholske
+#
+#    Raster I/O helpers for 01_Make-HI-WBGT.py and 02_count_days.py. Splits a
+#    raster into row windows that fit a memory budget and runs a function over
+#    the windows in a thread pool. GDAL reads/writes and numpy release the GIL,
+#    so one year can use all cores with a bounded working set.
+#
+#    Also the output profiles for the daily rasters (plain, compressed, COG or
+#    int16 at 0.01 °C) and reading/writing them so the scripts downstream see
+#    the same float32 values with -9999 nodata whatever profile was written.
+#
+#    prefetch reads the next days in a background thread into reused buffers
+#    while the current day is computed, so disk and CPU overlap.
+#
+#    land_index keeps the valid (land) pixels of a grid, made once in the main
+#    process and cached on disk, so a stage can pack each day into a 1-D vector of land pixels
+#    (pack), skip the ocean, and scatter back into the grid to write (unpack).
+#
+#################################################################################
+
+
+#### Dependencies
+import os
+import hashlib
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+import TraceFuncs
+
+#### Functions
+def row_windows(fn, px_bytes, mem_mb = None, n_threads = 1):
+    """Split a raster into full-width row windows so that n_threads windows in flight stay
+    under mem_mb. Window heights are rounded down to the file's block height so reads line
+    up with the GeoTIFF strips/tiles.
+
+    Args:
+        fn = raster to split, only its size and block shape are read
+        px_bytes = working bytes per pixel of the function run on each window
+        mem_mb = memory budget in MB for all threads, None to just split the rows evenly 
+            across the threads
+        n_threads = number of threads the windows will be run on
+
+    Returns list of rasterio Windows
+    """
+
+    with rasterio.open(fn) as src:
+        height, width = src.height, src.width
+        block_h = src.block_shapes[0][0]
+
+    if mem_mb is None:
+        rows = -(-height // n_threads) # ceil
+    else:
+        rows = int(mem_mb * 2**20 / (px_bytes * width * n_threads))
+    rows = max(block_h, rows - rows % block_h) # at least one block
+
+    return [Window(0, row, width, min(rows, height - row)) for row in range(0, height, rows)]
+
+def map_windows(function, windows, n_threads = 1):
+    """Run function(window) over the windows in a thread pool, returns the results in order.
+    Each window is independent, so function should read and write only its own window (its
+    own rasterio handles, its own slice of shared arrays). Runs inline with one thread."""
+
+    if n_threads == 1:
+        return [function(window) for window in windows]
+
+    with ThreadPoolExecutor(max_workers = n_threads) as pool:
+        return list(pool.map(function, windows))
+
+def read_window(fn, window, band = 1):
+    """Read one band of a window, opening the file in the calling thread since rasterio
+    datasets can't be shared across threads. Scaled rasters (the int16 profile) are decoded,
+    see decode. window None reads the whole band."""
+
+    with rasterio.open(fn) as src:
+        return decode(src.read(band, window = window), src, band)
+
+def read_into(fn, buf = None, band = 1):
+    """Read a whole band as float32 into buf (made if None) with one open of the file, 
+    decoding scaled rasters. Returns (buf, meta)."""
+
+    with rasterio.open(fn) as src:
+        meta = src.meta
+        if buf is None:
+            buf = np.empty((src.height, src.width), dtype = 'float32')
+        if src.dtypes[band - 1] == 'float32' and src.scales[band - 1] == 1 and src.offsets[band - 1] == 0:
+            src.read(band, out = buf)
+        else:
+            np.copyto(buf, decode(src.read(band), src, band), casting = 'unsafe')
+
+    return buf, meta
+
+def prefetch(groups, depth = 1):
+    """
+    Yields (fns, arrays, meta) for each group of files (e.g. the (rh_fn, tmax_fn) of a day), 
+    with the files read as float32 by a background thread up to depth groups ahead of the 
+    caller. The arrays are reused buffers, depth + 1 sets of them, so they are only valid 
+    until the next group is asked for. depth 0 reads each group when it is asked for, in 
+    the calling thread, into one reused set. meta is the meta data of the group's first file.
+    """
+
+    groups = list(groups)
+    free = queue.Queue()
+    for _ in range(depth + 1):
+        free.put(None) # buffer sets are made on the first read
+    ready = queue.Queue()
+
+    def read(fns):
+        bufs = free.get()
+        with TraceFuncs.stage('read') as trace:
+            out = [read_into(fn, None if bufs is None else bufs[i]) for i, fn in enumerate(fns)]
+            trace['bytes'] = sum(buf.nbytes for buf, _ in out)
+        return fns, [buf for buf, _ in out], out[0][1]
+
+    def produce():
+        try:
+            for fns in groups:
+                ready.put(read(fns))
+        except BaseException as e:
+            ready.put(e)
+
+    if depth > 0:
+        threading.Thread(target = produce, daemon = True).start()
+
+    prev = None
+    for fns in groups:
+        if prev is not None: # the caller is done with the last group
+            free.put(prev)
+        item = ready.get() if depth > 0 else read(fns)
+        if isinstance(item, BaseException):
+            raise item
+        prev = item[1]
+        yield item
+
+#### Per-thread buffers, so each thread reuses its own scratch memory day to day
+_local = threading.local()
+
+def thread_buffers(key, make):
+    """Get this thread's buffers for key, making them with make() the first time."""
+
+    if not hasattr(_local, 'buffers'):
+        _local.buffers = {}
+    if key not in _local.buffers:
+        _local.buffers[key] = make()
+
+    return _local.buffers[key]
+
+#### Writes to one open dataset from several threads need a lock
+write_lock = threading.Lock()
+
+def write_window(dst, arr, window, band = 1):
+    """Write arr into window of an open dataset, safe to call from map_windows threads.
+    Encoded for scaled rasters, see encode."""
+
+    arr = encode(arr, dst, band)
+    with write_lock:
+        dst.write_band(band, arr, window = window)
+
+#### Output profiles for the daily himax and wbgtmax rasters
+out_profiles = {
+    'gtiff' : {}, # as the input, uncompressed
+    'deflate' : {'tiled' : True, 'blockxsize' : 512, 'blockysize' : 512, 'compress' : 'deflate', 'predictor' : 3, 'zlevel' : 6},
+    'zstd' : {'tiled' : True, 'blockxsize' : 512, 'blockysize' : 512, 'compress' : 'zstd', 'predictor' : 3, 'zstd_level' : 9},
+    'cog' : {'driver' : 'COG', 'blocksize' : 512, 'compress' : 'deflate', 'predictor' : 3},
+    'int16' : {'tiled' : True, 'blockxsize' : 512, 'blockysize' : 512, 'compress' : 'zstd', 'predictor' : 2, 'zstd_level' : 9,
+               'dtype' : 'int16', 'nodata' : -32768, 'scale' : 0.01}, # 0.01 °C steps rounded up, ± 327 °C
+}
+
+def out_meta(meta, profile = 'gtiff'):
+    """Meta data to write a raster with one of out_profiles, made from the float32 meta of
+    the day. Returns (meta, scale), scale is None unless the profile stores scaled ints."""
+
+    opts = dict(out_profiles[profile])
+    scale = opts.pop('scale', None)
+    meta = dict(meta, **opts)
+    if meta['driver'] == 'COG': # COG tiles by blocksize
+        for key in ['tiled', 'blockxsize', 'blockysize']:
+            meta.pop(key, None)
+
+    return meta, scale
+
+def open_out(fn, meta, profile = 'gtiff'):
+    """Open fn to write with an output profile, setting the scale so readers decode it."""
+
+    meta, scale = out_meta(meta, profile)
+    dst = rasterio.open(fn, 'w', **meta)
+    if scale is not None:
+        dst.scales = (scale,) * dst.count
+        dst.offsets = (0,) * dst.count
+
+    return dst
+
+def encode(arr, dst, band = 1):
+    """float32 values with -9999 (or NaN) nodata to the dtype of dst. Scaled int rasters (scale
+    1/n) are rounded up to the next scale step, so value > thresh stays exact for any thresh
+    on the step grid (e.g. 30 °C at 0.01), -9999 and NaN go to the nodata of dst and values
+    past the int range (e.g. junk WBGT far below -300 at cold pixels) are clipped."""
+
+    scale = dst.scales[band - 1]
+    if scale == 1 and dst.offsets[band - 1] == 0:
+        return arr
+
+    info = np.iinfo(dst.dtypes[band - 1])
+    out = np.ceil((arr.astype('float64') - dst.offsets[band - 1]) * round(1 / scale))
+    np.clip(out, info.min + 1, info.max, out = out)
+    out[(arr == -9999) | ~np.isfinite(arr)] = dst.nodata
+
+    return out.astype(dst.dtypes[band - 1])
+
+def decode(arr, src, band = 1):
+    """Scaled int values back to float32 with -9999 nodata, other rasters as they are."""
+
+    scale = src.scales[band - 1]
+    if scale == 1 and src.offsets[band - 1] == 0:
+        return arr
+
+    out = arr.astype('float32') * np.float32(scale) + np.float32(src.offsets[band - 1])
+    out[arr == src.nodata] = -9999
+
+    return out
+
+#### Land-only pixels
+_lands = {}
+
+def land_index(fns, cache_dir = None):
+    """
+    Flat indices of the valid pixels of a grid, not NaN and not nodata (-9999) in any of 
+    fns, e.g. the ocean mask of CHC-CMIP6. Made once per grid, the grid's size, transform 
+    and CRS, and cached in cache_dir as land.<hash>.npz (and in memory), so every stage and 
+    year on the grid uses the same index. The ocean is taken to be the same every day, a 
+    pixel that is nodata in fns but valid on other days is left out, so make it from a day 
+    (or a few) with every land pixel valid. Make it in the main process before the pool and 
+    hand it to the workers, not from whatever day a task reads first.
+
+    Args:
+        fns = raster, or list of rasters on the same grid, to take the valid pixels from
+        cache_dir = folder to keep the index in, None to keep it in memory only
+
+    Returns dict with idx (int32 flat indices into the grid, sorted) and shape (height, width)
+    """
+
+    fns = [fns] if isinstance(fns, str) else list(fns)
+    with rasterio.open(fns[0]) as src:
+        grid = [src.height, src.width, list(src.transform)[:6], src.crs.to_wkt() if src.crs else None]
+    key = hashlib.sha1(repr(grid).encode()).hexdigest()[:12]
+    fn = os.path.join(cache_dir, 'land.' + key + '.npz') if cache_dir is not None else key
+
+    if fn in _lands:
+        return _lands[fn]
+    if cache_dir is not None and os.path.exists(fn):
+        with np.load(fn) as f:
+            _lands[fn] = {'idx' : f['idx'], 'shape' : tuple(f['shape'])}
+        return _lands[fn]
+
+    valid = np.zeros((grid[0], grid[1]), dtype = bool)
+    for fn_in in fns:
+        with rasterio.open(fn_in) as src:
+            arr = decode(src.read(1), src)
+            nodata = -9999 if src.scales[0] != 1 or src.offsets[0] != 0 else src.nodata
+        ok = np.isfinite(arr) & (arr != -9999)
+        if nodata is not None:
+            ok &= arr != nodata
+        valid |= ok
+
+    land = {'idx' : np.flatnonzero(valid).astype('int32'), 'shape' : valid.shape}
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok = True)
+        tmp = fn + '.' + str(os.getpid()) + '.tmp.npz' # workers on the same grid may make it at once
+        np.savez(tmp, idx = land['idx'], shape = np.array(land['shape']))
+        os.replace(tmp, fn)
+        print(fn, 'land pixels', land['idx'].size, 'of', valid.size)
+    _lands[fn] = land
+
+    return land
+
+def pack(arr, land, out = None):
+    """The land pixels of a (height, width) array as a 1-D vector, into out if given."""
+
+    return np.take(arr.reshape(-1), land['idx'], out = out)
+
+def unpack(vec, land, out = None, fill = -9999):
+    """Scatter a packed vector back into a (height, width) grid. out is filled with fill 
+    when made here, a reused out keeps what its ocean pixels already hold."""
+
+    if out is None:
+        out = np.full(land['shape'], fill, dtype = vec.dtype)
+    out.reshape(-1)[land['idx']] = vec
+
+    return out
+
+def vector_chunks(n, n_threads = 1):
+    """Split a packed vector of n pixels into n_threads contiguous slices, for map_windows."""
+
+    step = -(-n // n_threads) if n else 1
+
+    return [slice(i, min(i + step, n)) for i in range(0, n, step)]
@@ -0,0 +1,419 @@
+##################################################################################
+#
+#    Run Funcs
+#    By Cascade Tuholske
+#
+#    Work scheduling for the pipeline scripts. Instead of one Pool.map task per
+#    year, a year is split into blocks of days, the blocks are handed out to the
+#    workers as they free up (imap_unordered), and the partial results of each
+#    year are combined as they come back. Prints worker utilization at the end.
+#
+#    run_dag runs a graph of tasks (e.g. hi -> counts -> average per scenario
+#    and year) on one pool, starting each task as soon as the tasks it needs
+#    are done.
+#
+#    Pools can be started with forkserver instead of fork, so the workers come
+#    from a lean server process that only imported the modules the tasks need
+#    (make_pool), not from a main process holding manifests, graphs and its
+#    own imports.
+#
+#    Partial counts of a day block are full-grid arrays, so the workers write
+#    them to disk (spill) and send back only a handle, and the main process
+#    merges a year's files once its last block is in (partial_merge).
+#
+#    Also keeps a run manifest, a json of every output written with a key made
+#    from its inputs' size and mtime, the run parameters and the ClimFuncs
+#    version, so a rerun only redoes outputs that are missing or out of date.
+#
+#################################################################################
+
+
+#### Dependencies
+import os
+import sys
+import json
+import queue
+import hashlib
+import importlib.util
+import time
+import multiprocessing as mp
+from functools import partial
+import numpy as np
+import ClimFuncs
+import EventFuncs
+
+#### Functions
+def day_tasks(year_days, block):
+    """Split each year into (year, start, stop) tasks of at most block days.
+
+    Args:
+        year_days = dict of year: number of days (files) in the year, or a list of the day
+            indices to do, e.g. from a manifest, which are split into runs of consecutive days
+        block = days per task
+
+    Returns list of tasks
+    """
+
+    tasks = []
+    for year, days in year_days.items():
+        if isinstance(days, int):
+            days = range(days)
+        days = sorted(days)
+        start = None
+        for i, day in enumerate(days):
+            if start is None:
+                start = day
+            end_of_run = i == len(days) - 1 or days[i + 1] != day + 1
+            if end_of_run or day + 1 - start == block:
+                tasks.append((year, start, day + 1))
+                start = None
+
+    return tasks
+
+def timed(function, task):
+    """Run function(task) in a worker, returns (task, result, worker name, start, end)."""
+
+    start = time.time()
+    result = function(task)
+
+    return task, result, mp.current_process().name, start, time.time()
+
+def add_counts(a, b):
+    """Combine two partial count results of the same year, as returned by the day-block
+    functions: (counts, nan_mask, meta, stop) and optionally the heat-event states, the
+    histogram sketch of 02 and the land idx it is packed with (None for the full grid) as a 
+    fifth to seventh item. Counts and sketches are added (a year's sketch as uint16, blocks 
+    may be uint8), the nan mask and meta data of the later block are kept so the mask is the 
+    one of the last day, same as a full-year run, and the event states of blocks that follow 
+    each other are merged. Sketches packed with different land idx can't be added."""
+
+    if a is None:
+        return b
+    if b is None:
+        return a
+
+    counts = a[0] + b[0]
+    last = a if a[3] > b[3] else b
+    if len(a) > 4:
+        events = EventFuncs.event_combine(a[4], b[4]) if a[4] is not None else None
+        hist = None
+        if a[5] is not None:
+            assert (a[6] is None) == (b[6] is None) and (a[6] is None or np.array_equal(a[6], b[6])), \
+                'sketches of a year packed with different land indices'
+            hist = np.add(a[5], b[5], dtype = 'uint16')
+        return counts, last[1], last[2], last[3], events, hist, a[6]
+
+    return counts, last[1], last[2], last[3]
+
+#### Partial results on disk
+def partial_save(result, fn):
+    """Write a day-block count result (see add_counts) to fn, a .npz, and return the small
+    handle that stands for it: a list of one (fn, meta, stop, number of items), None for a
+    None result."""
+
+    if result is None:
+        return None
+
+    arrays = {'counts' : result[0], 'nan_mask' : result[1]}
+    if len(result) > 4:
+        for i, state in enumerate(result[4] or []):
+            for k, v in state.items():
+                arrays['ev' + str(i) + '_' + k] = v
+        if result[5] is not None:
+            arrays['hist'] = result[5]
+        if result[6] is not None:
+            arrays['idx'] = result[6]
+
+    os.makedirs(os.path.dirname(fn), exist_ok = True)
+    with open(fn, 'wb') as f: # no .npz added to the name
+        np.savez(f, **arrays)
+
+    return [(fn, result[2], result[3], len(result))]
+
+def partial_load(handle):
+    """Read back one partial result written by partial_save, as the tuple it was made from."""
+
+    fn, meta, stop, n = handle
+    with np.load(fn) as f:
+        result = [f['counts'], f['nan_mask'], meta, stop]
+        if n > 4:
+            states = {}
+            for key in f.files:
+                if key.startswith('ev'):
+                    i, k = key[2:].split('_', 1)
+                    states.setdefault(int(i), {})[k] = f[key] if f[key].ndim else f[key].item()
+            result.append([states[i] for i in sorted(states)] or None)
+            result.append(f['hist'] if 'hist' in f.files else None)
+            result.append(f['idx'] if 'idx' in f.files else None)
+
+    return tuple(result)
+
+def spill(function, folder, task):
+    """Run function(task) in a worker and write its result to folder with partial_save, so
+    only the handle goes back through the pool, not the full-grid arrays. Use as
+    partial(spill, function, folder) with combine = add_partials."""
+
+    fn = os.path.join(folder, function.__name__ + '.' + '.'.join(str(t) for t in task) + '.npz')
+
+    return partial_save(function(task), fn)
+
+def add_partials(a, b):
+    """Combine two lists of partial result handles of the same year."""
+
+    if a is None:
+        return b
+    if b is None:
+        return a
+
+    return a + b
+
+def partial_merge(handles):
+    """Combine the partial results of a year from their handles with add_counts, one file in
+    memory at a time, and delete the files. Returns the combined result, None for None."""
+
+    if handles is None:
+        return None
+
+    result = None
+    for handle in sorted(handles, key = lambda h: h[2]):
+        result = add_counts(result, partial_load(handle))
+        os.remove(handle[0])
+
+    return result
+
+def worker_init(modules = (), function = None, settings = None):
+    """Pool initializer. Imports modules, the ones the tasks need, before the first task, and
+    sets settings, dict of name: value, as globals of the task function, e.g. a script's
+    globals from main for workers that don't inherit them (forkserver, spawn)."""
+
+    for name in modules:
+        importlib.import_module(name)
+    if settings:
+        while isinstance(function, partial): # e.g. partial(spill, count_days, folder), the script's function
+            function = next((a for a in function.args if callable(a)), function.func)
+        function.__globals__.update(settings) # the globals the function sees, for a main script not its module's
+
+def make_pool(cpu_num, start_method = None, preload = (), function = None, settings = None):
+    """
+    Process pool of cpu_num workers started with worker_init(preload, function, settings).
+
+    Args:
+        cpu_num (int): number of worker processes.
+        start_method (str): None for the default (fork on linux), workers are copies of the
+            main process with all its globals and imports. 'forkserver' forks the workers
+            from a server process that imported only preload, so startup and per-worker memory
+            don't grow with the main process, globals the tasks need go in settings.
+        preload (tuple): modules the tasks need, e.g. ('numpy', 'rasterio', 'ClimFuncs').
+        function (callable): the task function, settings are set as its globals.
+        settings (dict): see worker_init.
+
+    Returns Pool
+    """
+
+    ctx = mp.get_context(start_method)
+    if start_method == 'forkserver':
+        ctx.set_forkserver_preload(list(preload))
+
+    return ctx.Pool(processes = cpu_num, initializer = worker_init, initargs = (tuple(preload), function, settings))
+
+def schedule(function, tasks, cpu_num = None, combine = add_counts, finish = None, on_task = None,
+             start_method = None, preload = (), settings = None):
+    """
+    Runs function over tasks on a process pool, one task at a time per worker, handing out
+    the next task to whichever worker frees up first. Results are combined per year (the
+    first item of each task) as they complete, and finish(year, result) is called in the
+    main process as soon as the last task of a year is in.
+
+    Args:
+        function (callable): top-level function taking one task.
+        tasks (list): tasks, e.g. from day_tasks, task[0] is the year.
+        cpu_num (int): number of worker processes, None for all CPUs.
+        combine (callable): combine(acc, result) for two results of the same year.
+        finish (callable): finish(year, result) once a year is complete, None to skip.
+        on_task (callable): on_task(task, result) as each task completes, e.g. to update a
+            manifest, None to skip.
+        start_method, preload, settings: how the workers are started, see make_pool.
+
+    Returns dict with the wall time, busy time per worker and utilization
+    """
+
+    cpu_num = os.cpu_count() if cpu_num is None else cpu_num
+
+    remaining = {}
+    for task in tasks:
+        remaining[task[0]] = remaining.get(task[0], 0) + 1
+    acc = {}
+    busy = {}
+
+    start = time.time()
+    with make_pool(cpu_num, start_method, preload, function, settings) as pool:
+        for task, result, worker, t0, t1 in pool.imap_unordered(partial(timed, function), tasks, chunksize = 1):
+            busy[worker] = busy.get(worker, 0) + t1 - t0
+            if on_task is not None:
+                on_task(task, result)
+            year = task[0]
+            acc[year] = combine(acc.get(year), result)
+            remaining[year] -= 1
+            if remaining[year] == 0:
+                result = acc.pop(year)
+                if finish is not None:
+                    finish(year, result)
+                print(year, 'done', round(time.time() - start, 1), 's')
+    wall = time.time() - start
+
+    stats = {'wall_s' : wall, 'cpu_num' : cpu_num, 'tasks' : len(tasks), 'busy_s' : busy,
+             'utilization' : sum(busy.values()) / (wall * cpu_num) if wall > 0 else 0}
+    print(wall)
+    print('worker utilization', round(100 * stats['utilization'], 1), '%', 'over', len(busy), 'workers,',
+          'busiest', round(max(busy.values(), default = 0), 1), 's, idlest', round(min(busy.values(), default = 0), 1), 's')
+
+    return stats
+
+def load_script(fn, name):
+    """
+    Imports one of the numbered pipeline scripts (e.g. 01_Make-HI-WBGT.py, next to this file) 
+    as a module called name, so its functions can be run with its settings set as module 
+    attributes. The module is registered in sys.modules so its functions can be sent to a pool.
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    spec = importlib.util.spec_from_file_location(name, os.path.join(here, fn))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name] # don't leave a half imported module behind
+        raise
+
+    return module
+
+def run_dag(function, deps, cpu_num = None, priority = None, on_done = None, start_method = None, 
+            preload = (), settings = None):
+    """
+    Runs function over a graph of tasks on a process pool. A task is handed to a worker as 
+    soon as all the tasks it needs are done, at most cpu_num at a time, picking the ready 
+    task with the lowest priority(task) first (e.g. downstream stages first, so they keep 
+    up with the upstream ones). A failed task is printed and the tasks needing it are skipped.
+
+    Args:
+        function (callable): top-level function taking one task.
+        deps (dict): task: list of the tasks it needs, every task is a key.
+        cpu_num (int): number of worker processes, None for all CPUs.
+        priority (callable): sort key of the ready tasks, None for the order of deps.
+        on_done (callable): on_done(task, result) in the main process as each task completes, 
+            e.g. to write a manifest, None to skip.
+        start_method, preload, settings: how the workers are started, see make_pool.
+
+    Returns dict with the wall time, busy time per worker, utilization, and the failed and 
+    skipped tasks
+    """
+
+    cpu_num = os.cpu_count() if cpu_num is None else cpu_num
+    order = {task : i for i, task in enumerate(deps)}
+    priority = order.get if priority is None else priority
+
+    waiting = {task : set(need) for task, need in deps.items()}
+    needed_by = {task : [] for task in deps}
+    for task, need in deps.items():
+        for n in need:
+            needed_by[n].append(task)
+
+    ready = [task for task, need in waiting.items() if not need]
+    for task in ready:
+        del waiting[task]
+    done = queue.Queue()
+    busy, failed, n_running = {}, [], 0
+
+    start = time.time()
+    with make_pool(cpu_num, start_method, preload, function, settings) as pool:
+        while ready or n_running:
+            
+            # hand out ready tasks
+            ready.sort(key = priority)
+            while ready and n_running < cpu_num:
+                task = ready.pop(0)
+                pool.apply_async(timed, (function, task), callback = done.put, 
+                                 error_callback = lambda e, task = task: done.put((task, e, None, None, None)))
+                n_running += 1
+            
+            # wait for one to finish
+            task, result, worker, t0, t1 = done.get()
+            n_running -= 1
+            if isinstance(result, BaseException):
+                print(task, 'failed:', repr(result))
+                failed.append(task)
+                continue
+            busy[worker] = busy.get(worker, 0) + t1 - t0
+            if on_done is not None:
+                on_done(task, result)
+            print(task, 'done', round(time.time() - start, 1), 's')
+            
+            # release the tasks waiting on it
+            for nxt in needed_by[task]:
+                if nxt in waiting:
+                    waiting[nxt].discard(task)
+                    if not waiting[nxt]:
+                        del waiting[nxt]
+                        ready.append(nxt)
+    wall = time.time() - start
+
+    stats = {'wall_s' : wall, 'cpu_num' : cpu_num, 'tasks' : len(deps), 'busy_s' : busy,
+             'utilization' : sum(busy.values()) / (wall * cpu_num) if wall > 0 else 0,
+             'failed' : failed, 'skipped' : list(waiting)}
+    print(wall)
+    print('worker utilization', round(100 * stats['utilization'], 1), '%,', len(failed), 'failed,', len(waiting), 'skipped')
+
+    return stats
+
+#### Run manifest
+def run_key(fns_in, params):
+    """Key of an output: its inputs' size and mtime, the run parameters and the ClimFuncs
+    version. Any change gives a new key.
+
+    Args:
+        fns_in = input files the output is made from
+        params = dict of the run parameters the output depends on (json-able)
+
+    Returns hex string
+    """
+
+    stamps = []
+    for fn in fns_in:
+        st = os.stat(fn)
+        stamps.append([fn, st.st_size, st.st_mtime_ns])
+    blob = json.dumps({'inputs' : stamps, 'params' : params, 'ClimFuncs' : ClimFuncs.__version__}, sort_keys = True, default = str)
+
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+def manifest_load(fn):
+    """Load a manifest, an empty one if it doesn't exist yet."""
+
+    if not os.path.exists(fn):
+        return {}
+    with open(fn) as f:
+        return json.load(f)
+
+def manifest_save(manifest, fn):
+    """Save a manifest, written to a temp file first so a crash can't leave it half written."""
+
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 1)
+    os.replace(fn + '.tmp', fn)
+
+def manifest_done(manifest, fn_out, key):
+    """True if fn_out is in the manifest with this key and is still on disk at the recorded size."""
+
+    rec = manifest.get(fn_out)
+
+    return (rec is not None and rec['key'] == key and os.path.exists(fn_out)
+            and os.path.getsize(fn_out) == rec['size'])
+
+def manifest_add(manifest, fn_out, key):
+    """Record a finished output."""
+
+    manifest[fn_out] = {'key' : key, 'size' : os.path.getsize(fn_out), 'time' : time.time(),
+                        'ClimFuncs' : ClimFuncs.__version__}
@@ -0,0 +1,153 @@
+##################################################################################
+#
+#    Sketch Funcs
+#    By Cascade Tuholske
+#
+#    Per-pixel histogram sketches of daily values (e.g. WBGTmax), built in the
+#    count pass one day at a time, so per-pixel percentiles over decades of
+#    days (e.g. the 1983-2012 90th percentile) never need the days in memory.
+#
+#    A sketch is a (n_bins + 3, pixels) uint16 array for fixed bins of step °C
+#    from lo to hi, closed on the right, (edge, edge + step]: row 0 counts the
+#    days at or below lo, rows 1 to n_bins the bins, row n_bins + 1 the days
+#    above hi and the last row the nodata days. Sketches of day blocks, years
+#    or workers merge by adding them. A percentile is good to about one bin
+#    (linear within the bin), and days above a per-pixel threshold to within
+#    the days in the threshold's bin, exact for a threshold on a bin edge
+#    (e.g. 30 °C with 0.25 °C bins): a day at the threshold is in the bin
+#    below it, so it is not above, same as the count rasters' strict >.
+#
+#    Memory is (n_bins + 3) x 2 bytes per pixel, e.g. 246 bytes for 10 to
+#    40 °C in 0.25 °C bins, half that as uint8 for blocks of up to 255 days,
+#    so pack to the land pixels where it matters.
+#
+#################################################################################
+
+
+#### Dependencies
+import numpy as np
+
+# bump when the binning changes, run manifests use it to know sketches are out of date
+__version__ = '1.1.0'
+
+#### Functions
+def n_bins(bins):
+    """Number of bins of bins = (lo, hi, step)."""
+
+    lo, hi, step = bins
+
+    return int(round((hi - lo) / step))
+
+def sketch_new(n_pix, bins, dtype = 'uint16'):
+    """Empty sketch for n_pix pixels and bins = (lo, hi, step), uint8 holds up to 255 days."""
+
+    return np.zeros((n_bins(bins) + 3, n_pix), dtype = dtype)
+
+def sketch_update(hist, arr, pix, bins):
+    """Add one day to the sketch. Each pixel is added to once, so windows of a day can be
+    added from several threads at once.
+
+    Args:
+        hist = sketch from sketch_new
+        arr = the day's values of the pixels, any shape, -9999 nodata and no NaN
+        pix = flat pixel indices (into the sketch columns) of arr, same size as arr
+        bins = (lo, hi, step)
+    """
+
+    lo, hi, step = bins
+    nb = n_bins(bins)
+    arr = arr.reshape(-1)
+
+    b = np.ceil((arr - np.float32(lo)) / np.float32(step)) # bin k is (lo + (k - 1) step, lo + k step]
+    np.clip(b, 0, nb + 1, out = b)
+    b[arr == -9999] = nb + 2
+    hist[b.astype(np.intp), pix] += 1
+
+def sketch_quantile(hist, bins, q, chunk = 2**20):
+    """Per-pixel q quantile (0 to 1) of the days in a sketch, interpolated linearly within
+    its bin. Pixels whose quantile is below lo or above hi get lo or hi, pixels with no
+    valid day -9999.
+
+    Returns float32 array, one value per pixel
+    """
+
+    lo, hi, step = bins
+    nb = n_bins(bins)
+    out = np.full(hist.shape[1], -9999, dtype = 'float32')
+
+    for p0 in range(0, hist.shape[1], chunk):
+        h = hist[:nb + 2, p0:p0 + chunk].astype('float64')
+        cum = np.cumsum(h, axis = 0)
+        n = cum[-1]
+        target = q * n
+
+        k = (cum < target).sum(axis = 0) # bin of the quantile
+        k = np.minimum(k, nb + 1)
+        cols = np.arange(h.shape[1])
+        below = cum[k, cols] - h[k, cols]
+        frac = np.divide(target - below, h[k, cols], out = np.zeros(h.shape[1]), where = h[k, cols] > 0)
+
+        val = lo + (k - 1 + frac) * step
+        val = np.where(k == 0, lo, np.where(k == nb + 1, hi, val))
+        out[p0:p0 + chunk] = np.where(n > 0, val, -9999)
+
+    return out
+
+def sketch_exceed(hist, bins, thresh, chunk = 2**20):
+    """Days above a per-pixel threshold from a sketch, counting the part of the threshold's
+    bin above it as if its days were spread evenly over the bin. Days at or below lo are taken 
+    to be below and days above hi above any threshold between lo and hi. For a threshold on a 
+    bin edge this is exactly the days > thresh, a day equal to it is in the bin below.
+
+    Args:
+        hist = sketch
+        bins = (lo, hi, step)
+        thresh = threshold per pixel (or one for all), -9999 for none
+
+    Returns int16 array of days, -9999 where thresh is -9999
+    """
+
+    lo, hi, step = bins
+    nb = n_bins(bins)
+    thresh = np.broadcast_to(np.asarray(thresh, dtype = 'float64'), (hist.shape[1],))
+    out = np.full(hist.shape[1], -9999, dtype = 'int16')
+
+    for p0 in range(0, hist.shape[1], chunk):
+        h = hist[:nb + 2, p0:p0 + chunk].astype('float64')
+        t = thresh[p0:p0 + chunk]
+        above = np.zeros((nb + 3, h.shape[1])) # days in bin k and above, nothing above the overflow
+        above[:nb + 2] = np.cumsum(h[::-1], axis = 0)[::-1]
+
+        pos = np.clip((t - lo) / step, 0, nb) # position of thresh in bin units
+        k = np.minimum(np.floor(pos).astype(np.intp) + 1, nb + 1) # its bin
+        cols = np.arange(h.shape[1])
+        upper = above[k + 1, cols]
+        part = np.where(k <= nb, h[k, cols] * (k - pos), h[k, cols]) # share of the bin above thresh
+
+        days = np.rint(upper + part)
+        out[p0:p0 + chunk] = np.where(t == -9999, -9999, days)
+
+    return out
+
+def sketch_save(fn, hist, bins, shape, idx = None):
+    """Save a sketch with its bins and grid, idx the flat grid indices of packed (land) pixels."""
+
+    extra = {} if idx is None else {'idx' : idx}
+    np.savez(fn, hist = hist, bins = np.array(bins, dtype = 'float64'), shape = np.array(shape), **extra)
+
+def sketch_load(fns):
+    """Load a sketch, or several on the same grid and bins (e.g. the years of a climatology)
+    merged by adding them. Returns (hist, bins, shape, idx)."""
+
+    fns = [fns] if isinstance(fns, str) else fns
+    hist = None
+    for fn in fns:
+        with np.load(fn) as f:
+            if hist is None:
+                hist = f['hist'].astype('uint32') if len(fns) > 1 else f['hist']
+                bins, shape = tuple(f['bins']), tuple(f['shape'])
+                idx = f['idx'] if 'idx' in f else None
+            else:
+                hist += f['hist']
+
+    return hist, bins, shape, idx
@@ -0,0 +1,131 @@
+##################################################################################
+#
+#    Trace Funcs
+#    By Cascade Tuholske
+#
+#    Per-stage timing for the pipeline scripts. Wrap a piece of work in
+#    stage('read', nbytes) and, when tracing is on (trace_dir set), its start,
+#    end, bytes, worker, thread, year and day are kept in memory and appended
+#    to one jsonl file per worker process by flush(). summary() reads the
+#    files back and prints the time and MB/s per stage, worker and day.
+#
+#    Tracing is off by default, then stage() records nothing.
+#
+#################################################################################
+
+
+#### Dependencies
+import os
+import json
+import glob
+import time
+import threading
+import multiprocessing as mp
+from contextlib import contextmanager
+
+#### Settings, set trace_dir (in main, before the pool starts) to turn tracing on
+trace_dir = None
+
+_events = []
+_tag = {}
+
+#### Functions
+def set_tag(**tag):
+    """Tag the events that follow in this process, e.g. set_tag(year = 2016, day = '2016.01.01').
+    The windows of a day run on threads of the same process, so the tag is per process."""
+
+    global _tag
+    _tag = tag
+
+@contextmanager
+def stage(name, nbytes = 0):
+    """Time the block inside as stage name, with nbytes read or written (array bytes). Yields a
+    dict, set its 'bytes' inside the block when the size is only known after a read."""
+
+    info = {'bytes' : nbytes}
+    if trace_dir is None:
+        yield info
+        return
+
+    start = time.time()
+    yield info
+    _events.append(dict(_tag, stage = name, start = start, end = time.time(), bytes = int(info['bytes']),
+                        worker = mp.current_process().name, thread = threading.current_thread().name))
+
+def flush():
+    """Append this process's events to its trace file and clear them. Call at the end of a task."""
+
+    if trace_dir is None or not _events:
+        return
+
+    os.makedirs(trace_dir, exist_ok = True)
+    fn = os.path.join(trace_dir, 'trace.' + str(os.getpid()) + '.jsonl')
+    events = _events[:]
+    del _events[:len(events)]
+    with open(fn, 'a') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+
+def load(path = None):
+    """All events of the trace files in path (trace_dir by default) as a list of dicts."""
+
+    events = []
+    for fn in sorted(glob.glob(os.path.join(path or trace_dir, 'trace.*.jsonl'))):
+        with open(fn) as f:
+            events.extend(json.loads(line) for line in f)
+
+    return events
+
+def _group(events, key):
+    """Total seconds, bytes and count of events grouped by key(event)."""
+
+    out = {}
+    for e in events:
+        k = key(e)
+        g = out.setdefault(k, {'seconds' : 0.0, 'bytes' : 0, 'n' : 0})
+        g['seconds'] += e['end'] - e['start']
+        g['bytes'] += e['bytes']
+        g['n'] += 1
+    for g in out.values():
+        g['mb_per_s'] = g['bytes'] / 2**20 / g['seconds'] if g['seconds'] > 0 else 0
+
+    return out
+
+def summary(path = None, top = 5):
+    """
+    Prints the time per stage (with MB/s for read and write), the busy time per worker and
+    the slowest days, and writes it all to summary.json in the trace folder.
+
+    Args:
+        path = trace folder, trace_dir by default
+        top = number of slowest days to print
+
+    Returns the summary dict
+    """
+
+    path = path or trace_dir
+    events = load(path)
+    if not events:
+        print('no trace events in', path)
+        return {}
+
+    wall = max(e['end'] for e in events) - min(e['start'] for e in events)
+    stages = _group(events, lambda e: e['stage'])
+    workers = _group(events, lambda e: e['worker'])
+    days = _group(events, lambda e: str(e.get('year', '')) + ' ' + str(e.get('day', '')))
+    by_worker_stage = _group(events, lambda e: e['worker'] + '|' + e['stage'])
+
+    total = sum(g['seconds'] for g in stages.values())
+    print('trace', len(events), 'events,', round(wall, 1), 's wall,', round(total, 1), 's in stages')
+    for name, g in sorted(stages.items(), key = lambda kv: -kv[1]['seconds']):
+        print('  ' + name.ljust(8), str(round(g['seconds'], 2)).rjust(9), 's', str(round(100 * g['seconds'] / total, 1)).rjust(5), '%',
+              (str(round(g['mb_per_s'], 1)) + ' MB/s') if g['bytes'] else '')
+    print('  workers busy', {w : round(g['seconds'], 1) for w, g in sorted(workers.items())})
+    print('  slowest days', [(d, round(g['seconds'], 2)) for d, g in sorted(days.items(), key = lambda kv: -kv[1]['seconds'])[:top]])
+
+    out = {'wall_s' : wall, 'events' : len(events), 'stages' : stages, 'workers' : workers, 'days' : days,
+           'worker_stages' : by_worker_stage}
+    with open(os.path.join(path, 'summary.json'), 'w') as f:
+        json.dump(out, f, indent = 1)
+
+    return out
@@ -0,0 +1,317 @@
+##################################################################################
+#
+#       Benchmark
+#       By Cascade Tuholske, cascade (dot) tuholske1 (at) montana (dot) edu
+#
+#       Times the pipeline stages on synthetic CHC-CMIP6 style data so a change
+#       to ClimFuncs.heatindex, hi_loop, annual_count_array or raster_avg can be
+#       checked for speed without the real inputs.
+#
+#       make_synthetic writes a year of daily Tmax and RHx GeoTIFFs laid out like
+#       the CHC-CMIP6 data (PATH/SSP_dataset/Tmax/YEAR, PATH/SSP_dataset/RHx/YEAR)
+#       on a lon/lat grid at any resolution, with an ocean mask (Tmax -9999, RHx
+#       NaN) and plausible Tmax and RHx fields. Each stage then runs in its own
+#       fresh process and reports wall time, pixels/s, MB/s read + written and
+#       peak RSS. Results are written to a json, compare two of them with
+#       compare_runs.
+#
+#       Update args for each run (e.g. res, n_days) in main.
+#
+#################################################################################
+
+# Dependencies
+import numpy as np
+import os
+import sys
+import json
+import glob
+import time
+import resource
+import platform
+import subprocess
+import multiprocessing as mp
+import rasterio
+from rasterio.transform import from_origin
+import ClimFuncs
+import RunFuncs
+
+# Functions
+
+def ocean_mask(height, width, ocean_frac, rng):
+    """
+    Smooth random land/ocean mask with about ocean_frac of the pixels ocean, made from
+    coarse noise blown up to the grid so the coasts are blobby like real ones.
+    """
+
+    coarse = rng.random((max(height // 16, 2), max(width // 16, 2)))
+    rows = np.linspace(0, coarse.shape[0] - 1, height).astype(int)
+    cols = np.linspace(0, coarse.shape[1] - 1, width).astype(int)
+    field = coarse[rows][:, cols]
+
+    return field < np.quantile(field, ocean_frac)
+
+def make_synthetic(path, SSP_dataset, year, n_days = 365, res = 0.05, bounds = (-180, -60, 180, 70),
+                   ocean_frac = 0.6, seed = 0):
+    """
+    Writes n_days of daily Tmax (°C, nodata -9999 over ocean) and RHx (%, NaN over ocean)
+    GeoTIFFs for a year, named like the CHC-CMIP6 files (Tmax.YEAR.MM.DD.tif,
+    RHx.YEAR.MM.DD.tif), and makes the himax/wbgtmax/annual_counts folders the stages
+    write to.
+
+    Args:
+        path (str): root folder, PATH in the pipeline scripts.
+        SSP_dataset (str): scenario folder, e.g. '2050_SSP245'.
+        year (int): year to make.
+        n_days (int): number of days.
+        res (float): pixel size in degrees, 0.05 is the CHC-CMIP6 grid.
+        bounds (tuple): west, south, east, north of the grid.
+        ocean_frac (float): share of ocean pixels.
+        seed (int): random seed.
+
+    Returns list of (rh_fn, tmax_fn)
+    """
+
+    rng = np.random.default_rng(seed)
+    west, south, east, north = bounds
+    height, width = int(round((north - south) / res)), int(round((east - west) / res))
+    meta = {'driver' : 'GTiff', 'dtype' : 'float32', 'nodata' : -9999, 'count' : 1, 'height' : height,
+            'width' : width, 'crs' : 'EPSG:4326', 'transform' : from_origin(west, north, res, res)}
+
+    # fixed fields, hot and humid at the equator
+    ocean = ocean_mask(height, width, ocean_frac, rng)
+    lat = np.linspace(north, south, height, dtype = 'float32')[:, None]
+    tmax_base = 38 - 0.35 * np.abs(lat) + 4 * rng.standard_normal((height, width), dtype = 'float32')
+    rh_base = 75 - 0.5 * np.abs(lat) + 15 * rng.standard_normal((height, width), dtype = 'float32')
+
+    for folder in ['Tmax', 'RHx', 'himax', 'wbgtmax']:
+        os.makedirs(os.path.join(path, SSP_dataset, folder, str(year)), exist_ok = True)
+    os.makedirs(os.path.join(path, SSP_dataset, 'annual_counts'), exist_ok = True)
+
+    fns = []
+    dates = np.datetime64(str(year) + '-01-01') + np.arange(n_days)
+    for i, date in enumerate(dates):
+        stamp = str(date).replace('-', '.')
+        season = 5 * np.sin(2 * np.pi * i / 365) * np.sign(lat)
+        tmax = (tmax_base + season + 2 * rng.standard_normal((height, width), dtype = 'float32')).astype('float32')
+        rh = np.clip(rh_base + 10 * rng.standard_normal((height, width), dtype = 'float32'), 1, 100).astype('float32')
+        tmax[ocean] = -9999
+        rh[ocean] = np.nan
+
+        tmax_fn = os.path.join(path, SSP_dataset, 'Tmax', str(year), 'Tmax.' + stamp + '.tif')
+        rh_fn = os.path.join(path, SSP_dataset, 'RHx', str(year), 'RHx.' + stamp + '.tif')
+        with rasterio.open(tmax_fn, 'w', **meta) as out:
+            out.write_band(1, tmax)
+        with rasterio.open(rh_fn, 'w', **meta) as out:
+            out.write_band(1, rh)
+        fns.append((rh_fn, tmax_fn))
+
+    print(len(fns), 'days of', height, 'x', width, 'written to', os.path.join(path, SSP_dataset))
+
+    return fns
+
+def make_counts(fn_like, fns_out, seed = 0):
+    """
+    Writes synthetic annual count rasters (int16, -9999 over ocean) on the grid of fn_like,
+    e.g. an annual count from stage_counts, for the raster_avg stage.
+    """
+
+    rng = np.random.default_rng(seed)
+    with rasterio.open(fn_like) as src:
+        meta = src.meta
+        base = src.read(1)
+
+    for fn in fns_out:
+        arr = np.where(base == -9999, -9999, np.clip(base + rng.integers(-10, 10, base.shape), 0, 366)).astype('int16')
+        with rasterio.open(fn, 'w', **meta) as out:
+            out.write_band(1, arr)
+
+def file_mb(fns):
+    """Total size of files in MB."""
+
+    return sum(os.path.getsize(fn) for fn in fns) / 2**20
+
+def stage_heatindex(cfg):
+    """ClimFuncs.heatindex (xarray) and heatindex_np on the first day, in memory."""
+
+    import xarray as xr
+    rh_fn, tmax_fn = sorted(glob.glob(cfg['rh_glob']))[0], sorted(glob.glob(cfg['tmax_glob']))[0]
+    tmax = rasterio.open(tmax_fn).read(1)
+    rh = rasterio.open(rh_fn).read(1)
+    n = tmax.size * cfg['repeat']
+
+    t0 = time.time()
+    for _ in range(cfg['repeat']):
+        ClimFuncs.heatindex(xr.DataArray(tmax), xr.DataArray(rh), unit_in = 'C', unit_out = 'C')
+    t_xr = time.time() - t0
+
+    scratch, out = ClimFuncs.hi_scratch(tmax.shape), np.empty(tmax.shape, dtype = 'float32')
+    t0 = time.time()
+    for _ in range(cfg['repeat']):
+        ClimFuncs.heatindex_np(tmax, rh, unit_in = 'C', unit_out = 'C', out = out, scratch = scratch)
+    t_np = time.time() - t0
+
+    return {'seconds' : t_np, 'pixels' : n, 'px_per_s' : n / t_np, 'heatindex_xr_seconds' : t_xr,
+            'heatindex_xr_px_per_s' : n / t_xr, 'mb_read' : 0, 'mb_written' : 0}
+
+def stage_hi_loop(cfg):
+    """01_Make-HI-WBGT.py hi_loop for the year, daily himax and wbgtmax written."""
+
+    hi = RunFuncs.load_script('01_Make-HI-WBGT.py', 'make_hi_wbgt')
+    hi.path, hi.SSP_dataset, hi.rh_handle = cfg['path'], cfg['SSP_dataset'], 'RHx.'
+    hi.write_daily, hi.count_thresh, hi.out_profile = True, None, cfg['out_profile']
+    hi.n_threads, hi.mem_mb, hi.prefetch = cfg['n_threads'], cfg['mem_mb'], cfg['prefetch']
+    hi.land_only = cfg['land_only']
+
+    fns = hi.hi_files(cfg['year'])
+    t0 = time.time()
+    hi.hi_loop(cfg['year'])
+    seconds = time.time() - t0
+
+    fns_out = [fn for day in fns for fn in hi.day_outputs(cfg['year'], day)]
+    with rasterio.open(fns[0][1]) as src:
+        n = src.height * src.width * len(fns)
+
+    return {'seconds' : seconds, 'pixels' : n, 'px_per_s' : n / seconds,
+            'mb_read' : file_mb([fn for day in fns for fn in day]), 'mb_written' : file_mb(fns_out)}
+
+def stage_counts(cfg):
+    """02_count_days.py annual_count_array on the wbgtmax of the year."""
+
+    counts = RunFuncs.load_script('02_count_days.py', 'count_days')
+    counts.path_in = os.path.join(cfg['path'], cfg['SSP_dataset'], 'wbgtmax') + '/'
+    counts.path_out = os.path.join(cfg['path'], cfg['SSP_dataset'], 'annual_counts') + '/'
+    counts.data_in, counts.thresh = 'wbgtmax', cfg['thresh']
+    counts.n_threads, counts.mem_mb, counts.prefetch = cfg['n_threads'], cfg['mem_mb'], cfg['prefetch']
+    counts.land_only, counts.heat_events, counts.spell_days = cfg['land_only'], cfg['heat_events'], 3
+    counts.sketch = None
+    for fn in counts.count_outputs(cfg['year']):
+        os.makedirs(os.path.dirname(fn), exist_ok = True)
+
+    fns = counts.year_files(cfg['year'])
+    t0 = time.time()
+    counts.annual_count_array(cfg['year'])
+    seconds = time.time() - t0
+
+    with rasterio.open(fns[0]) as src:
+        n = src.height * src.width * len(fns)
+
+    return {'seconds' : seconds, 'pixels' : n, 'px_per_s' : n / seconds,
+            'mb_read' : file_mb(fns), 'mb_written' : file_mb(counts.count_outputs(cfg['year']))}
+
+def stage_raster_avg(cfg):
+    """03_ten_year_avg.py raster_avg over avg_years synthetic annual counts."""
+
+    avg = RunFuncs.load_script('03_ten_year_avg.py', 'ten_year_avg')
+    count_path = os.path.join(cfg['path'], cfg['SSP_dataset'], 'annual_counts', 'wbgtmax' + str(cfg['thresh']))
+    fn_like = os.path.join(count_path, 'wbgtmax' + str(cfg['thresh']) + '.count.' + str(cfg['year']) + '.tif')
+    fns = [os.path.join(count_path, 'bench.wbgtmax' + str(cfg['thresh']) + '.count.' + str(y) + '.tif')
+           for y in range(cfg['avg_years'])]
+    make_counts(fn_like, fns)
+    fn_out = os.path.join(count_path, 'bench.avg.tif')
+
+    t0 = time.time()
+    avg.raster_avg(fns, fn_out)
+    seconds = time.time() - t0
+
+    with rasterio.open(fn_out) as src:
+        n = src.height * src.width * len(fns)
+
+    return {'seconds' : seconds, 'pixels' : n, 'px_per_s' : n / seconds,
+            'mb_read' : file_mb(fns), 'mb_written' : file_mb([fn_out])}
+
+def run_stage(name, cfg):
+    """Runs one stage in this (fresh) process and adds its peak RSS and MB/s."""
+
+    stage = globals()['stage_' + name]
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on linux
+    result = stage(cfg)
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result['start_rss_mb'] = rss0
+    result['mb_per_s'] = (result['mb_read'] + result['mb_written']) / result['seconds']
+
+    return result
+
+def run_benchmark(cfg, stages, fn_out):
+    """
+    Runs each stage in a new process (so peak RSS is the stage's own) and writes the
+    results with the config, ClimFuncs version, git commit and machine to a json.
+
+    Returns the results dict
+    """
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True,
+                                cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+
+    results = {'time' : time.strftime('%Y-%m-%d %H:%M:%S'), 'commit' : commit, 'ClimFuncs' : ClimFuncs.__version__,
+               'python' : sys.version.split()[0], 'numpy' : np.__version__, 'rasterio' : rasterio.__version__,
+               'machine' : platform.platform(), 'cpu_count' : os.cpu_count(), 'config' : cfg, 'stages' : {}}
+
+    ctx = mp.get_context('spawn')
+    for name in stages:
+        with ctx.Pool(1) as pool:
+            try:
+                result = pool.apply(run_stage, (name, cfg))
+            except Exception as e: # keep going, e.g. a stage's imports are missing
+                result = {'error' : repr(e)}
+        results['stages'][name] = result
+        print(name, {k : round(v, 2) if isinstance(v, float) else v for k, v in result.items()})
+
+    with open(fn_out, 'w') as f:
+        json.dump(results, f, indent = 1)
+    print(fn_out, 'done')
+
+    return results
+
+def compare_runs(fn_a, fn_b, key = 'px_per_s'):
+    """Prints the change in key (default pixels/s) of each stage from benchmark json fn_a to fn_b."""
+
+    with open(fn_a) as f:
+        a = json.load(f)
+    with open(fn_b) as f:
+        b = json.load(f)
+
+    print(a['commit'], '->', b['commit'])
+    for name, res in b['stages'].items():
+        old = a['stages'].get(name, {}).get(key)
+        new = res.get(key)
+        if old and new:
+            print(name, key, round(old, 1), '->', round(new, 1), '(' + str(round(100 * (new / old - 1), 1)) + ' %)')
+        else:
+            print(name, 'n/a')
+
+# Run it
+if __name__ == "__main__":
+
+    # Set args
+    path = os.path.join('bench/') # scratch folder for the synthetic data, needs room for 4 x n_days rasters
+    path_out = os.path.join('bench/') # path to write the results json
+    SSP_dataset = '2050_SSP245'
+    year = 2050
+    n_days = 30 # days to make and run
+    res = 0.25 # degrees, 0.05 for the full CHC-CMIP6 grid (7200 x 2600)
+    ocean_frac = 0.6
+
+    cfg = {'path' : path, 'SSP_dataset' : SSP_dataset, 'year' : year, 'n_days' : n_days, 'res' : res,
+           'ocean_frac' : ocean_frac, 'thresh' : 30, 'avg_years' : 10, 'repeat' : 3,
+           'n_threads' : 1, 'mem_mb' : None, 'prefetch' : 1, 'land_only' : False, 'heat_events' : False, 'out_profile' : 'gtiff',
+           'rh_glob' : os.path.join(path, SSP_dataset, 'RHx', str(year), '*.tif'),
+           'tmax_glob' : os.path.join(path, SSP_dataset, 'Tmax', str(year), '*.tif')}
+
+    # stages in order, hi_loop makes the wbgtmax that counts reads and counts the one raster_avg copies
+    stages = ['heatindex', 'hi_loop', 'counts', 'raster_avg']
+
+    # make the data once
+    if len(glob.glob(cfg['tmax_glob'])) != n_days:
+        make_synthetic(path, SSP_dataset, year, n_days = n_days, res = res, ocean_frac = ocean_frac)
+
+    # run it
+    fn_out = os.path.join(path_out, 'bench.' + time.strftime('%Y%m%d-%H%M%S') + '.json')
+    run_benchmark(cfg, stages, fn_out)
+
+    # compare with an earlier run
+    # compare_runs(os.path.join(path_out, 'bench.OLD.json'), fn_out)
+
+    print('done!')
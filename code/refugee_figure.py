@@ -0,0 +1,150 @@
+##################################################################################
+#
+#       Refugee Figure
+#       By Cascade Tuholske, cascade (dot) tuholske1 (at) montana (dot) edu
+#
+#       ALWAYS CHECK FILE PATHS AND FILE NAMES BEFORE RUNNING
+#
+#       Scripted version of the figure in refugee_figure.ipynb: the average days
+#       per year above a threshold at the UNHCR settlements for observations
+#       (panel A) and a scenario (panel B), each with West and East Africa
+#       insets, and the 15 hottest settlements in the scenario (panel C).
+#
+#       Makes one figure per scenario and threshold in one run. The basemaps of
+#       each zoom level, the country names and the settlement pixel index are
+#       cached in cache_dir on the first run (the only step that needs
+#       geopandas), and the settlement values of every avg count raster are
+#       read in one go, see FigureFuncs.
+#
+#       Update args for each run (e.g. scenarios, thresh) in main.
+#
+#################################################################################
+
+# Dependencies
+import os
+import time
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
+from matplotlib import cm
+import FigureFuncs
+
+# Functions
+
+def avg_fn(ssp, t):
+    """The avg count raster of a scenario and threshold, named as 03_ten_year_avg.py writes it."""
+
+    return os.path.join(path_in + ssp + '.' + data + str(t) + '.avg_count_' + window + '.tif')
+
+def make_figure(ssp, t, vals):
+    """
+    Makes and saves the figure of one scenario and threshold.
+
+    Args:
+        ssp (str): scenario, a key of scenarios.
+        t (int): threshold.
+        vals (DataFrame): settlement values, a column per avg count raster, from
+            FigureFuncs.settlement_values.
+    """
+
+    obs = vals[avg_fn(obs_ssp, t)].values
+    proj = vals[avg_fn(ssp, t)].values
+    unit = 'Days per Year ' + data_label + ' > ' + str(t) + '°C'
+
+    plt.rcParams['mathtext.default'] = 'regular'
+    plt.rcParams['font.size'] = 12
+    fig, axs = plt.subplots(3, 1, figsize = (10, 14), sharex = False)
+    fig.subplots_adjust(wspace = 0.1, hspace = .1)
+
+    # maps and insets
+    for ax, v, letter in zip(axs[:2], [obs, proj], ['(A)', '(B)']):
+        FigureFuncs.map_panel(ax, bases['world'], pts, v, cmap, norm, s = 10, bounds = zooms['world'][0])
+        for name, inset in insets.items():
+            FigureFuncs.inset_panel(ax, bases[name], pts, v, cmap, norm, inset, s = 15)
+        ax.text(-0.02, 1.0, letter, transform = ax.transAxes, fontsize = 14, ha = 'right')
+    axs[0].set_title('Average Hazardous Heat Stress Days per Year, ' + scenarios[obs_ssp], fontsize = 14)
+    axs[1].set_title('Average Hazardous Heat Stress Days per Year, ' + scenarios[ssp], fontsize = 14)
+
+    # top n settlements in the scenario
+    top = pts.assign(proj = proj, obs = obs).dropna(subset = ['proj'])
+    top = top.sort_values('proj', ascending = False).iloc[:n_top]
+    labels = top['gis_name'] + ', ' + top['iso3'].map(names).fillna(top['iso3'])
+    axs[2].barh(y = labels, width = top['proj'], color = 'darkred')
+    axs[2].barh(y = labels, width = top['obs'], color = '#ff8000')
+    axs[2].set_xlim([0, 365])
+    axs[2].legend(labels = [scenarios[ssp], scenarios[obs_ssp]])
+    axs[2].set_xlabel(unit)
+    axs[2].set_title('Top ' + str(n_top) + ' Hottest Refugee Camps in ' + scenarios[ssp], fontsize = 14)
+    axs[2].text(-0.02, 1.0, '(C)', transform = axs[2].transAxes, fontsize = 14, ha = 'right')
+
+    # color bar
+    cb_ax = fig.add_axes([.05, 0.48, 0.02, 0.3])
+    cbar = fig.colorbar(cm.ScalarMappable(norm = norm, cmap = cmap), orientation = 'vertical', cax = cb_ax)
+    cbar.set_label(unit)
+    cb_ax.yaxis.set_label_position('left')
+
+    # save it
+    fn_out = os.path.join(path_out + ssp + '.' + data + str(t) + '_refugees.png')
+    plt.savefig(fn_out, dpi = dpi, bbox_inches = 'tight')
+    plt.close(fig)
+    print(fn_out, 'done')
+
+# Run it
+if __name__ == "__main__":
+
+    # Data
+    path_in = os.path.join('') # path to the avg counts from 03
+    path_out = os.path.join('') # where the figures go
+    cache_dir = os.path.join(path_in) # basemaps, country names and settlement index
+    fn_pts = os.path.join('../wrl_prp_p_unhcr_refugees_noLBN_onlySettlements-2024_02.geojson')
+    fn_shp = os.path.join('../ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp')
+    data = 'wbgtmax'
+    data_label = 'WBGTmax'
+    thresh = [30] # [28, 30, 32]
+    window = '07-16' # avg window, as 03 names it
+
+    # ssp as in the 03 file names: label, the first is the observations
+    scenarios = {'' : 'Avg. 2007-2016',
+                 '2050_SSP245' : '2050 (SSP245)',
+                 # '2050_SSP585' : '2050 (SSP585)',
+                 }
+    obs_ssp = list(scenarios)[0]
+
+    # Zoom levels: bounds to clip to (lon/lat) and simplify tolerance, about a pixel at dpi
+    dpi = 300
+    zooms = {'world' : ((-180, -60, 180, 90), 0.05),
+             'West Africa' : ((-19, 11, -9, 18), 0.005),
+             'East Africa' : ((34, 12.5, 43, 18.5), 0.005)}
+
+    # Insets as in the notebook, the aspect ratio of the West Africa box
+    aspect_ratio = 1.2
+    insets = {'West Africa' : {'title' : 'West Africa', 'xlim' : (-17.7, -10), 'ylim' : (12, 12 + (17 - 12) / aspect_ratio),
+                               'box' : (-17.7, 12, 7.7, 5), 'width' : '140%', 'height' : '90%',
+                               'bbox_to_anchor' : (-0.1, 0.26, 0.25, 0.25)},
+              'East Africa' : {'title' : 'East Africa', 'xlim' : (35, 41.9), 'ylim' : (13.4, 13.4 + (18 - 13.4) / aspect_ratio),
+                               'box' : (35, 13.4, 6.9, 4.6), 'width' : '143%', 'height' : '93%',
+                               'bbox_to_anchor' : (-0.103, -0.08, 0.25, 0.25)}}
+    n_top = 15
+
+    # Colors, insets share the maps' 0 to 365 scale
+    cmap = FigureFuncs.hot_cmap()
+    norm = mcolors.Normalize(vmin = 0, vmax = 365)
+
+    # Basemaps, names and settlements, cached after the first run
+    start = time.time()
+    bases = {name : FigureFuncs.basemap(fn_shp, bounds, tol, cache_dir = cache_dir) for name, (bounds, tol) in zooms.items()}
+    names = FigureFuncs.country_names(fn_shp, cache_dir = cache_dir)
+    pts = FigureFuncs.settlements(fn_pts)
+
+    # Values of every scenario and threshold in one read
+    fns = [avg_fn(ssp, t) for t in thresh for ssp in scenarios]
+    vals = FigureFuncs.settlement_values(fn_pts, fns, cache_dir = cache_dir)
+    print('set up', round(time.time() - start, 1), 's')
+
+    # One figure per scenario and threshold
+    for t in thresh:
+        for ssp in list(scenarios)[1:]:
+            make_figure(ssp, t, vals)
+
+    print('done!', round(time.time() - start, 1), 's')
@@ -0,0 +1,307 @@
+##################################################################################
+#
+#       Run Pipeline
+#       By Cascade Tuholske, cascade (dot) tuholske1 (at) montana (dot) edu
+#
+#       ALWAYS CHECK FILE PATHS AND FILE NAMES BEFORE RUNNING
+#
+#       Runs steps 01 to 03 for several scenarios (e.g. observed, SSP245, SSP585)
+#       in one shared pool from one config, instead of editing the globals of
+#       each script between runs. Each (scenario, year) is split into blocks of
+#       day_block days like the scripts do (RunFuncs.day_tasks): hi tasks
+#       (hi_days of 01), then count tasks (count_days of 02) as soon as the hi
+#       blocks of their year are done, and each (scenario, threshold) an avg
+#       task (raster_avgs of 03) as soon as the counts of its window years are
+#       done, so counting 1983 doesn't wait for the HI of 2016 and a year is
+#       spread over workers. A year's counts are written in the main process
+#       once its last block is in. Downstream tasks go first when workers free up.
+#
+#       Work already done going by the 01, 02 and avg manifests is skipped. The
+#       scripts' own settings are set on them per task, see setup_hi and
+#       setup_counts.
+#
+#       Set the config in main, or run it from the command line with a json of
+#       it, e.g. python run_pipeline.py pipeline.json --cpu_num 64, see
+#       python run_pipeline.py -h. With --start_method forkserver the workers
+#       start lean, importing only the modules the tasks need (preload).
+#
+#################################################################################
+
+# Dependencies
+import os
+import json
+import argparse
+import RunFuncs
+import RasterFuncs
+
+# Modules the tasks import, preloaded in the forkserver, see RunFuncs.make_pool
+preload = ('numpy', 'rasterio', 'ClimFuncs', 'RasterFuncs', 'CubeFuncs', 'RunFuncs', 'TraceFuncs', 'EventFuncs', 'SketchFuncs')
+
+# Functions
+
+def scenario_configs(config):
+    """
+    One flat config per scenario, the top level settings with the scenario's own on top.
+
+    Args:
+        config (dict): run config, see main.
+
+    Returns dict of scenario name: config
+    """
+
+    base = {k : v for k, v in config.items() if k != 'scenarios'}
+
+    return {sc['name'] : dict(base, **sc) for sc in config['scenarios']}
+
+def setup_hi(sc):
+    """01_Make-HI-WBGT.py set up for a scenario."""
+
+    hi = RunFuncs.load_script('01_Make-HI-WBGT.py', 'make_hi_wbgt')
+    hi.path, hi.SSP_dataset, hi.rh_handle = sc['path'], sc['SSP_dataset'], sc['rh_handle']
+    hi.write_daily, hi.out_profile = sc['write_daily'], sc['out_profile']
+    hi.count_thresh = sc['thresh'] if sc['fused'] else None
+    hi.n_threads, hi.mem_mb, hi.prefetch = sc['n_threads'], sc['mem_mb'], sc['prefetch']
+    hi.land_only, hi.land = sc['land_only'], sc['land']
+
+    return hi
+
+def setup_counts(sc):
+    """02_count_days.py set up for a scenario, reading the wbgtmax written by 01."""
+
+    cd = RunFuncs.load_script('02_count_days.py', 'count_days')
+    cd.path_in = os.path.join(sc['path'], sc['SSP_dataset'] + '/' + sc['data'] + '/')
+    cd.path_out = os.path.join(sc['path'], sc['SSP_dataset'] + '/annual_counts/')
+    cd.data_in, cd.thresh = sc['data'], sc['thresh']
+    cd.n_threads, cd.mem_mb, cd.prefetch = sc['n_threads'], sc['mem_mb'], sc['prefetch']
+    cd.land_only, cd.heat_events, cd.spell_days = sc['land_only'], sc['heat_events'], sc['spell_days']
+    cd.sketch, cd.land = sc['sketch'], sc['land']
+
+    return cd
+
+def avg_windows(sc, t):
+    """
+    Count rasters and averaging windows of one threshold of a scenario, named like 03.
+
+    Returns (fns, windows) for raster_avgs
+    """
+
+    cd = setup_counts(sc)
+    fns = {year : os.path.join(cd.path_out, sc['data'] + str(t) + '/' + sc['data'] + str(t) + '.count.' + str(year) + '.tif')
+           for year in sc['years']}
+    windows = {}
+    for name, (first, last) in sc['avg_windows'].items():
+        fn_out = os.path.join(sc['path'] + sc['avg_path'] + sc['ssp'] + '.' + sc['data'] + str(t) + '.avg_count_' + name + '.tif')
+        windows[fn_out] = [fns[y] for y in sc['years'] if first <= y <= last]
+
+    return [fns[y] for y in sc['years']], windows
+
+def make_dirs(sc):
+    """Output folders the scripts expect to exist."""
+
+    for year in sc['years']:
+        for data in ['himax', 'wbgtmax']:
+            os.makedirs(os.path.join(sc['path'], sc['SSP_dataset'] + '/' + data + '/' + str(year)), exist_ok = True)
+    for t in sc['thresh']:
+        os.makedirs(os.path.join(sc['path'], sc['SSP_dataset'] + '/annual_counts/' + sc['data'] + str(t)), exist_ok = True)
+    os.makedirs(os.path.join(sc['path'] + sc['avg_path']), exist_ok = True)
+
+def avg_manifest_fn(sc):
+    """Manifest of the averages of a scenario, next to them."""
+
+    return os.path.join(sc['path'] + sc['avg_path'], 'manifest.avg.' + sc['name'] + '.json')
+
+def avg_done(sc, t, manifest):
+    """True if the averages of a threshold are in the manifest with their current count rasters."""
+
+    _, windows = avg_windows(sc, t)
+    if not all(os.path.exists(fn) for members in windows.values() for fn in members):
+        return False
+
+    return all(RunFuncs.manifest_done(manifest, fn_out, RunFuncs.run_key(members, {'thresh' : t}))
+               for fn_out, members in windows.items())
+
+def build_graph(scenarios):
+    """
+    Tasks and what they need: ('hi', scenario, year, start, stop) blocks of the days to do, 
+    ('count', scenario, year, start, stop) blocks needing the hi blocks of their year, and 
+    ('avg', scenario, thresh) needing the count blocks (or with fused, the hi blocks) of its 
+    window years. Days and years done going by the 01/02 manifests get no task.
+
+    Args:
+        scenarios (dict): from scenario_configs.
+
+    Returns dict of task: list of tasks it needs
+    """
+
+    deps = {}
+    for name, sc in scenarios.items():
+        hi = setup_hi(sc)
+        hi_manifest = RunFuncs.manifest_load(os.path.join(sc['path'], sc['SSP_dataset'] + '/manifest.hi.json'))
+        cd = setup_counts(sc)
+        count_manifest = RunFuncs.manifest_load(os.path.join(cd.path_out, 'manifest.' + sc['data'] + '.json'))
+
+        # years in any avg window
+        avg_years = [y for y in sc['years'] if any(a <= y <= b for a, b in sc['avg_windows'].values())]
+
+        for year in sc['years']:
+            todo = hi.hi_todo(year, hi_manifest)
+            hi_blocks = [('hi', name) + task for task in RunFuncs.day_tasks({year : todo}, sc['day_block'])]
+            for task in hi_blocks:
+                deps[task] = []
+            if sc['fused'] or not (hi_blocks or not cd.count_done(year, count_manifest)):
+                continue
+            
+            # one wbgtmax per hi day, not written yet if its hi blocks are to run. Count blocks index 
+            # the year's listing of them, so they wait for every hi block of the year
+            n_days = len(hi.hi_files(year)) if hi_blocks else len(cd.year_files(year))
+            for task in RunFuncs.day_tasks({year : n_days}, sc['day_block']):
+                deps[('count', name) + task] = list(hi_blocks)
+
+        if sc['avg_windows']:
+            stage = 'hi' if sc['fused'] else 'count'
+            avg_manifest = RunFuncs.manifest_load(avg_manifest_fn(sc))
+            for t in sc['thresh']:
+                need = [task for task in deps if task[:2] == (stage, name) and task[2] in avg_years]
+                if need or not avg_done(sc, t, avg_manifest):
+                    deps[('avg', name, t)] = need
+
+    return deps
+
+def year_blocks(deps):
+    """Number of blocks of each (kind, scenario, year) in the graph, for task_done."""
+
+    blocks = {}
+    for task in deps:
+        if task[0] != 'avg':
+            blocks[task[:3]] = blocks.get(task[:3], 0) + 1
+
+    return blocks
+
+def priority(task):
+    """Averages, then counts, then HI, oldest year and first days first, so downstream work keeps up."""
+
+    return {'avg' : 0, 'count' : 1, 'hi' : 2}[task[0]], str(task[2]), task[3:]
+
+def run_task(task):
+    """
+    Runs one task in a worker, with the script set up for the task's scenario.
+
+    Returns the handle of the partial result of hi_days or count_days written to disk
+    (RunFuncs.spill), for the manifests and count writes in the main process, None for avg
+    """
+
+    kind, name, key = task[:3]
+    sc = scenarios[name]
+
+    if kind == 'hi':
+        hi = setup_hi(sc)
+        return RunFuncs.spill(hi.hi_days, os.path.join(sc['path'], sc['SSP_dataset'] + '/partial/'), task[2:])
+    if kind == 'count':
+        cd = setup_counts(sc)
+        return RunFuncs.spill(cd.count_days, os.path.join(cd.path_out, 'partial/'), task[2:])
+    if kind == 'avg':
+        avg = RunFuncs.load_script('03_ten_year_avg.py', 'ten_year_avg')
+        fns, windows = avg_windows(sc, key)
+        avg.raster_avgs(fns, windows, sc['land'] if sc['land_only'] else None)
+
+def task_done(task, result):
+    """
+    Main process side of a finished task: adds the days of a hi block to the 01 manifest, 
+    collects the partial results of a year's blocks, writes the counts and updates the 01/02 
+    manifests once the year's last block is in (same as RunFuncs.schedule does for the 
+    scripts), and updates the avg manifest.
+    """
+
+    kind, name, key = task[:3]
+    sc = scenarios[name]
+    if kind != 'avg':
+        acc[task[:3]] = RunFuncs.add_partials(acc.get(task[:3]), result)
+        remaining[task[:3]] -= 1
+        last = remaining[task[:3]] == 0
+
+    if kind == 'hi':
+        hi = setup_hi(sc)
+        manifest_fn = os.path.join(sc['path'], sc['SSP_dataset'] + '/manifest.hi.json')
+        manifest = RunFuncs.manifest_load(manifest_fn)
+        hi.hi_record(task[2:], result, manifest, manifest_fn)
+        if last:
+            result = acc.pop(task[:3])
+            if result is not None:
+                hi.hi_finish(key, result, manifest, manifest_fn)
+    if kind == 'count' and last:
+        cd = setup_counts(sc)
+        manifest_fn = os.path.join(cd.path_out, 'manifest.' + sc['data'] + '.json')
+        cd.count_finish(key, acc.pop(task[:3]), RunFuncs.manifest_load(manifest_fn), manifest_fn)
+    if kind == 'avg':
+        manifest = RunFuncs.manifest_load(avg_manifest_fn(sc))
+        for fn_out, members in avg_windows(sc, key)[1].items():
+            RunFuncs.manifest_add(manifest, fn_out, RunFuncs.run_key(members, {'thresh' : key}))
+        RunFuncs.manifest_save(manifest, avg_manifest_fn(sc))
+
+# Run it
+if __name__ == "__main__":
+
+    # Config, or load it from a json with the same keys
+    config = {
+        'path' : os.path.join(''), # PATH/TO/DATA with a folder per SSP_dataset
+        'rh_handle' : 'RHx.',
+        'data' : 'wbgtmax',
+        'thresh' : [28, 30, 32],
+        'years' : list(range(1983, 2016+1)),
+        'avg_windows' : {'07-16' : [2007, 2016]}, # name: [first year, last year], as 03 names them
+        'avg_path' : 'refugees/', # under path, where 03 writes the averages
+        'write_daily' : True, # 01 writes the daily himax and wbgtmax
+        'fused' : False, # 01 counts the days itself, no count tasks
+        'day_block' : 30, # days per hi and count task, see RunFuncs.day_tasks
+        'out_profile' : 'gtiff',
+        'n_threads' : 1,
+        'mem_mb' : None,
+        'prefetch' : 1, # days read ahead, 0 to read window by window within mem_mb
+        'land_only' : False, # compute on the land pixels only, see RasterFuncs.land_index
+        'heat_events' : False, # 02 also writes the longest run, spells and degree-days, see EventFuncs
+        'spell_days' : 3,
+        'sketch' : None, # 02 also keeps per-pixel histograms for percentiles, e.g. [10, 40, 0.25], see SketchFuncs, (n_bins + 3) bytes per pixel per count task, see sketch in 02
+        'scenarios' : [
+            {'name' : 'obs', 'SSP_dataset' : 'obs', 'ssp' : ''}, # observations, in a folder like the SSPs
+            {'name' : '2050_SSP245', 'SSP_dataset' : '2050_SSP245', 'ssp' : '2050_SSP245'},
+            {'name' : '2050_SSP585', 'SSP_dataset' : '2050_SSP585', 'ssp' : '2050_SSP585'},
+        ],
+    }
+
+    # Command line
+    parser = argparse.ArgumentParser(description = 'Runs steps 01 to 03 for several scenarios in one pool.')
+    parser.add_argument('config', nargs = '?', help = 'json of the config, the one in main if not given')
+    parser.add_argument('--cpu_num', type = int, default = os.cpu_count(), help = 'number of worker processes')
+    parser.add_argument('--start_method', choices = ['fork', 'forkserver', 'spawn'], default = None,
+                        help = 'how workers start, forkserver for lean workers on many cores')
+    parser.add_argument('--dry_run', action = 'store_true', help = 'list the tasks to run and stop')
+    args = parser.parse_args()
+    if args.config is not None:
+        with open(args.config) as f:
+            config = json.load(f)
+    cpu_num = args.cpu_num
+
+    # scenarios and their folders
+    scenarios = scenario_configs(config)
+    for sc in scenarios.values():
+        make_dirs(sc)
+        
+        # one land index per scenario for all its tasks, from the first Tmax day of each year
+        sc['land'] = None
+        if sc['land_only']:
+            sc['land'] = RasterFuncs.land_index(setup_hi(sc).land_ref(sc['years']), cache_dir = os.path.join(sc['path'], sc['SSP_dataset']))
+
+    # the graph, only the work not done yet
+    deps = build_graph(scenarios)
+    remaining, acc = year_blocks(deps), {} # blocks left and partial results per (kind, scenario, year)
+    print(len(deps), 'tasks to run')
+    if args.dry_run:
+        for task, need in deps.items():
+            print(task, 'needs', need)
+        raise SystemExit
+
+    # run it, workers that don't fork from main get the scenarios from the pool initializer
+    RunFuncs.run_dag(run_task, deps, cpu_num, priority = priority, on_done = task_done, start_method = args.start_method, 
+                     preload = preload, settings = {'scenarios' : scenarios})
+
+    print('done!')
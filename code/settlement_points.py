@@ -0,0 +1,184 @@
+##################################################################################
+#
+#       Settlement Points
+#       By Cascade Tuholske, cascade (dot) tuholske1 (at) montana (dot) edu
+#
+#       ALWAYS CHECK FILE PATHS AND FILE NAMES BEFORE RUNNING
+#
+#       Point-only version of steps 01 to 03 for the UNHCR settlements. Each
+#       settlement is mapped to the CHC-CMIP6 pixel it falls in once, then for
+#       each day only the raster blocks holding settlements are read and HImax
+#       and WBGTmax are made for those pixels only. Writes per-settlement annual
+#       day counts above each threshold and mean WBGTmax per year, and the
+#       average count over the years in avg_years (e.g. 2007 - 2016), which
+#       is the same value zonal_stats pulls from the 03 rasters in the notebook.
+#
+#       Update args for each run (e.g. SSP_dataset, thresh) in main.
+#
+#################################################################################
+
+# Dependencies
+import numpy as np
+import os
+import glob
+import time
+import multiprocessing as mp
+from multiprocessing import Pool
+import ClimFuncs
+import PointFuncs
+
+# Functions
+
+def day_files(year):
+    """
+    Lists the daily CHC-CMIP6 RHx and Tmax rasters for a year, paired by day.
+
+    Args:
+        year (int): year to list.
+
+    Returns list of (rh_fn, tmax_fn)
+    """
+
+    rh_path = os.path.join(path, SSP_dataset + '/' + rh_handle.split('.')[0] + '/' + str(year))
+    tmax_path = os.path.join(path, SSP_dataset + '/Tmax/' + str(year))
+    rh_fns = sorted(glob.glob(rh_path+'/*'+ rh_handle + '*.tif'))
+    tmax_fns = sorted(glob.glob(tmax_path+'/*.tif'))
+
+    return list(zip(rh_fns,tmax_fns))
+
+def point_loop(year):
+
+    """
+    Makes daily HImax and WBGTmax at the settlement pixels for a year and writes the
+    per-settlement counts of days above each threshold and the mean WBGTmax to a csv.
+
+    The math is the same as hi_loop in 01_Make-HI-WBGT.py and annual_count_array in
+    02_count_days.py, only for the settlement pixels.
+
+    Args:
+        year (int): The year to process.
+
+    Note:
+        - Ensure that `path`, `path_out`, `SSP_dataset`, `rh_handle`, `thresh`, `pts` and
+          `blocks` are defined and accessible in the global scope.
+        - Settlements off the grid get NaN. Counts are NaN where the last day of the year is
+          nodata, the nan mask of annual_count_array in 02_count_days.py, and the mean WBGTmax
+          is NaN where no day is valid.
+    """
+
+    print(mp.current_process(), year)
+
+    # one or many thresholds
+    threshs = thresh if isinstance(thresh, (list, tuple)) else [thresh]
+
+    n = len(pts)
+    counts = np.zeros((len(threshs), n), dtype = 'int16')
+    wbgt_sum = np.zeros(n, dtype = 'float64')
+    n_days = np.zeros(n, dtype = 'int16')
+
+    for rh_fn, tmax_fn in day_files(year):
+
+        # settlement pixels only
+        tmax = PointFuncs.read_points(tmax_fn, blocks, n)
+        rh = PointFuncs.read_points(rh_fn, blocks, n)
+
+        # heat index, CMIP NaN
+        arr = ClimFuncs.heatindex_np(Tmax = tmax, RH = rh, unit_in = 'C', unit_out = 'C')
+        arr[arr < -1000] = -9999
+
+        # wbgt, CMIP NaN
+        wbgt_arr = ClimFuncs.hi_to_wbgt(ClimFuncs.C_to_F(arr)).astype('float32')
+        wbgt_arr[wbgt_arr < -1000] = -9999
+
+        # counts and sums
+        for j, t in enumerate(threshs):
+            counts[j] += wbgt_arr > t # nan and -9999 are never above thresh
+        valid = (wbgt_arr != -9999) & np.isfinite(wbgt_arr)
+        wbgt_sum[valid] += wbgt_arr[valid]
+        n_days += valid
+
+    # nan mask of the last day, same as 02
+    last_valid = valid
+
+    # write it
+    df = pts[['pcode', 'lon', 'lat']].copy()
+    for t, count in zip(threshs, counts):
+        df[data + str(t)] = np.where(last_valid, count, np.nan)
+    df[data + '_mean'] = np.where(n_days > 0, wbgt_sum / np.maximum(n_days, 1), np.nan)
+    df['n_days'] = n_days
+
+    fn_out = os.path.join(path_out, SSP_dataset + '.' + data + '.points.' + str(year) + '.csv')
+    df.to_csv(fn_out, index = False)
+    print(fn_out, 'done')
+
+def points_avg(fns, fn_out):
+
+    """
+    Averages the per-settlement annual counts and mean WBGTmax over a set of years, like
+    raster_avg in 03_ten_year_avg.py does for the count rasters.
+
+    Args:
+        fns (list of str): annual csvs from point_loop.
+        fn_out (str): csv to write.
+    """
+
+    import pandas as pd
+
+    df = pd.concat([pd.read_csv(fn) for fn in fns])
+    avg = df.drop(columns = 'n_days').groupby(['pcode', 'lon', 'lat'], sort = False).mean().reset_index()
+    avg.to_csv(fn_out, index = False)
+    print(fn_out, 'done')
+
+def parallel_loop(function, start_list, cpu_num):
+    """
+    Executes a given function in parallel using multiple CPU cores.
+
+    This function leverages Python's multiprocessing capabilities to run the
+    specified function concurrently across a given number of CPU cores. The
+    function is applied to each element of the provided `start_list`.
+
+    Args:
+        function (callable): The function to execute in parallel. It should be
+            able to accept elements from the `start_list` as arguments.
+        start_list (list): A list of arguments to pass to the `function` in parallel.
+        cpu_num (int): The number of CPU cores to utilize for parallel processing.
+    """
+    start = time.time()
+    pool = Pool(processes = cpu_num)
+    pool.map(function, start_list)
+    pool.close()
+
+    end = time.time()
+    print(end-start)
+
+# Run it
+if __name__ == "__main__":
+
+    # Set args
+    path = os.path.join('') # PATH/TO/DATA with the CHC-CMIP6 Tmax and RHx
+    path_out = os.path.join('') # path to write the settlement csvs
+    gdf_fn = os.path.join('../wrl_prp_p_unhcr_refugees_noLBN_onlySettlements-2024_02.geojson')
+    SSP_dataset = '2050_SSP245' # blank for observational data
+    rh_handle = 'RHx.'
+    data = 'wbgtmax'
+    thresh = [28, 30, 32]
+
+    # set year list to feed point_loop and the years to average
+    year_list = list(range(1983,2016+1))
+    avg_years = list(range(2007,2016+1))
+
+    # map the settlements to the grid once, workers get them from here
+    fn_grid = day_files(year_list[0])[0][1]
+    pts = PointFuncs.settlement_pixels(gdf_fn, fn_grid)
+    blocks = PointFuncs.point_blocks(pts, fn_grid)
+    print(len(pts), 'settlements,', (~pts['valid']).sum(), 'off the grid,', len(blocks), 'blocks to read')
+
+    # run it
+    parallel_loop(function = point_loop, start_list = year_list, cpu_num = os.cpu_count()) # number of CPUS available
+
+    # average the years
+    fns = [os.path.join(path_out, SSP_dataset + '.' + data + '.points.' + str(year) + '.csv') for year in avg_years]
+    fn_out = os.path.join(path_out, SSP_dataset + '.' + data + '.points.avg_' + str(avg_years[0]) + '-' + str(avg_years[-1]) + '.csv')
+    points_avg(fns, fn_out)
+
+    print('done!')